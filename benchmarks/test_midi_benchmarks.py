@@ -0,0 +1,181 @@
+"""
+Benchmarks of the MIDI send paths, on the in-process loopback backend so that
+they run w/o hardware, e.g. on a headless Linux box:
+
+    pytest benchmarks --no-cov
+
+Latencies are measured up to the last byte received by the virtual device, see
+MidiRecorder. To compare a new send strategy, add it to SEND_STRATEGIES.
+"""
+import asyncio
+import io
+import itertools
+import pathlib
+
+import mido
+import pytest
+
+from text2synth import mcp_server
+from text2synth.midi import AsyncMidiSender, LoopbackBackend, MidiOutput, TokenBucket
+from text2synth.state import JU06AState
+from text2synth.synths import JU_A6_A_LINK
+
+
+pytest.importorskip("pytest_benchmark")
+
+PAD_PRM = pathlib.Path(__file__).parent.parent / "tests" / "pad.prm"
+PORT = "loopback"
+
+
+async def _send(midi, messages):
+    for msg in messages:
+        midi.send(msg)
+
+
+async def _send_async(midi, messages):
+    for msg in messages:
+        await midi.send_async(msg)
+
+
+async def _async_sender(midi, messages):
+    sender = AsyncMidiSender(midi)
+    sender.submit(messages)
+    await sender.flush()
+    await sender.close()
+
+
+# name -> async callable(midi, messages), sending the messages and returning
+# once the last one is sent
+SEND_STRATEGIES = {
+    "send": _send,
+    "send_async": _send_async,
+    "async_sender": _async_sender,
+}
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def state():
+    return JU06AState.from_path(str(PAD_PRM))
+
+
+class _CountingBucket(TokenBucket):
+    """ TokenBucket counting the bytes it is charged."""
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.charged = 0
+
+    def reserve(self, nbytes):
+        self.charged += nbytes
+        return super().reserve(nbytes)
+
+
+def _link_limiter():
+    return _CountingBucket(JU_A6_A_LINK["bytes_per_second"], JU_A6_A_LINK["burst_bytes"])
+
+
+@pytest.mark.parametrize("strategy", SEND_STRATEGIES)
+def test_messages_per_second(benchmark, loop, strategy):
+    """ Throughput of the send path itself, w/o rate limiting."""
+    # Given
+    backend = LoopbackBackend()
+    recorder = backend.recorder(PORT)
+    midi = MidiOutput(PORT, backend)
+    # Distinct CC, so that no strategy may coalesce them
+    messages = [
+        mido.Message("control_change", channel=channel, control=control, value=control)
+        for channel, control in itertools.product(range(16), range(64))
+    ]
+    send = SEND_STRATEGIES[strategy]
+
+    def run():
+        recorder.clear()
+        loop.run_until_complete(send(midi, messages))
+        assert len(recorder.messages) == len(messages)
+
+    # When
+    benchmark(run)
+
+    # Then
+    # No stats w/ --benchmark-disable
+    if benchmark.stats:
+        benchmark.extra_info["messages_per_second"] = len(messages) / benchmark.stats["mean"]
+
+
+@pytest.mark.parametrize("strategy", SEND_STRATEGIES)
+def test_full_patch_latency(benchmark, loop, state, strategy):
+    """ Latency of a full patch apply, up to the last byte on the JU-06A link."""
+    # Given
+    backend = LoopbackBackend()
+    recorder = backend.recorder(PORT)
+    messages = JU06AState.diff_cc_messages(None, state)
+    send = SEND_STRATEGIES[strategy]
+
+    def setup():
+        recorder.clear()
+        # Fresh limiter: every apply starts w/ an idle link
+        midi = MidiOutput(PORT, backend, limiter=_link_limiter())
+        return (midi,), {}
+
+    def run(midi):
+        start = backend.clock.time()
+        loop.run_until_complete(send(midi, messages))
+        latencies.append(recorder.last_time - start)
+        charged.append(midi.limiter.charged)
+
+    # When
+    latencies = []
+    charged = []
+    benchmark.pedantic(run, setup=setup, rounds=20)
+
+    # Then
+    assert len(recorder.messages) == len(messages)
+    # Latencies are only comparable if every strategy pays for what it sends
+    assert charged[-1] == recorder.bytes_received
+    benchmark.extra_info["bytes"] = recorder.bytes_received
+    benchmark.extra_info["max_last_byte_latency"] = max(latencies)
+
+
+@pytest.fixture
+def mcp_recorder(monkeypatch, loop):
+    """ Point the MCP server to a loopback device, and return its recorder."""
+    backend = LoopbackBackend()
+    monkeypatch.setattr(mcp_server.MIDI_OUT, "backend", backend)
+    monkeypatch.setattr(mcp_server.MIDI_OUT, "limiter", mcp_server.MIDI_OUT.limiter)
+    monkeypatch.setattr(mcp_server, "STATE", JU06AState.from_file(io.StringIO(mcp_server.INIT_106)))
+    monkeypatch.setattr(mcp_server, "SENT_STATE", None)
+    monkeypatch.setattr(mcp_server, "SENDER", AsyncMidiSender(mcp_server.MIDI_OUT))
+    yield backend.recorder(mcp_server.MIDI_OUT.name)
+    loop.run_until_complete(mcp_server.SENDER.close())
+
+
+@pytest.mark.parametrize("tool", ["update_synth_state", "reset"])
+def test_mcp_tool_call_latency(benchmark, loop, mcp_recorder, tool):
+    """ Latency from an MCP tool call to the last byte sent to the synth."""
+    # Given
+    # Cutoff is sent as value // 2: step by 2 so that every call sends a CC
+    values = itertools.cycle(range(0, 256, 2))
+
+    async def call():
+        arguments = {"cutoff": next(values)} if tool == "update_synth_state" else {}
+        await mcp_server.server.call_tool(tool, arguments)
+        await mcp_server.SENDER.flush()
+
+    def setup():
+        mcp_recorder.clear()
+        # Start every call w/ an idle link
+        mcp_server.MIDI_OUT.limiter = _link_limiter()
+        return (), {}
+
+    # When
+    benchmark.pedantic(lambda: loop.run_until_complete(call()), setup=setup, rounds=50)
+
+    # Then
+    assert len(mcp_recorder.messages) > 0
+    benchmark.extra_info["messages"] = len(mcp_recorder.messages)
@@ -0,0 +1,29 @@
+"""
+Benchmarks of the offline renderer:
+
+    pytest benchmarks --no-cov
+"""
+import pathlib
+
+import pytest
+
+from text2synth.render import DEFAULT_NOTES, SAMPLE_RATE, render
+from text2synth.state import JU06AState
+
+
+pytest.importorskip("pytest_benchmark")
+
+PAD_PRM = pathlib.Path(__file__).parent.parent / "tests" / "pad.prm"
+
+
+def test_render(benchmark):
+    """ Rendering speed of a patch, in multiples of real time."""
+    # Given
+    state = JU06AState.from_path(str(PAD_PRM))
+
+    # When
+    audio = benchmark(render, state, DEFAULT_NOTES)
+
+    # Then
+    if benchmark.stats:
+        benchmark.extra_info["real_time_factor"] = len(audio) / SAMPLE_RATE / benchmark.stats["mean"]
@@ -0,0 +1,89 @@
+"""
+Benchmarks of JU06AState loading, and of its updates as done by the MCP server
+for each update_synth_state call:
+
+    pytest benchmarks --no-cov
+"""
+import pathlib
+import re
+
+import pytest
+
+from text2synth.state import JU06AState
+
+
+pytest.importorskip("pytest_benchmark")
+
+PAD_PRM = pathlib.Path(__file__).parent.parent / "tests" / "pad.prm"
+
+UPDATES = {"cutoff": 10, "resonance": 20, "attack": 30, "osc_range": 2}
+
+
+def _setattr(state, updates):
+    for name, value in updates.items():
+        setattr(state, name, value)
+
+
+def _apply_updates(state, updates):
+    state.apply_updates(updates)
+
+
+@pytest.mark.parametrize("update", [_setattr, _apply_updates], ids=["setattr", "apply_updates"])
+def test_update(benchmark, update):
+    # Given
+    state = JU06AState.from_path(str(PAD_PRM))
+
+    # When
+    benchmark(update, state, UPDATES)
+
+    # Then
+    assert state.cutoff == 10
+
+
+def _regex_from_file(fp):
+    # Reference implementation, to benchmark against
+    parsed_values = {}
+    lines = [line.strip() for line in fp.readlines() if line.strip()]
+    for i, line in enumerate(lines):
+        match = re.match(r'^(.+?)\s*\((.+?)\)\s*;?$', line)
+        if not match:
+            continue
+        attr_name = match.group(1).strip().lower().replace(' ', '_')
+        value = match.group(2).strip()
+        parsed_values[attr_name] = value if i == len(lines) - 1 else int(value)
+    parsed_values.pop("patch_name")
+    parsed_values.pop("bend_range")
+    parsed_values.pop("tempo_sync")
+    return JU06AState(**parsed_values)
+
+
+def _load_regex(paths):
+    states = []
+    for path in paths:
+        with open(path, encoding="ascii") as fp:
+            states.append(_regex_from_file(fp))
+    return states
+
+
+@pytest.fixture(scope="module")
+def library(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("library")
+    state = JU06AState.from_path(str(PAD_PRM))
+    paths = []
+    for i in range(2000):
+        state.cutoff = i % 256
+        path = directory / f"patch{i}.PRM"
+        state.to_path(path, f"PATCH {i}")
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("load", [_load_regex, JU06AState.load_many], ids=["regex", "load_many"])
+def test_load(benchmark, library, load):
+    # When
+    states = benchmark(load, library)
+
+    # Then
+    assert [state.cutoff for state in states] == [i % 256 for i in range(len(library))]
+    if benchmark.stats:
+        benchmark.extra_info["patches_per_second"] = len(library) / benchmark.stats["mean"]
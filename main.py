@@ -1,18 +1,28 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import json
 import logging
+import shutil
 import sys
-import textwrap
-import time
 
 from pathlib import Path
 
 import mido
 
-from pydantic_ai import Agent
-
-from text2synth.state import JU06AState
+from text2synth.agent import (
+    DEFAULT_ATTEMPTS, DEFAULT_CONCURRENCY, DEFAULT_RESULT_CACHE, DEFAULT_TOP_K, PatchGenerator,
+    ResultCache, generate_batch, read_descriptions
+)
+from text2synth.dedupe import DEFAULT_IGNORE, dedupe
+from text2synth.features import FeatureIndex, compute_features
+from text2synth.metrics import METRICS, enable as enable_metrics, timed
+from text2synth.midi import LOOPBACK_BACKEND, MidiOutput, TokenBucket, open_backend
+from text2synth.patches import compute_stats, iter_prm_paths, load_library
+from text2synth.render import DEFAULT_NOTES, SAMPLE_RATE, read_wav, render_many, write_wav
+from text2synth.retrieval import SimilarityIndex
+from text2synth.state import FIELDS, JU06AState
+from text2synth.synths import JU_A6_A_LINK
 
 
 DEFAULT_MIDI_IN = DEFAULT_MIDI_OUT = "USB MIDI Interface"
@@ -22,32 +32,31 @@ DEFAULT_LLM_MODEL = "anthropic:claude-sonnet-4-5"
 
 
 def list_ports_cli(args):
+    backend = args.midi.backend
     print("MIDI Input Ports:")
-    for name in mido.get_input_names():
+    for name in backend.get_input_names():
         print("  ", name)
 
     print("\nMIDI Output Ports:")
-    for name in mido.get_output_names():
+    for name in backend.get_output_names():
         print("  ", name)
 
 
 def control_change_cli(args):
-    outport_name = args.midi_out
     number = args.cc_number
     value = args.cc_value
 
     LOGGER.debug("Sending CC %d with value %d", number, value)
 
-    with mido.open_output(outport_name) as outport:
-        LOGGER.debug("Ready to use port")
-
-        msg = mido.Message('control_change', control=number, value=value)
-        outport.send(msg)
+    msg = mido.Message('control_change', control=number, value=value)
+    args.midi.send(msg)
 
 
 def analyze_patch_ranges_cli(args):
     """
-    Recursively analyze all .PRM patch files to find min/max ranges for each parameter.
+    Recursively analyze all .PRM patch files to compute statistics for each
+    parameter: min/max, mean, percentiles, histograms and the values taken by
+    enum parameters.
 
     Parameters
     ----------
@@ -56,170 +65,415 @@ def analyze_patch_ranges_cli(args):
 
     Returns
     -------
-    Dict[str, Tuple[int, int]]
-        Dictionary mapping attribute names to (min, max) tuples for all numerical attributes
+    dict
+        Statistics, see text2synth.patches.compute_stats
     """
     path = args.path
+    # Keep stdout clean for JSON output
+    log = sys.stderr if args.json else sys.stdout
 
-    # Dictionary to track min/max for each attribute
-    ranges = {}
+    # Recursively find and load all .PRM files
+    errors = []
+    patches = load_library(path, args.jobs, errors=errors, use_cache=not args.no_cache)
 
-    # Recursively find all .PRM files
-    prn_files = list(Path(path).rglob("*.PRM"))
+    if len(patches) + len(errors) == 0:
+        print(f"Warning: No .PRM files found in {path}", file=log)
+        if not args.json:
+            return compute_stats(patches)
+    else:
+        print(f"Found {len(patches) + len(errors)} .PRM files", file=log)
 
-    if not prn_files:
-        print(f"Warning: No .PRM files found in {path}")
-        return ranges
+    for prn_file, e in errors:
+        print(f"Error processing {prn_file}: {e}", file=log)
 
-    print(f"Found {len(prn_files)} .PRM files")
+    stats = compute_stats(patches)
 
-    for prn_file in prn_files:
-        try:
-            patch = JU06AState.from_path(str(prn_file))
+    if args.json:
+        stats["errors"] = [{"path": str(p), "error": str(e)} for p, e in errors]
+        json.dump(stats, sys.stdout, indent=2)
+        print()
+    elif args.show_double_only:
+        for attr_name in sorted(stats["double_attributes"]):
+            print(attr_name)
+    else:
+        print("\nParameter Ranges:")
+        print("-" * 50)
+        for attr_name, field_stats in sorted(stats["fields"].items()):
+            percentiles = " ".join(
+                f"p{q}={v:3d}" for q, v in field_stats["percentiles"].items()
+            )
+            line = (
+                f"{attr_name:20s}: {field_stats['min']:3d} - {field_stats['max']:3d}"
+                f"  mean={field_stats['mean']:6.1f}  {percentiles}"
+            )
+            if "values" in field_stats:
+                line += "  values: " + ", ".join(
+                    f"{k} ({v})" for k, v in field_stats["values"].items()
+                )
+            print(line)
+
+    return stats
+
+
+def parse_field_weight(text):
+    """ Parse a field weight given as field=weight, e.g. cutoff=2."""
+    name, sep, value = text.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"Invalid weight {text!r}, expected FIELD=WEIGHT")
+    if name not in FIELDS:
+        raise argparse.ArgumentTypeError(f"Unknown field {name!r}")
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid weight {text!r}") from None
+
+
+def find_similar_cli(args):
+    """ Print the patches of the library closest to the given patch file."""
+    state = JU06AState.from_path(args.path)
+    # Keep stdout clean for JSON output
+    log = sys.stderr if args.json else sys.stdout
+
+    errors = []
+    patches = load_library(args.patches_path, args.jobs, errors=errors, use_cache=not args.no_cache)
+    print(f"Loaded {len(patches)} patches", file=log)
+
+    index = SimilarityIndex(patches, dict(args.weight))
+    indices, distances = index.search(state, args.k)
+
+    results = [
+        {"name": patches.names[i], "path": str(patches.paths[i]), "distance": float(d)}
+        for i, d in zip(indices, distances)
+    ]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for result in results:
+            print(f"{result['distance']:6.3f}  {result['name'] or '':16s}  {result['path']}")
 
-            for attr_name in JU06AState.model_fields:
-                value = getattr(patch, attr_name)
+    return results
 
-                # Skip non-integer attributes (like patch_name)
-                if not isinstance(value, int):
-                    continue
 
-                # Update min/max for this attribute
-                if attr_name not in ranges:
-                    ranges[attr_name] = (value, value)
-                else:
-                    current_min, current_max = ranges[attr_name]
-                    ranges[attr_name] = (min(current_min, value), max(current_max, value))
+def find_sound_cli(args):
+    """ Print the patches of the library sounding closest to a description or
+    a recording.
+    """
+    # Keep stdout clean for JSON output
+    log = sys.stderr if args.json else sys.stdout
+
+    errors = []
+    patches = load_library(args.patches_path, args.jobs, errors=errors, use_cache=not args.no_cache)
+    print(f"Loaded {len(patches)} patches", file=log)
+
+    if args.no_cache:
+        index = FeatureIndex(patches, compute_features(patches.values, args.jobs))
+    else:
+        index = FeatureIndex.from_library(args.patches_path, patches, args.jobs)
+
+    if args.wav:
+        audio, sample_rate = read_wav(args.wav)
+        indices, values = index.search_audio(audio, sample_rate, args.k)
+        key = "distance"
+    else:
+        indices, values = index.search_text(args.text, args.k)
+        key = "score"
+
+    results = [
+        {"name": patches.names[i], "path": str(patches.paths[i]), key: float(value)}
+        for i, value in zip(indices, values)
+    ]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for result in results:
+            print(f"{result[key]:6.3f}  {result['name'] or '':16s}  {result['path']}")
 
-        except Exception as e:
-            print(f"Error processing {prn_file}: {e}")
-            continue
+    return results
 
-    print("\nParameter Ranges:")
-    print("-" * 50)
 
-    if args.show_double_only:
-        for attr_name, (min_val, max_val) in sorted(ranges.items()):
-            if max_val > 128 and max_val <= 255:
-                print(attr_name)
+def dedupe_cli(args):
+    """ Report the duplicate patches of a library, or write a deduplicated
+    copy of it.
+    """
+    root = Path(args.path)
+    # Keep stdout clean for JSON output
+    log = sys.stderr if args.json else sys.stdout
+
+    errors = []
+    patches = load_library(root, args.jobs, errors=errors, use_cache=not args.no_cache)
+    for path, e in errors:
+        print(f"Error processing {path}: {e}", file=log)
+
+    ignore = () if args.no_ignore else tuple(args.ignore or DEFAULT_IGNORE)
+    keep, groups = dedupe(patches, args.tolerance, ignore)
+
+    if args.json:
+        json.dump({
+            "count": len(patches),
+            "kept": len(keep),
+            "groups": [[str(patches.paths[i]) for i in members] for members in groups],
+        }, sys.stdout, indent=2)
+        print()
     else:
-        for attr_name, (min_val, max_val) in sorted(ranges.items()):
-            print(f"{attr_name:20s}: {min_val:3d} - {max_val:3d}")
+        for members in groups:
+            print(f"{patches.paths[members[0]]} ({patches.names[members[0]]})")
+            for i in members[1:]:
+                print(f"    {patches.paths[i]} ({patches.names[i]})")
+        print(f"{len(patches)} patches, {len(keep)} unique, {len(groups)} groups of duplicates",
+              file=log)
+
+    if args.output is not None:
+        output = Path(args.output)
+        for i in keep:
+            target = output / Path(patches.paths[i]).relative_to(root)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(patches.paths[i], target)
+        print(f"Wrote {len(keep)} patches to {output}", file=log)
+
+    return keep, groups
+
+
+def parse_note(text):
+    """ Parse a note given as note[:start[:duration]], e.g. 60:0.5:1."""
+    parts = text.split(":")
+    if not 1 <= len(parts) <= 3:
+        raise argparse.ArgumentTypeError(f"Invalid note {text!r}")
+    try:
+        note = int(parts[0])
+        start = float(parts[1]) if len(parts) > 1 else 0.0
+        duration = float(parts[2]) if len(parts) > 2 else 1.0
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid note {text!r}") from None
+    return note, start, duration
+
+
+def render_cli(args):
+    """ Render PRM files into wav files, w/o the synth.
+
+    The patches found in a directory are rendered into the same tree under
+    the output directory, so that patches of the same name do not collide.
+    """
+    outputs = {}
+    output_dir = Path(args.output_dir)
+    for path in map(Path, args.paths):
+        if path.is_dir():
+            found = [(p, p.relative_to(path)) for p in sorted(iter_prm_paths(path))]
+        else:
+            found = [(path, Path(path.name))]
+        for prm_path, rel_path in found:
+            output = output_dir / rel_path.with_suffix(".wav")
+            if output in outputs:
+                sys.exit(f"Error: {prm_path} and {outputs[output]} would both be rendered to {output}")
+            outputs[output] = prm_path
+
+    errors = []
+    states = JU06AState.load_many(outputs.values(), errors=errors)
+    for path, e in errors:
+        print(f"Error processing {path}: {e}", file=sys.stderr)
+    invalid = {path for path, _ in errors}
+    outputs = {output: path for output, path in outputs.items() if path not in invalid}
+
+    notes = args.notes or DEFAULT_NOTES
+    for (output, path), audio in zip(outputs.items(), render_many(states, notes, jobs=args.jobs)):
+        output.parent.mkdir(parents=True, exist_ok=True)
+        write_wav(output, audio, SAMPLE_RATE)
+        LOGGER.info("Rendered %s to %s", path, output)
 
 
 def program_change_cli(args):
-    outport_name = args.midi_out
     program = args.program
     LOGGER.info("Changing program to %d", program)
 
     assert program >= 1
 
-    with mido.open_output(outport_name) as outport:
-        LOGGER.debug("Ready to use port")
+    msg = mido.Message('program_change', program=program-1)
+    args.midi.send(msg)
 
-        msg = mido.Message('program_change', program=program-1)
-        outport.send(msg)
 
+def apply_state_to_synth(state, midi, previous=None):
+    """ Send the given state to the synth.
 
-def apply_state_to_synth(state, outport_name):
-    with mido.open_output(outport_name) as outport:
-        LOGGER.debug("Ready to use MIDI port %s", outport_name)
-        for msg in state.to_cc_messages():
-            outport.send(msg)
-            # Sleeping a bit to avoid flooding the MIDI connection
-            time.sleep(0.001)
+    If previous is given, it is assumed to be the state of the synth, and only
+    the CC that changed are sent.
+    """
+    messages = JU06AState.diff_cc_messages(previous, state)
+    LOGGER.debug("Sending %d CC messages to MIDI port %s", len(messages), midi.name)
+    for msg in messages:
+        midi.send(msg)
 
 
 def send_patch_cli(args):
-    outport_name = args.midi_out
     path = args.path
     LOGGER.info("Applying PRM file %s", path)
 
     state = JU06AState.from_path(path)
-    apply_state_to_synth(state, outport_name)
+    apply_state_to_synth(state, args.midi)
 
 
-def load_patches(patch_directory: str, max_examples=None) -> str:
+def export_midi_cli(args):
+    path = args.path
+    output = args.output
+    LOGGER.info("Exporting PRM file %s to %s", path, output)
+
+    state = JU06AState.from_path(path)
+    state.to_midi_path(output, args.channel - 1)
+
+
+def load_patches(patch_directory: str, max_examples=None, jobs=None, use_cache=True):
     """
-    Load patches in their original text format.
+    Load the patches to use as examples.
 
     Parameters
     ----------
     patch_directory : str
         Directory containing .PRM patch files
     max_examples : int
-        Maximum number of examples to include
+        Maximum number of patches to consider
+    jobs : int
+        Number of processes used to load the patches
+    use_cache : bool
+        Whether to use the on-disk patch cache
 
     Returns
     -------
-    str
-        Concatenated original patch files
+    PatchArray
+        The patches
     """
 
-    patches = []
-    paths = list(Path(patch_directory).rglob("*.PRM"))[:max_examples]
-    print(f"Loading {len(paths)} patches")
+    # Invalid patches are skipped
+    patches = load_library(patch_directory, jobs, errors=[], use_cache=use_cache)
+    if max_examples is not None:
+        patches = patches.select(range(min(max_examples, len(patches))))
+    print(f"Loaded {len(patches)} patches")
 
-    for path in paths:
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                patches.append(f"=== {path.name} ===\n{content}\n")
+    return patches
 
-        except Exception:
-            continue
 
-    return "\n".join(patches)
+def create_generator(args):
+    if args.patches_path is not None:
+        patches = load_patches(args.patches_path, args.max_patches, args.jobs, not args.no_cache)
+    else:
+        patches = None
+
+    result_cache = ResultCache(None if args.no_result_cache else DEFAULT_RESULT_CACHE)
+    generator = PatchGenerator(args.llm_model, patches, args.top_k, result_cache=result_cache)
+    LOGGER.debug("Agent %s is created", generator.agent)
+    return generator
 
 
-async def text2patch_cmd(agent, description, outport_name, output_path="test-patch.prm", patch_name="TEST PATCH"):
-    result = await agent.run(description)
+async def text2patch_cmd(generator, description, midi, output_path="test-patch.prm",
+                         patch_name="TEST PATCH", previous=None, stream=False):
+    with timed("text2patch"):
+        if stream:
+            state = await stream_state_to_synth(generator, description, midi, previous)
+        else:
+            state = await generator.generate(description)
+            LOGGER.debug("Applying to synth")
+            apply_state_to_synth(state, midi, previous)
 
-    state = result.output
     state.to_path(output_path, patch_name)
+    return state
 
-    LOGGER.debug("Applying to synth")
-    apply_state_to_synth(state, "USB MIDI Interface")
 
+async def stream_state_to_synth(generator, description, midi, previous=None):
+    """ Generate a patch, sending each field to the synth as soon as it is
+    generated.
 
-def text2patch_cli(args):
-    outport_name = args.midi_out
-    patches_path = args.patches_path
-    max_patches = args.max_patches
-    description = args.description
-    llm_model = args.llm_model
-
-    if patches_path is not None:
-        patches = load_patches(patches_path, max_patches)
-    else:
-        patches = ""
+    If previous is given, it is assumed to be the state of the synth, and only
+    the CC that changed are sent.
+    """
+    sent = {} if previous is None else dict(previous.__dict__)
 
-    # Create agent
-    agent = Agent(
-        llm_model,
-        output_type=JU06AState,
-        system_prompt=textwrap.dedent(f"""You are an expert sound designer for the Roland JU-06A synthesizer.
+    async def send_fields(state, names):
+        values = state.__dict__
+        names = [name for name in names if sent.get(name, None) != values[name]]
+        for msg in state.field_cc_messages(names):
+            await midi.send_async(msg)
+        sent.update((name, values[name]) for name in names)
 
-        Create synthesizer patches based on user descriptions. Consider:
-        - Filter cutoff and resonance for brightness and character
-        - Envelope (ADSR) for shaping the sound over time
-        - LFO for modulation effects
-        - Oscillator settings for tone color
-        - Effects like chorus and delay for depth
+    state = await generator.generate_stream(description, send_fields)
 
-        Here are example patches from real JU-06A presets to learn from:
+    # Fields which were invalid or changed in the final, validated, state
+    await send_fields(state, JU06AState.model_fields)
+    return state
 
-        {patches}
 
-        Generate creative, musically useful patches that match the user's description.""",
-        )
-    )
-    LOGGER.debug("Agent %s is created", agent)
+def text2patch_cli(args):
+    generator = create_generator(args)
 
     asyncio.run(
-        text2patch_cmd(agent, description, outport_name)
+        text2patch_cmd(generator, args.description, args.midi, stream=args.stream)
+    )
+
+
+def text2patch_repl_cli(args):
+    """
+    Generate patches from descriptions read from stdin, one per line, until
+    an empty line or EOF.
+
+    The agent, and its system prompt, are only built once, and identical
+    requests are returned from the result cache.
+    """
+    generator = create_generator(args)
+
+    async def repl():
+        previous = None
+        while True:
+            try:
+                description = await asyncio.to_thread(input, "> ")
+            except EOFError:
+                break
+            description = description.strip()
+            if not description:
+                break
+            try:
+                previous = await text2patch_cmd(generator, description, args.midi,
+                                                previous=previous, stream=args.stream)
+            except Exception as e:
+                LOGGER.error("Could not create patch: %s", e)
+
+    asyncio.run(repl())
+
+
+def text2patch_batch_cli(args):
+    with open(args.descriptions, encoding="utf-8") as fp:
+        descriptions = read_descriptions(fp)
+    generator = create_generator(args)
+
+    summary = asyncio.run(
+        generate_batch(generator, descriptions, args.output_dir, args.concurrency, args.attempts)
     )
 
+    print(f"Created {len(summary['paths'])}/{len(descriptions)} patches in {args.output_dir} "
+          f"in {summary['elapsed']:.1f}s ({summary['throughput']:.2f} patches/s)")
+    for description, e in summary["failed"]:
+        print(f"Failed: {description!r}: {e}")
+    if summary["failed"]:
+        sys.exit(1)
+
+
+def _add_text2patch_arguments(parser):
+    parser.add_argument("--max-patches", type=int, help="Max patches to load")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K,
+                        help=f"Number of patches most relevant to the description to use as examples (default: {DEFAULT_TOP_K})")
+    parser.add_argument("--patches-path", type=str, help="Where to look for patches")
+    parser.add_argument("--jobs", type=int,
+                        help="Number of processes used to load patches (default: number of CPUs)")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="If given, do not use nor update the on-disk patch cache")
+    parser.add_argument("--no-result-cache", action="store_true", default=False,
+                        help=f"If given, do not use nor update the generated patches cache in {DEFAULT_RESULT_CACHE}")
+    parser.add_argument("--llm-model", type=str, default=DEFAULT_LLM_MODEL,
+                        help="The LLM to use. Use local:<transformers model> for a local model, or "
+                             "local:hash for a deterministic stub (default: %(default)s)")
+
+
+def _add_stream_argument(parser):
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="If given, send each parameter to the synth as soon as it is generated")
+
 
 def main():
     logging.basicConfig(level=logging.INFO,
@@ -230,6 +484,12 @@ def main():
                         help="MIDI input device")
     parser.add_argument("--midi-out", type=str, default=DEFAULT_MIDI_OUT,
                         help="MIDI output device")
+    parser.add_argument("--midi-backend", type=str,
+                        help=f"mido backend, e.g. mido.backends.rtmidi, or {LOOPBACK_BACKEND} for an "
+                             "in-process virtual device (default: mido's default)")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="If given, print the timings of the hot paths (parsing, validation, LLM, "
+                             "MIDI) on exit")
 
     subparsers = parser.add_subparsers(dest="command", required=True)
 
@@ -245,6 +505,14 @@ def main():
     send_patch_parser.add_argument("path", type=str, help="Path to the PRM file")
     send_patch_parser.set_defaults(func=send_patch_cli)
 
+    export_midi_parser = subparsers.add_parser("export-midi",
+                                               help="Save the CC messages for the given patch file into a .mid file, or a raw .bin stream")
+    export_midi_parser.add_argument("path", type=str, help="Path to the PRM file")
+    export_midi_parser.add_argument("output", type=str, help="Output .mid or .bin file")
+    export_midi_parser.add_argument("--channel", type=int, default=1,
+                                    help="MIDI channel (default: 1)")
+    export_midi_parser.set_defaults(func=export_midi_cli)
+
     cc_parser = subparsers.add_parser("control-change", aliases=["cc"],
                                       help="Send a MIDI control change message")
     cc_parser.add_argument("cc_number", type=int, help="Control change number")
@@ -259,8 +527,80 @@ def main():
     stats_parser.add_argument("--show-double-only", action="store_true",
                               default=False,
                               help="If given, only print CC that go beyond 127")
+    stats_parser.add_argument("--json", action="store_true", default=False,
+                              help="If given, print the statistics as JSON")
+    stats_parser.add_argument("--jobs", type=int,
+                              help="Number of processes used to load patches (default: number of CPUs)")
+    stats_parser.add_argument("--no-cache", action="store_true", default=False,
+                              help="If given, do not use nor update the on-disk patch cache")
     stats_parser.set_defaults(func=analyze_patch_ranges_cli)
 
+    find_similar_parser = subparsers.add_parser("find-similar",
+                                                help="Find the patches of a library closest to the given patch")
+    find_similar_parser.add_argument("path", type=str, help="Path to the PRM file")
+    find_similar_parser.add_argument("patches_path", type=str, help="Directory of the patch library")
+    find_similar_parser.add_argument("-k", type=int, default=10,
+                                     help="Number of patches to return (default: 10)")
+    find_similar_parser.add_argument("--weight", type=parse_field_weight, action="append", default=[],
+                                     metavar="FIELD=WEIGHT",
+                                     help="Weight of a field in the distance, may be repeated (default: 1)")
+    find_similar_parser.add_argument("--json", action="store_true", default=False,
+                                     help="If given, print the results as JSON")
+    find_similar_parser.add_argument("--jobs", type=int,
+                                     help="Number of processes used to load patches (default: number of CPUs)")
+    find_similar_parser.add_argument("--no-cache", action="store_true", default=False,
+                                     help="If given, do not use nor update the on-disk patch cache")
+    find_similar_parser.set_defaults(func=find_similar_cli)
+
+    find_sound_parser = subparsers.add_parser("find-sound",
+                                              help="Find the patches of a library sounding like a description or a wav file")
+    find_sound_parser.add_argument("patches_path", type=str, help="Directory of the patch library")
+    query_group = find_sound_parser.add_mutually_exclusive_group(required=True)
+    query_group.add_argument("--text", type=str, help="Description of the sound, e.g. 'bright plucky bass'")
+    query_group.add_argument("--wav", type=str, help="Recording of the sound")
+    find_sound_parser.add_argument("-k", type=int, default=10,
+                                   help="Number of patches to return (default: 10)")
+    find_sound_parser.add_argument("--json", action="store_true", default=False,
+                                   help="If given, print the results as JSON")
+    find_sound_parser.add_argument("--jobs", type=int,
+                                   help="Number of processes used to load and render patches (default: number of CPUs)")
+    find_sound_parser.add_argument("--no-cache", action="store_true", default=False,
+                                   help="If given, do not use nor update the on-disk patch and feature caches")
+    find_sound_parser.set_defaults(func=find_sound_cli)
+
+    dedupe_parser = subparsers.add_parser("dedupe",
+                                          help="Find duplicate patches, and optionally write a deduplicated library")
+    dedupe_parser.add_argument("path", type=str, help="Directory of the patch library")
+    dedupe_parser.add_argument("--output", type=str,
+                               help="If given, copy the first patch of each group of duplicates into this directory")
+    dedupe_parser.add_argument("--tolerance", type=int, default=0,
+                               help="Max difference of each parameter between near-duplicates, found w/ a "
+                                    "~1e-4 probability of missing a pair (default: 0, exact duplicates only)")
+    dedupe_parser.add_argument("--ignore", action="append", metavar="FIELD",
+                               help=f"Field to ignore, may be repeated (default: {', '.join(DEFAULT_IGNORE)})")
+    dedupe_parser.add_argument("--no-ignore", action="store_true", default=False,
+                               help="If given, compare every field")
+    dedupe_parser.add_argument("--json", action="store_true", default=False,
+                               help="If given, print the report as JSON")
+    dedupe_parser.add_argument("--jobs", type=int,
+                               help="Number of processes used to load patches (default: number of CPUs)")
+    dedupe_parser.add_argument("--no-cache", action="store_true", default=False,
+                               help="If given, do not use nor update the on-disk patch cache")
+    dedupe_parser.set_defaults(func=dedupe_cli)
+
+    render_parser = subparsers.add_parser("render",
+                                          help="Render patches into wav files w/ a software approximation of the synth")
+    render_parser.add_argument("paths", type=str, nargs="+",
+                               help="PRM files, or directories to recursively walk")
+    render_parser.add_argument("--output-dir", type=str, default=".",
+                               help="Directory where the wav files are written (default: current directory)")
+    render_parser.add_argument("--notes", type=parse_note, nargs="+", metavar="NOTE[:START[:DURATION]]",
+                               help="Notes to play, as MIDI note numbers w/ their start and duration in seconds "
+                                    "(default: a C major chord)")
+    render_parser.add_argument("--jobs", type=int,
+                               help="Number of processes used to render (default: number of CPUs)")
+    render_parser.set_defaults(func=render_cli)
+
     list_ports_parser = subparsers.add_parser("list-ports",
                                       help="list ports")
     list_ports_parser.set_defaults(func=list_ports_cli)
@@ -268,14 +608,43 @@ def main():
     text2patch_parser = subparsers.add_parser("text2patch", aliases=["t2p"],
                                       help="Create a new patch from description and apply it to the synth")
     text2patch_parser.add_argument("description", type=str, help="Patch description")
-    text2patch_parser.add_argument("--max-patches", type=int, help="Max patches to load")
-    text2patch_parser.add_argument("--patches-path", type=str, help="Where to look for patches")
-    text2patch_parser.add_argument("--llm-model", type=str, help="The LLM to use", default=DEFAULT_LLM_MODEL)
+    _add_text2patch_arguments(text2patch_parser)
+    _add_stream_argument(text2patch_parser)
     text2patch_parser.set_defaults(func=text2patch_cli)
 
+    text2patch_repl_parser = subparsers.add_parser("text2patch-repl", aliases=["t2p-repl"],
+                                                   help="Create patches from descriptions read from stdin, reusing the same agent")
+    _add_text2patch_arguments(text2patch_repl_parser)
+    _add_stream_argument(text2patch_repl_parser)
+    text2patch_repl_parser.set_defaults(func=text2patch_repl_cli)
+
+    text2patch_batch_parser = subparsers.add_parser("text2patch-batch", aliases=["t2p-batch"],
+                                                    help="Create one patch per description in a file, concurrently")
+    text2patch_batch_parser.add_argument("descriptions", type=str,
+                                         help="File w/ one description per line")
+    text2patch_batch_parser.add_argument("output_dir", type=str,
+                                         help="Directory where the PRM files are written")
+    text2patch_batch_parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                                         help=f"Max number of concurrent LLM requests (default: {DEFAULT_CONCURRENCY})")
+    text2patch_batch_parser.add_argument("--attempts", type=int, default=DEFAULT_ATTEMPTS,
+                                         help=f"Number of attempts per description (default: {DEFAULT_ATTEMPTS})")
+    _add_text2patch_arguments(text2patch_batch_parser)
+    text2patch_batch_parser.set_defaults(func=text2patch_batch_cli)
+
     args = parser.parse_args()
+    if args.profile:
+        enable_metrics()
     if hasattr(args, "func"):
-        args.func(args)
+        # Port is only opened on first use, and shared by every command
+        limiter = TokenBucket(JU_A6_A_LINK["bytes_per_second"], JU_A6_A_LINK["burst_bytes"])
+        backend = open_backend(args.midi_backend)
+        try:
+            with MidiOutput(args.midi_out, backend, limiter=limiter) as midi:
+                args.midi = midi
+                args.func(args)
+        finally:
+            if args.profile:
+                print(METRICS.report(), file=sys.stderr)
     else:
         print("No operation implemented for this command yet.")
         sys.exit(-1)
@@ -0,0 +1,427 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import textwrap
+import time
+
+from pathlib import Path
+
+from pydantic import ValidationError
+from pydantic_ai import Agent
+from pydantic_ai.messages import ToolCallPart
+from pydantic_ai.settings import ModelSettings
+from pydantic_core import from_json
+
+from .local import LOCAL_PREFIX, local_model
+from .metrics import observe, timed
+from .patches import PatchArray
+from .retrieval import PatchIndex
+from .state import JU06AState
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of example patches selected for each description
+DEFAULT_TOP_K = 20
+# Number of example patches in the static, cacheable, system prompt
+DEFAULT_PREFIX_K = 50
+# Number of concurrent LLM requests in batch mode
+DEFAULT_CONCURRENCY = 8
+# Number of attempts per description in batch mode
+DEFAULT_ATTEMPTS = 3
+
+DEFAULT_RESULT_CACHE = (
+    Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")).expanduser() / "text2synth" / "results.jsonl"
+)
+
+INSTRUCTIONS = textwrap.dedent("""\
+    You are an expert sound designer for the Roland JU-06A synthesizer.
+
+    Create synthesizer patches based on user descriptions. Consider:
+    - Filter cutoff and resonance for brightness and character
+    - Envelope (ADSR) for shaping the sound over time
+    - LFO for modulation effects
+    - Oscillator settings for tone color
+    - Effects like chorus and delay for depth
+
+    Generate creative, musically useful patches that match the user's description.""")
+
+
+def format_examples(patches: PatchArray, title):
+    """ Format the given patches for a prompt, in the compact CSV format."""
+    if len(patches) == 0:
+        return ""
+    return textwrap.dedent(f"""\
+        {title}, one patch per line in CSV format, w/ enums as their int value:
+
+        """) + patches.to_compact()
+
+
+def build_system_prompt(examples: PatchArray) -> str:
+    examples = format_examples(
+        examples, "Here are example patches from real JU-06A presets to learn from"
+    )
+    return INSTRUCTIONS + ("\n\n" + examples if examples else "")
+
+
+def complete_fields(args, final=False):
+    """
+    Return the fields of streamed, possibly partial, tool call arguments
+    whose value is complete.
+
+    Parameters
+    ----------
+    args : str or dict
+        The JSON arguments received so far
+    final : bool
+        If True, the arguments are complete
+
+    Returns
+    -------
+    dict
+        Field -> value, in the order they were received. The last field is
+        left out until a later one starts, or the object is closed, as e.g.
+        "cutoff": 12 may still become "cutoff": 127.
+    """
+    if isinstance(args, dict):
+        return args
+    if not args:
+        return {}
+
+    try:
+        values = from_json(args, allow_partial=True)
+    except ValueError:
+        return {}
+    if not isinstance(values, dict):
+        return {}
+
+    if values and not final and not args.rstrip().endswith("}"):
+        # The last parsed field is complete iff a comma follows its value
+        last = next(reversed(values))
+        if "," not in args[args.rfind(json.dumps(last)):]:
+            values.popitem()
+    return values
+
+
+def model_name(model) -> str:
+    if isinstance(model, str):
+        return model
+    return f"{model.system}:{model.model_name}"
+
+
+def create_agent(model, system_prompt, cache_prompt=True) -> Agent:
+    """
+    Create the agent generating JU06AState from descriptions.
+
+    Parameters
+    ----------
+    model : str or pydantic_ai.models.Model
+        The LLM to use. Names starting w/ "local:" are local models w/
+        constrained decoding, see text2synth.local.
+    system_prompt : str
+        The system prompt
+    cache_prompt : bool
+        If True, mark the system prompt as cacheable by the provider, so that
+        requests sharing it are faster and cheaper. Only Anthropic models are
+        supported, other models ignore it.
+    """
+    if isinstance(model, str) and model.startswith(LOCAL_PREFIX):
+        model = local_model(model[len(LOCAL_PREFIX):])
+
+    model_settings = None
+    if cache_prompt and model_name(model).startswith("anthropic:"):
+        # pydantic-ai does not expose Anthropic's cache_control: send the
+        # system prompt ourselves as a cacheable block
+        model_settings = ModelSettings(extra_body={
+            "system": [
+                {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}},
+            ],
+        })
+
+    return Agent(
+        model,
+        output_type=JU06AState,
+        system_prompt=system_prompt,
+        model_settings=model_settings,
+    )
+
+
+class ResultCache:
+    """
+    Cache of generated patches, keyed on (model, description, prompt hash).
+
+    Results are persisted in a JSON lines file, one [key, compact row] per
+    line. Each result is appended w/ a single write, so that storing a result
+    does not depend on the cache size, and processes sharing the file, e.g.
+    concurrent REPLs, do not overwrite each other's results.
+
+    Parameters
+    ----------
+    path : str or Path, optional
+        JSON lines file where the results are persisted. If None, results are
+        only kept in memory.
+    """
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self._results = {}
+
+        if self.path is not None and self.path.exists():
+            try:
+                with open(self.path, encoding="utf-8") as fp:
+                    lines = fp.readlines()
+            except OSError:
+                LOGGER.warning("Ignoring unreadable result cache %s", self.path, exc_info=True)
+                lines = []
+            invalid = 0
+            for line in lines:
+                try:
+                    key, row = json.loads(line)
+                except (ValueError, TypeError):
+                    # e.g. a line truncated by a crash
+                    invalid += 1
+                    continue
+                self._results[key] = row
+            if invalid:
+                LOGGER.warning("Ignoring %d invalid lines in result cache %s", invalid, self.path)
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def key(model, description, prompt):
+        data = json.dumps([model, description, hashlib.sha256(prompt.encode()).hexdigest()])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        row = self._results.get(key)
+        return None if row is None else JU06AState.from_compact_row(row)
+
+    def put(self, key, state):
+        row = state.to_compact_row()
+        self._results[key] = row
+        if self.path is None:
+            return
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as fp:
+                fp.write(json.dumps([key, row]) + "\n")
+        except OSError:
+            LOGGER.warning("Could not write result cache %s", self.path, exc_info=True)
+
+
+class PatchGenerator:
+    """
+    Generate patches from descriptions.
+
+    The agent and its system prompt are built once, and reused for every
+    description. The system prompt is static: instructions plus a broad sample
+    of the library, so that the provider can cache it. The examples most
+    relevant to each description are sent along w/ the description.
+
+    Parameters
+    ----------
+    model : str or pydantic_ai.models.Model
+        The LLM to use
+    patches : PatchArray, optional
+        The library to take the examples from
+    top_k : int
+        Number of examples selected for each description
+    prefix_k : int
+        Number of examples in the system prompt
+    result_cache : ResultCache, optional
+        Where to look for, and store, the generated patches. Identical requests
+        are returned from the cache w/o calling the LLM.
+    """
+    def __init__(self, model, patches=None, top_k=DEFAULT_TOP_K, prefix_k=DEFAULT_PREFIX_K,
+                 result_cache=None):
+        self.model_name = model_name(model)
+        self.patches = patches if patches is not None else PatchArray([])
+        self.top_k = top_k
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+
+        self.index = PatchIndex(self.patches)
+        # An empty query gets patches spread over the whole library
+        self.system_prompt = build_system_prompt(
+            self.patches.select(self.index.search("", prefix_k))
+        )
+        self.agent = create_agent(model, self.system_prompt)
+
+    def build_prompt(self, description):
+        """ Build the user prompt for the given description."""
+        with timed("llm.prompt"):
+            examples = format_examples(
+                self.patches.select(self.index.search(description, self.top_k)),
+                "Example patches relevant to the description",
+            )
+        return (examples + "\n\n" if examples else "") + f"Description: {description}"
+
+    async def generate(self, description) -> JU06AState:
+        prompt = self.build_prompt(description)
+        key = ResultCache.key(self.model_name, description, self.system_prompt + prompt)
+
+        state = self.result_cache.get(key)
+        if state is not None:
+            LOGGER.debug("Using cached result for %r", description)
+            return state
+
+        with timed("llm.run"):
+            result = await self.agent.run(prompt)
+        state = result.output
+        self.result_cache.put(key, state)
+        return state
+
+    async def generate_stream(self, description, on_fields) -> JU06AState:
+        """
+        Generate a patch, streaming its fields as soon as they are generated.
+
+        Parameters
+        ----------
+        description : str
+            The patch description
+        on_fields : coroutine function
+            Called as on_fields(state, names) every time new fields are
+            complete and valid. state is a partial JU06AState, holding every
+            field received so far, and names the set of new fields. Invalid
+            fields are left out, the final state is validated as a whole.
+
+        Returns
+        -------
+        JU06AState
+            The final state
+        """
+        prompt = self.build_prompt(description)
+        key = ResultCache.key(self.model_name, description, self.system_prompt + prompt)
+
+        state = self.result_cache.get(key)
+        if state is not None:
+            LOGGER.debug("Using cached result for %r", description)
+            await on_fields(state, set(JU06AState.model_fields))
+            return state
+
+        partial = JU06AState.model_construct()
+        seen = set()
+        start = time.perf_counter()
+        async with self.agent.run_stream(prompt) as result:
+            async for response, last in result.stream_responses(debounce_by=None):
+                parts = [part for part in response.parts if isinstance(part, ToolCallPart)]
+                if not parts:
+                    continue
+
+                names = set()
+                for name, value in complete_fields(parts[0].args, final=last).items():
+                    if name in seen or name not in JU06AState.model_fields:
+                        continue
+                    seen.add(name)
+                    try:
+                        setattr(partial, name, value)
+                    except ValidationError as e:
+                        LOGGER.debug("Skipping invalid streamed field %s: %s", name, e)
+                        continue
+                    names.add(name)
+                if names:
+                    if len(seen) == len(names):
+                        observe("llm.first_field", time.perf_counter() - start)
+                    await on_fields(partial, names)
+
+            state = await result.get_output()
+        observe("llm.stream", time.perf_counter() - start)
+
+        self.result_cache.put(key, state)
+        return state
+
+
+def read_descriptions(fp):
+    """ Read descriptions, one per line. Blank lines and # comments are skipped."""
+    descriptions = []
+    for line in fp:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            descriptions.append(line)
+    return descriptions
+
+
+def patch_name(description, max_length=16):
+    """ Derive a patch name from a description."""
+    words = re.findall(r"[A-Za-z0-9]+", description)
+    return " ".join(words).upper()[:max_length].strip() or "NEW PATCH"
+
+
+def patch_filename(index, description):
+    slug = "-".join(re.findall(r"[a-z0-9]+", description.lower()))[:40].strip("-")
+    return f"{index:03d}-{slug or 'patch'}.prm"
+
+
+async def generate_batch(generator, descriptions, output_dir, concurrency=DEFAULT_CONCURRENCY,
+                         attempts=DEFAULT_ATTEMPTS, retry_delay=1.0):
+    """
+    Generate a patch for each description, concurrently, and write each one
+    to its own PRM file.
+
+    Parameters
+    ----------
+    generator : PatchGenerator
+        The generator to use
+    descriptions : list of str
+        The patch descriptions
+    output_dir : str or Path
+        Directory where the PRM files are written, created if needed
+    concurrency : int
+        Maximum number of concurrent LLM requests
+    attempts : int
+        Number of attempts per description before giving up
+    retry_delay : float
+        Delay in seconds before the first retry, doubled after each failure
+
+    Returns
+    -------
+    dict
+        Summary: the written "paths", the descriptions which "failed" w/ their
+        error, the "elapsed" time in seconds and the "throughput" in patches
+        per second.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    total = len(descriptions)
+    done = 0
+    paths = {}
+    failed = []
+
+    async def generate_one(i, description):
+        nonlocal done
+        path = output_dir / patch_filename(i, description)
+        for attempt in range(attempts):
+            try:
+                async with semaphore:
+                    state = await generator.generate(description)
+                break
+            except Exception as e:
+                if attempt + 1 == attempts:
+                    LOGGER.error("Could not create patch for %r: %s", description, e)
+                    failed.append((description, e))
+                    done += 1
+                    return
+                LOGGER.warning("Attempt %d for %r failed (%s), retrying", attempt + 1,
+                               description, e)
+                await asyncio.sleep(retry_delay * 2 ** attempt)
+
+        state.to_path(path, patch_name(description))
+        paths[i] = path
+        done += 1
+        LOGGER.info("[%d/%d] %s", done, total, path)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(generate_one(i, description) for i, description in enumerate(descriptions)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "paths": [paths[i] for i in sorted(paths)],
+        "failed": failed,
+        "elapsed": elapsed,
+        "throughput": len(paths) / elapsed if elapsed > 0 else 0.0,
+    }
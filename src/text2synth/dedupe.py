@@ -0,0 +1,209 @@
+"""
+Deduplication of patch libraries.
+
+Patches are compared on their parameters only: the same patch saved under
+different names is a duplicate. Near-duplicates are patches whose numeric
+parameters all differ by at most a given tolerance, w/ the same enum values.
+"""
+import logging
+
+import numpy as np
+
+from .patches import COLUMNS, FIELDS, PatchArray
+from .state import FIELD_ENUMS
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Fields ignored by default when comparing patches: the output level does not
+# change the sound
+DEFAULT_IGNORE = ("amp_level",)
+# Number of shifted grids used to find near-duplicate candidates
+DEFAULT_GRIDS = 10
+# Grid cell size, in tolerances. Larger cells split fewer near-duplicates, but
+# give more candidates to check
+_CELL_FACTOR = 16
+# Number of numeric fields each grid is made of. The more fields, the more
+# likely near-duplicates are split by one of them
+_GRID_FIELDS = 8
+# Pairs of rows further apart than this in a bucket are generated one row at a
+# time, to bound memory
+_MAX_BLOCK = 64
+
+
+def _connected_components(n, a, b):
+    """
+    Return the connected components of the graph of n nodes w/ edges (a, b),
+    as the smallest node index of each node's component.
+    """
+    labels = np.arange(n)
+    while True:
+        # Hook the root of each edge end to the smallest of both roots, then
+        # shortcut every node to its root
+        low = np.minimum(labels[a], labels[b])
+        np.minimum.at(labels, labels[a], low)
+        np.minimum.at(labels, labels[b], low)
+        while True:
+            roots = labels[labels]
+            if np.array_equal(roots, labels):
+                break
+            labels = roots
+        if np.array_equal(labels[a], labels[b]):
+            return labels
+
+
+def _columns(ignore):
+    unknown = set(ignore) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return np.array([COLUMNS[name] for name in FIELDS if name not in ignore])
+
+
+def exact_groups(patches: PatchArray, ignore=DEFAULT_IGNORE):
+    """
+    Group the patches w/ the same parameters.
+
+    Returns
+    -------
+    ndarray
+        For each patch, the index of the first patch of its group
+    """
+    if len(patches) == 0:
+        return np.array([], dtype=np.intp)
+
+    values = patches.values[:, _columns(ignore)]
+    _, first, inverse = np.unique(values, axis=0, return_index=True, return_inverse=True)
+    return first[inverse.ravel()]
+
+
+def _bucket_pairs(buckets):
+    """ Yield every pair (i, j) of rows in the same bucket, as chunks of
+    (i indices, j indices).
+    """
+    order = np.argsort(buckets, kind="stable")
+    sorted_buckets = buckets[order]
+    starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+
+    # Pair each row w/ the one d rows after it, if in the same bucket
+    for d in range(1, min(sizes.max(initial=1), _MAX_BLOCK)):
+        same = sorted_buckets[:-d] == sorted_buckets[d:]
+        yield order[:-d][same], order[d:][same]
+
+    # Rows further apart in large buckets, one row at a time
+    for start, size in zip(starts[sizes > _MAX_BLOCK], sizes[sizes > _MAX_BLOCK]):
+        members = order[start:start + size]
+        for i in range(size - _MAX_BLOCK):
+            yield np.repeat(members[i], size - i - _MAX_BLOCK), members[i + _MAX_BLOCK:]
+
+
+def near_duplicate_groups(patches: PatchArray, tolerance=2, ignore=DEFAULT_IGNORE,
+                          grids=DEFAULT_GRIDS, seed=0):
+    """
+    Group the patches which are near-duplicates of each other.
+
+    Two patches are near-duplicates if every numeric parameter differs by at
+    most tolerance, and every enum parameter is the same. Groups are the
+    connected components of this relation.
+
+    Candidate pairs are only looked for in the same bucket of a grid of cells
+    of 16 * tolerance + 1 (locality sensitive hashing), avoiding O(n^2)
+    comparisons. Each grid is randomly shifted, over the enum fields and 8
+    random numeric fields. Candidates are then checked exactly.
+
+    A near-duplicate pair is in the same bucket of a grid w/ a probability of
+    at least (15 / 16) ** 8 ~ 0.6, even when all its fields differ by the full
+    tolerance. It is hence missed w/ a probability of at most 0.4 ** grids,
+    i.e. ~1e-4 w/ the default 10 grids.
+
+    Parameters
+    ----------
+    patches : PatchArray
+        The patches
+    tolerance : int
+        Maximum difference between numeric parameters, in the PRM units
+    ignore : sequence of str
+        Fields to ignore
+    grids : int
+        Number of shifted grids
+    seed : int
+        Seed of the grid shifts, for reproducible results
+
+    Returns
+    -------
+    ndarray
+        For each patch, the index of the first patch of its group
+    """
+    exact = exact_groups(patches, ignore)
+    if tolerance == 0 or len(patches) == 0:
+        return exact
+
+    # Only compare distinct patches
+    unique = np.unique(exact)
+    columns = _columns(ignore)
+    enum_columns = [i for i, column in enumerate(columns) if FIELDS[column] in FIELD_ENUMS]
+    numeric_columns = [i for i, column in enumerate(columns) if FIELDS[column] not in FIELD_ENUMS]
+
+    values = patches.values[unique][:, columns].astype(np.int16)
+    # Enums must match: compare them w/ an infinite difference
+    compared = values.copy()
+    compared[:, enum_columns] *= 1024
+
+    cell = _CELL_FACTOR * tolerance + 1
+    rng = np.random.default_rng(seed)
+    # Bucket keys are hashed into int64, collisions only add candidates
+    hash_weights = rng.integers(1, 2 ** 62, values.shape[1])
+    a, b = [], []
+    for _ in range(grids):
+        keys = values.astype(np.int64)
+        grid_columns = rng.permutation(numeric_columns)[:_GRID_FIELDS]
+        shifts = rng.integers(0, cell, len(grid_columns))
+        keys[:, numeric_columns] = 0
+        keys[:, grid_columns] = (values[:, grid_columns] + shifts) // cell
+
+        for candidates_a, candidates_b in _bucket_pairs(keys @ hash_weights):
+            close = np.abs(compared[candidates_a] - compared[candidates_b]).max(axis=1) <= tolerance
+            a.append(candidates_a[close])
+            b.append(candidates_b[close])
+
+    a = np.concatenate(a) if a else np.array([], dtype=np.intp)
+    b = np.concatenate(b) if b else np.array([], dtype=np.intp)
+    labels = _connected_components(len(unique), a, b)
+
+    # Map back from distinct patches to every patch
+    groups = unique[labels]
+    return groups[np.searchsorted(unique, exact)]
+
+
+def group_members(groups):
+    """ Return the groups of more than one patch, as lists of indices, by
+    order of their first patch.
+    """
+    order = np.argsort(groups, kind="stable")
+    bounds = np.flatnonzero(np.diff(groups[order])) + 1
+    return [members.tolist() for members in np.split(order, bounds) if len(members) > 1]
+
+
+def dedupe(patches: PatchArray, tolerance=0, ignore=DEFAULT_IGNORE):
+    """
+    Deduplicate the patches, keeping the first patch of each group.
+
+    Parameters
+    ----------
+    patches : PatchArray
+        The patches
+    tolerance : int
+        See near_duplicate_groups. If 0, only exact duplicates are removed.
+    ignore : sequence of str
+        Fields to ignore
+
+    Returns
+    -------
+    keep : ndarray
+        Indices of the patches to keep, in library order
+    groups : list of list
+        The groups of duplicates, see group_members
+    """
+    groups = near_duplicate_groups(patches, tolerance, ignore)
+    keep = np.flatnonzero(groups == np.arange(len(patches)))
+    return keep, group_members(groups)
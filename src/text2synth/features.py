@@ -0,0 +1,304 @@
+"""
+Audio features of patches, rendered w/ text2synth.render, to find patches by
+how they sound: from a description, or from a recording (audio2patch).
+"""
+import logging
+import os
+import uuid
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from .patches import CACHE_DIRNAME, FIELDS, PatchArray, state_from_row
+from .render import SAMPLE_RATE, render
+from .retrieval import tokenize
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Audio features, see audio_features
+FEATURES = (
+    "attack", "decay", "release", "centroid", "rolloff", "flatness", "low_ratio", "modulation",
+)
+FEATURE_COLUMNS = {name: i for i, name in enumerate(FEATURES)}
+# Bump when the features or the rendering change, to invalidate the caches
+FEATURES_VERSION = 1
+FEATURES_FILENAME = "features.npz"
+
+# Note rendered for every patch: one second of C3
+FEATURE_NOTES = ((48, 0.0, 1.0),)
+
+# Tag, see retrieval.tokenize -> feature directions
+TAG_FEATURES = {
+    "bright": {"centroid": 1.0, "rolloff": 1.0},
+    "dark": {"centroid": -1.0, "rolloff": -1.0},
+    "pluck": {"attack": -1.0, "decay": -1.0},
+    "short": {"decay": -1.0, "release": -1.0},
+    "pad": {"attack": 1.0, "release": 1.0},
+    "slow": {"attack": 1.0},
+    "bass": {"low_ratio": 1.0},
+    "lead": {"decay": 1.0, "centroid": 0.5},
+    "string": {"attack": 0.5, "decay": 1.0},
+    "brass": {"attack": 0.5, "centroid": 0.5},
+    "organ": {"attack": -1.0, "decay": 1.0, "release": -1.0},
+    "noise": {"flatness": 1.0},
+    "modulated": {"modulation": 1.0},
+    "chorus": {"modulation": 0.5},
+    "delay": {"release": 1.0},
+}
+
+# Frame sizes of the level and spectrum analyses, in samples at SAMPLE_RATE,
+# w/ a hop of half a frame. Spectrum frames resolve the low end
+_FRAME = 1024
+_SPECTRUM_FRAME = 4096
+# Frequency below which energy counts as low end, in Hz: an octave below the
+# rendered note, i.e. sub oscillator and 16' range
+_LOW_FREQUENCY = 100
+# Spectrum level, relative to the peak, below which is noise: -60dB
+_NOISE_FLOOR = 1e-6
+# Lowest audible frequency, below is DC offset, e.g. from PWM
+_MIN_FREQUENCY = 20
+
+
+def _frames(audio, frame):
+    """ Split audio in frames overlapping by half, zero padding the end."""
+    hop = frame // 2
+    n_frames = max(1, -(-(len(audio) - frame) // hop) + 1)
+    audio = np.pad(audio, (0, (n_frames - 1) * hop + frame - len(audio)))
+    return np.lib.stride_tricks.sliding_window_view(audio, frame)[::hop]
+
+
+def audio_features(audio, sample_rate=SAMPLE_RATE):
+    """
+    Compute the features of a mono sound, in FEATURES order.
+
+    - attack: time to reach 90% of the peak level, in log10 seconds
+    - decay: level 0.3s after the peak, relative to the peak
+    - release: time from the end of the sustained part to silence (-40dB),
+      in log10 seconds
+    - centroid and rolloff: spectral centroid and 85% rolloff of the sound,
+      in log2 Hz
+    - flatness: spectral flatness, 0 for a pure tone, 1 for white noise
+    - low_ratio: fraction of the energy between 20Hz and 100Hz
+    - modulation: variation of the level while sustained
+
+    Returns
+    -------
+    ndarray
+        float32 features
+    """
+    audio = np.asarray(audio, dtype=np.float64)
+    frame = max(16, _FRAME * sample_rate // SAMPLE_RATE)
+    hop = frame // 2
+    level = np.sqrt((_frames(audio, frame) ** 2).mean(axis=1))
+    peak = level.max()
+    if peak <= 0:
+        return np.zeros(len(FEATURES), dtype=np.float32)
+    times = np.arange(len(level)) * hop / sample_rate
+
+    peak_index = int(np.argmax(level >= 0.9 * peak))
+    attack = times[peak_index]
+    after = min(len(level) - 1, peak_index + int(0.3 * sample_rate / hop))
+    decay = level[after] / peak
+
+    sustained = np.flatnonzero(level >= 0.5 * peak)
+    audible = np.flatnonzero(level >= 0.01 * peak)
+    release = times[audible[-1]] - times[sustained[-1]]
+    modulation = level[sustained].std() / level[sustained].mean()
+
+    # Spectrum of the audible part
+    spectrum_frame = max(16, _SPECTRUM_FRAME * sample_rate // SAMPLE_RATE)
+    audible_audio = audio[audible[0] * hop:audible[-1] * hop + frame]
+    spectra = np.fft.rfft(_frames(audible_audio, spectrum_frame) * np.hanning(spectrum_frame))
+    power = (np.abs(spectra) ** 2).mean(axis=0)
+    frequencies = np.fft.rfftfreq(spectrum_frame, 1 / sample_rate)
+    audible_band = frequencies >= _MIN_FREQUENCY
+    power, frequencies = power[audible_band] + 1e-20, frequencies[audible_band]
+    # Centroid and rolloff on the magnitude, closer to perceived brightness,
+    # ignoring the noise floor
+    magnitude = np.where(power >= _NOISE_FLOOR * power.max(), np.sqrt(power), 0)
+    centroid = (magnitude * frequencies).sum() / magnitude.sum()
+    rolloff = frequencies[np.searchsorted(np.cumsum(magnitude), 0.85 * magnitude.sum())]
+    flatness = np.exp(np.log(power).mean()) / power.mean()
+    low_ratio = power[frequencies < _LOW_FREQUENCY].sum() / power.sum()
+
+    return np.array([
+        np.log10(attack + 1e-3),
+        decay,
+        np.log10(release + 1e-3),
+        np.log2(centroid + 1),
+        np.log2(rolloff + 1),
+        flatness,
+        low_ratio,
+        modulation,
+    ], dtype=np.float32)
+
+
+def _rows_features(rows):
+    """ Render the given rows and compute their features. Run in the worker
+    processes.
+    """
+    return np.array(
+        [audio_features(render(state_from_row(row), FEATURE_NOTES)) for row in rows],
+        dtype=np.float32,
+    ).reshape(-1, len(FEATURES))
+
+
+def compute_features(rows, jobs=None, chunk_size=16):
+    """
+    Compute the features of the given PatchArray rows, using a pool of
+    processes.
+
+    Parameters
+    ----------
+    rows : ndarray
+        (n_patches, n_fields) PatchArray values
+    jobs : int, optional
+        Number of worker processes. Defaults to the number of CPUs. If 1,
+        patches are rendered in the current process.
+    chunk_size : int
+        Number of patches rendered per task
+
+    Returns
+    -------
+    ndarray
+        (n_patches, n_features) float32 features
+    """
+    jobs = jobs or os.cpu_count()
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    if jobs == 1:
+        results = [_rows_features(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(_rows_features, chunks))
+    return np.concatenate(results) if results else np.zeros((0, len(FEATURES)), np.float32)
+
+
+class FeatureCache:
+    """
+    On-disk cache of patch features, keyed on the patch parameters, so that
+    patches are only rendered once whatever their name or path.
+
+    Stored as a npz file of the unique parameter rows and their features.
+
+    Parameters
+    ----------
+    path : str or Path
+        The npz file
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read(self):
+        """ Return the cached rows -> features dict, empty if there is no
+        valid cache.
+        """
+        try:
+            with np.load(self.path) as data:
+                if int(data["version"]) != FEATURES_VERSION:
+                    return {}
+                rows, values = data["rows"], data["features"]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return {}
+        if rows.shape != (len(values), len(FIELDS)) or values.shape[1:] != (len(FEATURES),):
+            return {}
+        return {row.tobytes(): value for row, value in zip(rows, values)}
+
+    def write(self, features):
+        rows = np.frombuffer(b"".join(features), dtype=np.uint8).reshape(-1, len(FIELDS))
+        values = np.array(list(features.values()), dtype=np.float32).reshape(-1, len(FEATURES))
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.parent / f"features-{uuid.uuid4().hex}.tmp.npz"
+        np.savez(tmp_path, version=FEATURES_VERSION, rows=rows, features=values)
+        os.replace(tmp_path, self.path)
+
+    def load(self, patches: PatchArray, jobs=None):
+        """
+        Return the features of the given patches, only rendering the patches
+        which are not in the cache yet, and updating it.
+        """
+        cached = self.read()
+        keys = [row.tobytes() for row in np.ascontiguousarray(patches.values)]
+
+        missing = list(dict.fromkeys(key for key in keys if key not in cached))
+        if missing:
+            LOGGER.info("Rendering %d patches", len(missing))
+            rows = np.frombuffer(b"".join(missing), dtype=np.uint8).reshape(-1, len(FIELDS))
+            cached.update(zip(missing, compute_features(rows, jobs)))
+            try:
+                self.write(cached)
+            except OSError:
+                LOGGER.warning("Could not write feature cache %s", self.path, exc_info=True)
+
+        return np.array([cached[key] for key in keys], dtype=np.float32).reshape(-1, len(FEATURES))
+
+
+class FeatureIndex:
+    """
+    Index of the audio features of a patch library.
+
+    Features are standardized over the library, so that descriptions and
+    recordings are matched relative to the library content.
+
+    Parameters
+    ----------
+    patches : PatchArray
+        The patches
+    features : ndarray
+        Their (n_patches, n_features) features, see audio_features
+    """
+    def __init__(self, patches: PatchArray, features):
+        self.patches = patches
+        self.features = np.asarray(features, dtype=np.float32).reshape(-1, len(FEATURES))
+
+        self._mean = self.features.mean(axis=0) if len(self.features) else 0
+        std = self.features.std(axis=0) if len(self.features) else 1
+        self._std = np.where(std > 0, std, 1)
+        self._standardized = (self.features - self._mean) / self._std
+
+    def __len__(self):
+        return len(self.patches)
+
+    @classmethod
+    def from_library(cls, root, patches: PatchArray, jobs=None, cache_path=None):
+        """ Create the index of the given library, using an on-disk cache of
+        the features next to it, see FeatureCache.
+        """
+        cache_path = cache_path or Path(root) / CACHE_DIRNAME / FEATURES_FILENAME
+        return cls(patches, FeatureCache(cache_path).load(patches, jobs))
+
+    def _top(self, scores, k):
+        k = min(k, len(self))
+        best = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=np.intp)
+        return best[np.lexsort((best, -scores[best]))]
+
+    def search_text(self, description, k=10):
+        """
+        Return the indices of the k patches sounding most like description,
+        best first, and their scores.
+
+        Each tag of the description, see TAG_FEATURES, is a direction in the
+        standardized feature space: patches are scored by how far they are
+        along the sum of these directions.
+        """
+        direction = np.zeros(len(FEATURES), dtype=np.float32)
+        for token in tokenize(description):
+            for name, weight in TAG_FEATURES.get(token, {}).items():
+                direction[FEATURE_COLUMNS[name]] += weight
+        scores = self._standardized @ direction
+        best = self._top(scores, k)
+        return best, scores[best]
+
+    def search_audio(self, audio, sample_rate=SAMPLE_RATE, k=10):
+        """
+        Return the indices of the k patches sounding closest to the given mono
+        audio, best first, and their distances.
+        """
+        query = (audio_features(audio, sample_rate) - self._mean) / self._std
+        distances = np.sqrt(((self._standardized - query) ** 2).sum(axis=1))
+        best = self._top(-distances, k)
+        return best, distances[best]
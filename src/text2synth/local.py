@@ -0,0 +1,280 @@
+"""
+Local, offline, patch generation w/ constrained decoding.
+
+Instead of asking a model for free-form JSON and validating it afterwards, the
+JU06AState arguments are decoded one character at a time, and the model only
+chooses between the characters which keep the output valid: the JSON syntax is
+fixed, and values are restricted to the field range, or to the enum values.
+Every output is hence a valid JU06AState, and never needs a retry.
+
+The model is abstracted as a Scorer, so that a deterministic stub is enough to
+run the whole pipeline, e.g. in tests.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import struct
+
+from typing import Protocol
+
+from pydantic_ai.messages import (
+    ModelRequest, ModelResponse, SystemPromptPart, ToolCallPart, UserPromptPart
+)
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, FunctionModel
+
+from .state import FIELD_ENUMS, FIELD_RANGES, JU06AState
+
+
+LOGGER = logging.getLogger(__name__)
+
+LOCAL_PREFIX = "local:"
+# Name of the deterministic stub scorer, i.e. "local:hash"
+HASH_SCORER = "hash"
+
+# Field -> allowed values, as they are written in the JSON output
+FIELD_VALUES = {
+    name: (
+        tuple(str(int(v)) for v in FIELD_ENUMS[name]) if name in FIELD_ENUMS
+        else tuple(str(v) for v in range(FIELD_RANGES[name][0], FIELD_RANGES[name][1] + 1))
+    )
+    for name in JU06AState.model_fields
+}
+
+
+class Scorer(Protocol):
+    """ A model choosing the next characters of a text."""
+    def score(self, prompt: str, prefix: str, candidates: list[str]) -> list[float]:
+        """ Return a score for each candidate continuation of prompt + prefix,
+        the higher the more likely.
+        """
+        ...
+
+
+class HashScorer:
+    """
+    Deterministic stub scorer, scoring candidates from a hash of their
+    context. Outputs are arbitrary, but valid, and reproducible.
+
+    Parameters
+    ----------
+    seed : str
+        Changes the generated outputs
+    """
+    def __init__(self, seed=""):
+        self.seed = seed
+
+    def score(self, prompt, prefix, candidates):
+        context = hashlib.sha256(f"{self.seed}\0{prompt}\0{prefix}".encode()).digest()
+        return [
+            struct.unpack("<d", hashlib.sha256(context + c.encode()).digest()[:8])[0]
+            for c in candidates
+        ]
+
+
+def _common_prefix_length(a, b):
+    """ Return the length of the common prefix of the sequences a and b."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class TransformersScorer:
+    """
+    Scorer using a local causal LM through transformers, scoring each candidate
+    by the log-probability of its tokens.
+
+    Consecutive calls share most of their context, i.e. the prompt and the
+    output so far: the key/value cache of the previous context is kept, and
+    only the new tokens are run through the model.
+
+    transformers and torch are only imported when the model is first used.
+
+    Parameters
+    ----------
+    model_name : str
+        Name or path of the model, e.g. "Qwen/Qwen2.5-0.5B-Instruct"
+    """
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._model = None
+        self._tokenizer = None
+        # Token ids of the context in _kv_cache
+        self._context_ids = []
+        self._kv_cache = None
+
+    def _load(self):
+        try:
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+        except ImportError as e:
+            raise ImportError(
+                "Local models other than 'hash' need transformers and torch to be installed"
+            ) from e
+
+        LOGGER.info("Loading local model %s", self.model_name)
+        self._torch = torch
+        self._new_cache = DynamicCache
+        self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self._model = AutoModelForCausalLM.from_pretrained(self.model_name)
+        self._model.eval()
+
+    def _forward(self, token_ids):
+        """ Run token_ids through the model after the cached tokens, extending
+        the cache, and return their next token log-probabilities.
+        """
+        input_ids = self._torch.tensor([token_ids])
+        logits = self._model(input_ids, past_key_values=self._kv_cache, use_cache=True).logits[0]
+        return self._torch.log_softmax(logits.float(), dim=-1)
+
+    def _next_token_log_probs(self, context_ids):
+        """ Return the next token log-probabilities after context_ids, only
+        running the tokens not in the cache yet.
+        """
+        # Tokens may change at the end of the previous context once extended,
+        # and the last token is always run, for its logits
+        common = min(_common_prefix_length(context_ids, self._context_ids), len(context_ids) - 1)
+        if common == 0:
+            self._kv_cache = self._new_cache()
+        else:
+            self._kv_cache.crop(common)
+        self._context_ids = context_ids[:common]
+        log_probs = self._forward(context_ids[common:])[-1]
+        self._context_ids = context_ids
+        return log_probs
+
+    def score(self, prompt, prefix, candidates):
+        if self._model is None:
+            self._load()
+
+        context_ids = self._tokenizer(prompt + prefix).input_ids
+        with self._torch.no_grad():
+            log_probs = self._next_token_log_probs(context_ids)
+            scores = []
+            for candidate in candidates:
+                token_ids = self._tokenizer(candidate, add_special_tokens=False).input_ids
+                score = log_probs[token_ids[0]].item()
+                if len(token_ids) > 1:
+                    # Score the next tokens, then drop them from the cache
+                    next_log_probs = self._forward(token_ids[:-1])
+                    positions = self._torch.arange(len(token_ids) - 1)
+                    score += next_log_probs[positions, token_ids[1:]].sum().item()
+                    self._kv_cache.crop(len(context_ids))
+                scores.append(score)
+        return scores
+
+
+def _choose(scorer, prompt, prefix, candidates):
+    if len(candidates) == 1:
+        return candidates[0]
+    scores = scorer.score(prompt, prefix, candidates)
+    return candidates[max(range(len(candidates)), key=scores.__getitem__)]
+
+
+def decode_value(scorer, prompt, prefix, values, terminator):
+    """
+    Decode a value among the given ones, one character at a time.
+
+    Parameters
+    ----------
+    scorer : Scorer
+        The model
+    prompt : str
+        The prompt
+    prefix : str
+        The output so far
+    values : tuple of str
+        The allowed values
+    terminator : str
+        The character ending the value
+
+    Returns
+    -------
+    str
+        The value followed by the terminator
+    """
+    value = ""
+    while True:
+        candidates = sorted(
+            {v[len(value)] for v in values if len(v) > len(value) and v.startswith(value)}
+        )
+        if value in values:
+            candidates.append(terminator)
+        c = _choose(scorer, prompt, prefix + value, candidates)
+        value += c
+        if c == terminator:
+            return value
+
+
+def decode_state(scorer, prompt):
+    """
+    Decode the JSON arguments of a JU06AState, constrained to valid values.
+
+    Returns
+    -------
+    iterator of str
+        The output, one field at a time
+    """
+    output = ""
+    names = list(JU06AState.model_fields)
+    for i, name in enumerate(names):
+        chunk = ("{" if i == 0 else " ") + json.dumps(name) + ": "
+        terminator = "}" if i == len(names) - 1 else ","
+        chunk += decode_value(scorer, prompt, output + chunk, FIELD_VALUES[name], terminator)
+        output += chunk
+        yield chunk
+
+
+def _prompt_text(messages):
+    """ Flatten the system and user prompts of the conversation into a text
+    prompt.
+    """
+    lines = []
+    for message in messages:
+        if isinstance(message, ModelRequest):
+            for part in message.parts:
+                if isinstance(part, (SystemPromptPart, UserPromptPart)) and isinstance(part.content, str):
+                    lines.append(part.content)
+    return "\n\n".join(lines) + "\n\nPatch as JSON:\n"
+
+
+def create_scorer(name) -> Scorer:
+    if name == HASH_SCORER:
+        return HashScorer()
+    return TransformersScorer(name)
+
+
+def local_model(name) -> FunctionModel:
+    """
+    Create the pydantic-ai model for the given local model name, i.e. a model
+    name w/o the "local:" prefix.
+
+    The model answers w/ a JU06AState output tool call, decoded w/
+    `decode_state`. Streaming is supported, one field at a time.
+    """
+    scorer = create_scorer(name)
+
+    def output_tool_name(info: AgentInfo):
+        if not info.output_tools:
+            raise ValueError("Local models only support JU06AState outputs")
+        return info.output_tools[0].name
+
+    def generate(messages, info: AgentInfo):
+        args = "".join(decode_state(scorer, _prompt_text(messages)))
+        return ModelResponse(parts=[ToolCallPart(output_tool_name(info), args)])
+
+    async def stream(messages, info: AgentInfo):
+        chunks = decode_state(scorer, _prompt_text(messages))
+        name = output_tool_name(info)
+        while True:
+            # Decoding is CPU bound, keep the event loop responsive
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield {0: DeltaToolCall(name=name, json_args=chunk)}
+            name = None
+
+    return FunctionModel(generate, stream_function=stream, model_name=LOCAL_PREFIX + name)
@@ -1,18 +1,23 @@
+import asyncio
+import contextlib
 import inspect
 import io
 import logging
+import os
 import textwrap
-import time
 
 from enum import Enum
 from typing import Callable, Optional, get_origin
 
-import mido
-
 from mcp.server.fastmcp import FastMCP
 from pydantic import BaseModel
 
+from text2synth.metrics import METRICS, METRICS_ENV, timed
+from text2synth.midi import AsyncMidiSender, MidiOutput, TokenBucket, open_backend
+from text2synth.patches import load_library
+from text2synth.retrieval import SimilarityIndex
 from text2synth.state import JU06AState
+from text2synth.synths import JU_A6_A_LINK
 
 
 LOGGER = logging.getLogger(__name__)
@@ -61,20 +66,84 @@ PATCH_NAME(Brass           );
 
 
 STATE = JU06AState.from_file(io.StringIO(INIT_106))
+# Last state sent to the synth. None means the synth state is unknown, in which
+# case the full state is sent.
+SENT_STATE = None
 DEFAULT_MIDI_OUT = "USB MIDI Interface"
+# mido backend, or "loopback" for an in-process virtual device, see
+# text2synth.midi.open_backend
+MIDI_BACKEND_ENV = "TEXT2SYNTH_MIDI_BACKEND"
+# Kept open for the whole session
+MIDI_OUT = MidiOutput(
+    DEFAULT_MIDI_OUT,
+    open_backend(os.environ.get(MIDI_BACKEND_ENV)),
+    limiter=TokenBucket(JU_A6_A_LINK["bytes_per_second"], JU_A6_A_LINK["burst_bytes"]),
+)
+
+
+def _on_send_error(e):
+    global SENT_STATE
+    # We don't know how much went through
+    SENT_STATE = None
+
+
+SENDER = AsyncMidiSender(MIDI_OUT, on_error=_on_send_error)
+
+# Directory of the patch library used by find_similar
+PATCHES_PATH_ENV = "TEXT2SYNTH_PATCHES"
+# Loaded on first use
+SIMILARITY_INDEX = None
+
+
+def get_similarity_index():
+    global SIMILARITY_INDEX
+
+    if SIMILARITY_INDEX is None:
+        path = os.environ.get(PATCHES_PATH_ENV)
+        if not path:
+            raise ValueError(f"No patch library: set {PATCHES_PATH_ENV} to its directory")
+        # Invalid patches are skipped
+        SIMILARITY_INDEX = SimilarityIndex(load_library(path, errors=[]))
+        LOGGER.info("Loaded %d patches from %s", len(SIMILARITY_INDEX), path)
+    return SIMILARITY_INDEX
+
+
+@contextlib.asynccontextmanager
+async def lifespan(server):
+    try:
+        yield
+    finally:
+        await SENDER.close()
 
 
-server = FastMCP('Text2Synth MCP Server')
+server = FastMCP('Text2Synth MCP Server', lifespan=lifespan)
 
 
-def apply_state_to_synth(state):
-    outport_name = DEFAULT_MIDI_OUT
-    with mido.open_output(outport_name) as outport:
-        LOGGER.debug("Ready to use MIDI port %s", outport_name)
-        for msg in state.to_cc_messages():
-            outport.send(msg)
-            # Sleeping a bit to avoid flooding the MIDI connection
-            time.sleep(0.001)
+def apply_state_to_synth(state, full=False, changed=None):
+    """ Queue the CC messages needed to bring the synth to the given state.
+
+    Only the CC that changed since the last state sent are sent, unless full
+    is True. If changed is given, e.g. from JU06AState.apply_updates, only
+    those fields are compared. The messages are sent in the background, see
+    SENDER.
+    """
+    global SENT_STATE
+
+    if full or SENT_STATE is None or changed is None:
+        messages = JU06AState.diff_cc_messages(None if full else SENT_STATE, state)
+        # STATE is updated in place, so we need to keep our own copy
+        sent_state = state.model_copy()
+    else:
+        messages = [
+            msg for msg, sent in zip(state.field_cc_messages(changed), SENT_STATE.field_cc_messages(changed))
+            if msg.value != sent.value
+        ]
+        sent_state = SENT_STATE
+        sent_state.apply_updates({name: state.__dict__[name] for name in changed})
+
+    LOGGER.debug("Queuing %d CC messages", len(messages))
+    SENDER.submit(messages)
+    SENT_STATE = sent_state
 
 
 def create_function_from_model(model_class: type[BaseModel], wrapped_func: Callable):
@@ -89,6 +158,9 @@ def create_function_from_model(model_class: type[BaseModel], wrapped_func: Calla
     pydantic class. This exposes the right info when exposing the function as
     an MCP tool.
 
+    If wrapped_func is a coroutine function, the generated function is one as
+    well.
+
     Parameters
     ----------
     model_class : type[BaseModel]
@@ -163,9 +235,14 @@ def create_function_from_model(model_class: type[BaseModel], wrapped_func: Calla
 {chr(10).join(param_docs)}
     """)
 
-    def generated_func(**kwargs) -> None:
-        updates = {k: v for k, v in kwargs.items() if v is not None}
-        wrapped_func(**updates)
+    if inspect.iscoroutinefunction(wrapped_func):
+        async def generated_func(**kwargs) -> None:
+            updates = {k: v for k, v in kwargs.items() if v is not None}
+            await wrapped_func(**updates)
+    else:
+        def generated_func(**kwargs) -> None:
+            updates = {k: v for k, v in kwargs.items() if v is not None}
+            wrapped_func(**updates)
 
     # Note: None is for explicit -> None, not for no annotation
     sig = inspect.Signature(params, return_annotation=None)
@@ -184,10 +261,10 @@ def create_function_from_model(model_class: type[BaseModel], wrapped_func: Calla
     return generated_func
 
 
-def update_synth_state(**kw):
-    for k, v in kw.items():
-        setattr(STATE, k, v)
-    apply_state_to_synth(STATE)
+async def update_synth_state(**kw):
+    with timed("state.validate"):
+        changed = STATE.apply_updates(kw)
+    apply_state_to_synth(STATE, changed=changed)
 
 
 update_synth = create_function_from_model(JU06AState, update_synth_state)
@@ -195,11 +272,78 @@ update_synth = server.tool()(update_synth)
 
 
 @server.tool()
-def reset() -> None:
-    """Reset the state to initial state"""
+async def reset(wait: bool = False) -> None:
+    """Reset the state to initial state
+
+    Parameters
+    ----------
+    wait : bool
+        If True, only return once the state has been sent to the synth.
+    """
     global STATE
     STATE = JU06AState.from_file(io.StringIO(INIT_106))
-    apply_state_to_synth(STATE)
+    apply_state_to_synth(STATE, full=True)
+    if wait:
+        await SENDER.flush()
+
+
+@server.tool()
+async def find_similar(k: int = 5, path: Optional[str] = None) -> list[dict]:
+    """Find the patches of the library closest to the current state
+
+    Parameters
+    ----------
+    k : int
+        Number of patches to return
+    path : str, optional
+        If given, look for the patches closest to this PRM file instead of
+        the current state.
+
+    Returns
+    -------
+    list of dict
+        The name, path and distance of each patch, closest first
+    """
+    state = STATE if path is None else JU06AState.from_path(path)
+
+    # Loading the library may take a while, keep the event loop responsive
+    index = await asyncio.to_thread(get_similarity_index)
+    indices, distances = index.search(state, k)
+    return [
+        {"name": index.patches.names[i], "path": str(index.patches.paths[i]), "distance": float(d)}
+        for i, d in zip(indices, distances)
+    ]
+
+
+@server.tool()
+def metrics(reset: bool = False) -> dict:
+    """Timings of the server hot paths, to tell whether latency comes from
+    validation, CC encoding or the MIDI wire
+
+    Parameters
+    ----------
+    reset : bool
+        If True, clear the timings after reading them.
+
+    Returns
+    -------
+    dict
+        Whether metrics are enabled, and the count, total, mean, min, max and
+        percentiles of each timing, in seconds: state.validate,
+        cc.encode, midi.wait (rate limiting), midi.send, etc.
+    """
+    result = {"enabled": METRICS.enabled, "timings": METRICS.snapshot()}
+    if not METRICS.enabled:
+        result["hint"] = f"Set {METRICS_ENV}=1 to enable metrics"
+    if reset:
+        METRICS.reset()
+    return result
+
+
+@server.tool()
+async def flush() -> None:
+    """Wait until every pending change has been sent to the synth"""
+    await SENDER.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+"""
+Low overhead timing of the hot paths, to tell where the latency comes from:
+the model, validation, encoding or the MIDI wire.
+
+Timings are recorded in histograms w/ logarithmic buckets, so recording is
+O(log(buckets)) and memory is bounded, whatever the session length.
+
+Recording is disabled by default, in which case `timed` returns a shared no-op
+context manager. Enable it w/ `enable`, or by setting TEXT2SYNTH_METRICS=1.
+
+Example:
+
+    with timed("prm.parse"):
+        state = JU06AState.from_file(fp)
+"""
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+
+# Set to a non empty value to enable metrics when the module is imported
+METRICS_ENV = "TEXT2SYNTH_METRICS"
+
+# Upper bounds of the buckets, in seconds: from 1us to ~20 min, 4 buckets per
+# octave, i.e. percentiles are within ~19%
+BUCKET_BOUNDS = tuple(1e-6 * 2 ** (i / 4) for i in range(121))
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Histogram:
+    """
+    Histogram of durations, in seconds.
+
+    Parameters
+    ----------
+    bounds : sequence of float
+        Increasing upper bounds of the buckets. Larger values go in an extra
+        overflow bucket.
+    """
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        """ Return the q-th percentile, as the upper bound of its bucket,
+        clipped to the observed range.
+        """
+        if self.count == 0:
+            return 0.0
+        if q <= 0:
+            return self.min
+        rank = q / 100 * self.count
+        cumulated = 0
+        for i, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= rank and count:
+                bound = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """ Return the count, total, mean, min, max, p50, p90 and p99, in
+        seconds.
+        """
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *a):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metrics:
+    """
+    Registry of named histograms.
+
+    Parameters
+    ----------
+    enabled : bool
+        If False, nothing is recorded.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        """ Return the histogram of the given name, created on first use."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def timed(self, name):
+        """ Context manager recording the duration of its block in the given
+        histogram.
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _Timer(self.histogram(name))
+
+    def observe(self, name, value):
+        """ Record a duration measured by the caller, e.g. a sleep."""
+        if self.enabled:
+            self.histogram(name).observe(value)
+
+    def snapshot(self):
+        """ Return the summary of every histogram, by name."""
+        return {name: self.histograms[name].summary() for name in sorted(self.histograms)}
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+    def report(self):
+        """ Return the snapshot as a text table, in milliseconds."""
+        lines = [f"{'name':24s} {'count':>8s} {'total':>10s} {'mean':>9s} {'p50':>9s} {'p90':>9s} "
+                 f"{'p99':>9s} {'max':>9s}"]
+        for name, summary in self.snapshot().items():
+            lines.append(
+                f"{name:24s} {summary['count']:8d} {summary['total'] * 1e3:10.2f}"
+                + "".join(f" {summary[key] * 1e3:9.3f}" for key in ("mean", "p50", "p90", "p99", "max"))
+            )
+        return "\n".join(lines)
+
+
+# Process wide registry, used by the module functions
+METRICS = Metrics(enabled=bool(os.environ.get(METRICS_ENV)))
+
+
+def timed(name):
+    """ See Metrics.timed, on the process wide registry."""
+    if not METRICS.enabled:
+        return _NULL_CONTEXT
+    return _Timer(METRICS.histogram(name))
+
+
+def observe(name, value):
+    """ See Metrics.observe, on the process wide registry."""
+    if METRICS.enabled:
+        METRICS.histogram(name).observe(value)
+
+
+def enable():
+    METRICS.enabled = True
+
+
+def disable():
+    METRICS.enabled = False
@@ -0,0 +1,478 @@
+import asyncio
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import mido
+
+from .metrics import observe, timed
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SystemClock:
+    """ Wall clock, used by default by the rate limiters."""
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimulatedClock:
+    """ Clock where sleeping only advances the current time. Useful to check
+    the throughput of a rate limiter without waiting nor hardware.
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+# Name of the in-process loopback backend, see open_backend
+LOOPBACK_BACKEND = "loopback"
+
+
+class LoopbackPort:
+    """ Output port of a LoopbackBackend: messages are delivered to every
+    input port and recorder connected to the same name.
+    """
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.closed = False
+
+    def send(self, msg):
+        if self.closed:
+            raise OSError(f"Port {self.name} is closed")
+        self.backend.deliver(self.name, msg)
+
+    def close(self):
+        self.closed = True
+
+
+class LoopbackInput:
+    """ Input port of a LoopbackBackend, w/ the subset of mido's input port
+    API used to read messages.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+        self._queue = queue.SimpleQueue()
+
+    def _receive(self, timestamp, msg):
+        self._queue.put(msg)
+
+    def receive(self, block=True, timeout=None):
+        """ Return the next message, or None if not blocking and no message is
+        pending.
+        """
+        try:
+            return self._queue.get(block, timeout)
+        except queue.Empty:
+            if block:
+                raise TimeoutError(f"No message received on {self.name}") from None
+            return None
+
+    def poll(self):
+        return self.receive(block=False)
+
+    def iter_pending(self):
+        while (msg := self.poll()) is not None:
+            yield msg
+
+    def close(self):
+        self.closed = True
+
+
+class MidiRecorder:
+    """
+    Record the messages sent to a LoopbackBackend port, w/ their arrival time
+    and the number of bytes received so far, as a device would see them.
+
+    Parameters
+    ----------
+    name : str
+        Name of the recorded port
+    clock : object
+        Object with a time method, see SystemClock
+    """
+    def __init__(self, name, clock):
+        self.name = name
+        self.clock = clock
+        self.closed = False
+        # (timestamp, msg)
+        self.messages = []
+        self.bytes_received = 0
+        self._received = threading.Condition()
+
+    def _receive(self, timestamp, msg):
+        with self._received:
+            self.bytes_received += len(msg.bytes())
+            self.messages.append((timestamp, msg))
+            self._received.notify_all()
+
+    @property
+    def last_time(self):
+        """ Arrival time of the last message, None if nothing was received."""
+        return self.messages[-1][0] if self.messages else None
+
+    def wait_for(self, count, timeout=None):
+        """ Block until count messages were received in total."""
+        with self._received:
+            if not self._received.wait_for(lambda: len(self.messages) >= count, timeout):
+                raise TimeoutError(f"Received {len(self.messages)} of {count} messages on {self.name}")
+
+    def clear(self):
+        with self._received:
+            self.messages = []
+            self.bytes_received = 0
+
+    def close(self):
+        self.closed = True
+
+
+class LoopbackBackend:
+    """
+    In-process virtual MIDI device, to run the send paths w/o hardware, e.g.
+    in tests and benchmarks.
+
+    Has the subset of mido's backend API used by MidiOutput. Any output name
+    can be opened, which creates the port. Messages sent to a port are
+    delivered synchronously to the inputs and recorders opened on the same
+    name.
+
+    Parameters
+    ----------
+    names : sequence of str
+        Ports available before any is opened
+    clock : object
+        Object with a time method, used to timestamp the messages. Defaults to
+        the system clock.
+    """
+    def __init__(self, names=(), clock=None):
+        self.clock = clock or SystemClock()
+        self._names = list(names)
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def _add_name(self, name):
+        with self._lock:
+            if name not in self._names:
+                self._names.append(name)
+
+    def get_output_names(self):
+        return list(self._names)
+
+    def get_input_names(self):
+        return list(self._names)
+
+    def open_output(self, name):
+        self._add_name(name)
+        return LoopbackPort(self, name)
+
+    def _listen(self, name, listener):
+        self._add_name(name)
+        with self._lock:
+            self._listeners.setdefault(name, []).append(listener)
+        return listener
+
+    def open_input(self, name):
+        return self._listen(name, LoopbackInput(name))
+
+    def recorder(self, name):
+        """ Return a MidiRecorder of the messages sent to the given port."""
+        return self._listen(name, MidiRecorder(name, self.clock))
+
+    def deliver(self, name, msg):
+        timestamp = self.clock.time()
+        with self._lock:
+            listeners = [listener for listener in self._listeners.get(name, ()) if not listener.closed]
+            self._listeners[name] = listeners
+        for listener in listeners:
+            listener._receive(timestamp, msg)
+
+
+def open_backend(name=None):
+    """
+    Return the MIDI backend of the given name.
+
+    Parameters
+    ----------
+    name : str, optional
+        LOOPBACK_BACKEND for a new LoopbackBackend, or a mido backend module,
+        e.g. "mido.backends.rtmidi". If None, mido's current backend.
+    """
+    if not name:
+        return mido
+    if name == LOOPBACK_BACKEND:
+        return LoopbackBackend()
+    return mido.Backend(name)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, counted in bytes.
+
+    Bytes can be sent at once up to `burst`, after which they are sent at the
+    sustained `rate`.
+
+    Parameters
+    ----------
+    rate : float
+        Sustained rate, in bytes per second
+    burst : int
+        Max number of bytes sent back to back. Should be small enough not to
+        overflow the device input buffer.
+    clock : object
+        Object with time and sleep methods. Defaults to the system clock.
+    """
+    def __init__(self, rate, burst, clock=None):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock or SystemClock()
+
+        self._tokens = burst
+        self._last = self.clock.time()
+
+    def reserve(self, nbytes):
+        """ Consume the tokens for nbytes, and return how long the caller
+        needs to wait before sending them, in seconds.
+        """
+        now = self.clock.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        # Tokens may go negative: the debt is what later callers wait for
+        self._tokens -= nbytes
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+    def acquire(self, nbytes):
+        """ Block until nbytes can be sent."""
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            self.clock.sleep(delay)
+
+
+class MidiOutput:
+    """
+    Long-lived MIDI output connection.
+
+    The port is opened lazily on first send, and kept open until close is
+    called. If sending fails, e.g. because the device was unplugged, the port
+    is reopened once before giving up.
+
+    Parameters
+    ----------
+    name : str
+        Name of the MIDI output port
+    backend : object
+        Object with mido's `open_output` and `get_output_names` functions.
+        Defaults to mido's current backend.
+    limiter : object, optional
+        Rate limiter, with `acquire(nbytes)` and `reserve(nbytes)` methods,
+        see TokenBucket. If None, messages are sent as fast as possible.
+    """
+    def __init__(self, name, backend=mido, limiter=None):
+        self.name = name
+        self.backend = backend
+        self.limiter = limiter
+        self._port = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a, **kw):
+        self.close()
+
+    @property
+    def is_open(self):
+        return self._port is not None and not self._port.closed
+
+    def open(self):
+        """ Open the port if not opened yet, and return it."""
+        if not self.is_open:
+            LOGGER.debug("Opening MIDI port %s", self.name)
+            self._port = self.backend.open_output(self.name)
+        return self._port
+
+    def close(self):
+        if self._port is not None:
+            LOGGER.debug("Closing MIDI port %s", self.name)
+            try:
+                self._port.close()
+            finally:
+                self._port = None
+
+    def reconnect(self):
+        try:
+            self.close()
+        except Exception:
+            # The port is likely broken already, e.g. the device was unplugged
+            LOGGER.warning("Failed closing MIDI port %s", self.name, exc_info=True)
+        return self.open()
+
+    def is_healthy(self):
+        """ True if the port is open and the device is still connected."""
+        return self.is_open and self.name in self.backend.get_output_names()
+
+    def send(self, msg):
+        """ Send the given message, reconnecting once on failure."""
+        if self.limiter is not None:
+            with timed("midi.wait"):
+                self.limiter.acquire(len(msg.bytes()))
+        self._send(msg)
+
+    async def send_async(self, msg):
+        """ Like send, but waits for the rate limiter w/o blocking the event
+        loop.
+        """
+        if self.limiter is not None:
+            delay = self.limiter.reserve(len(msg.bytes()))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            observe("midi.wait", delay)
+        self._send(msg)
+
+    def _send(self, msg):
+        port = self.open()
+        try:
+            with timed("midi.send"):
+                port.send(msg)
+        except Exception:
+            LOGGER.warning("Failed sending to MIDI port %s, reconnecting", self.name,
+                           exc_info=True)
+            self.reconnect().send(msg)
+
+
+class CoalescingQueue:
+    """
+    Asyncio queue of MIDI messages where pending writes to the same CC are
+    merged.
+
+    When a control change is put while another one for the same CC and channel
+    is still pending, the latest value replaces the pending one (last write
+    wins) and keeps its position in the queue. Other messages are never merged,
+    and act as barriers: a CC put after a program change is not merged with one
+    put before it.
+
+    The API is the subset of asyncio.Queue used by AsyncMidiSender.
+    """
+    def __init__(self):
+        # key -> msg, in insertion order
+        self._pending = {}
+        self._generation = 0
+        self._counter = itertools.count()
+
+        self._unfinished = 0
+        self._not_empty = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self):
+        return len(self._pending)
+
+    def empty(self):
+        return not self._pending
+
+    def put_nowait(self, msg):
+        if msg.type == "control_change":
+            key = (self._generation, msg.channel, msg.control)
+        else:
+            key = next(self._counter)
+            self._generation += 1
+
+        if key not in self._pending:
+            self._unfinished += 1
+            self._finished.clear()
+        self._pending[key] = msg
+        self._not_empty.set()
+
+    async def get(self):
+        while not self._pending:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._pending.pop(next(iter(self._pending)))
+
+    def task_done(self):
+        if self._unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self):
+        await self._finished.wait()
+
+
+class AsyncMidiSender:
+    """
+    Send MIDI messages from a background asyncio task.
+
+    The task owns the output port and consumes a queue of messages, so that
+    callers return as soon as their messages are queued. The task is started
+    on first submit.
+
+    Pending writes to the same CC are coalesced, see CoalescingQueue, so that
+    fast parameter sweeps do not build a backlog on slow links.
+
+    Parameters
+    ----------
+    output : MidiOutput
+        Where to send the messages
+    on_error : callable, optional
+        Called with the exception when a message could not be sent.
+    """
+    def __init__(self, output, on_error=None):
+        self.output = output
+        self.on_error = on_error
+
+        self._queue = CoalescingQueue()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, messages):
+        """ Queue the given messages, w/o waiting for them to be sent."""
+        self.start()
+        for msg in messages:
+            self._queue.put_nowait(msg)
+
+    async def flush(self):
+        """ Wait until every queued message has been sent."""
+        await self._queue.join()
+
+    async def close(self):
+        """ Send the pending messages, then stop the task and close the port."""
+        if self._task is not None:
+            await self.flush()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.output.close()
+
+    async def _run(self):
+        while True:
+            msg = await self._queue.get()
+            try:
+                await self.output.send_async(msg)
+            except Exception as e:
+                LOGGER.error("Could not send %s to %s", msg, self.output.name, exc_info=True)
+                if self.on_error is not None:
+                    self.on_error(e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,616 @@
+import io
+import json
+import logging
+import os
+import time
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Self
+
+import numpy as np
+
+from .metrics import observe, timed
+from .state import COMPACT_HEADER, FIELD_ENUMS, FIELD_RANGES, FIELDS, JU06AState, parse_prm
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Column of each field in PatchArray.values, see FIELDS
+COLUMNS = {name: i for i, name in enumerate(FIELDS)}
+
+# Per column (min, max) allowed values, and allowed values for enum columns.
+# Used to validate whole matrices at once.
+_COLUMN_MIN = np.array(
+    [FIELD_RANGES[name][0] if name in FIELD_RANGES else 0 for name in FIELDS]
+)
+_COLUMN_MAX = np.array(
+    [FIELD_RANGES[name][1] if name in FIELD_RANGES else 255 for name in FIELDS]
+)
+_ENUM_VALUES = {
+    COLUMNS[name]: np.array([e.value for e in enum_class])
+    for name, enum_class in FIELD_ENUMS.items()
+}
+# dtype of the rows read from the files: uint8 is not enough, rows are not
+# validated yet
+_ROW_DTYPE = np.int16
+_ROW_MIN, _ROW_MAX = np.iinfo(_ROW_DTYPE).min, np.iinfo(_ROW_DTYPE).max
+
+
+def _invalid_rows(values):
+    """ Return the mask of the rows of values that are not valid states."""
+    invalid = ((values < _COLUMN_MIN) | (values > _COLUMN_MAX)).any(axis=1)
+    for column, allowed in _ENUM_VALUES.items():
+        invalid |= ~np.isin(values[:, column], allowed)
+    return invalid
+
+
+class PatchArray:
+    """
+    Compact, array-backed collection of patches.
+
+    Every patch is a row of `values`, a (n_patches, n_fields) uint8 matrix with
+    one column per JU06AState field, in FIELDS order. Enum fields are stored as
+    their int value, see FIELD_ENUMS for their types. Patch names and source
+    paths are stored alongside, one per row.
+
+    Rows are assumed to be valid states: use the from_* constructors to create
+    instances from unvalidated data.
+
+    Parameters
+    ----------
+    values : array-like
+        (n_patches, n_fields) matrix
+    names : list, optional
+        Patch names
+    paths : list, optional
+        Path each patch was loaded from
+    """
+    def __init__(self, values, names=None, paths=None):
+        values = np.asarray(values, dtype=np.uint8).reshape(-1, len(FIELDS))
+        n = len(values)
+        names = [None] * n if names is None else list(names)
+        paths = [None] * n if paths is None else list(paths)
+        if len(names) != n or len(paths) != n:
+            raise ValueError("values, names and paths must have the same length")
+
+        self.values = values
+        self.names = names
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        """ Return the row of the given patch, as a read-only view."""
+        row = self.values[index]
+        row.flags.writeable = False
+        return row
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.to_state(i)
+
+    def column(self, name):
+        """ Return the values of the given field for every patch, as a view."""
+        return self.values[:, COLUMNS[name]]
+
+    def select(self, indices) -> Self:
+        """ Return a new PatchArray w/ the given patches."""
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        return type(self)(
+            self.values[indices],
+            [self.names[i] for i in indices],
+            [self.paths[i] for i in indices],
+        )
+
+    def to_state(self, index) -> JU06AState:
+        """ Create the JU06AState for the given patch."""
+        return state_from_row(self.values[index])
+
+    def to_compact(self) -> str:
+        """ Return the patches in the compact CSV format, w/ a header line,
+        see JU06AState.to_compact_row.
+        """
+        lines = [COMPACT_HEADER]
+        for i, name in enumerate(self.names):
+            lines.append(self.to_state(i).to_compact_row(name or "NEW PATCH"))
+        return "\n".join(lines)
+
+    def to_prm(self, index) -> str:
+        """ Return the given patch as PRM text."""
+        fp = io.StringIO(newline='')
+        self.to_state(index).to_file(fp, self.names[index] or "NEW PATCH")
+        return fp.getvalue()
+
+    @classmethod
+    def from_states(cls, states, names=None, paths=None) -> Self:
+        values = np.array(
+            [[int(state.__dict__[name]) for name in FIELDS] for state in states],
+            dtype=np.uint8,
+        )
+        return cls(values, names, paths)
+
+    @classmethod
+    def from_rows(cls, rows, names=None, paths=None, errors=None) -> Self:
+        """
+        Create from unvalidated rows, e.g. parsed from PRM files.
+
+        Parameters
+        ----------
+        rows : array-like
+            (n_patches, n_fields) integer matrix
+        names : list, optional
+            Patch names
+        paths : list, optional
+            Path each patch was loaded from
+        errors : list, optional
+            If given, (path, exception) tuples are appended for the invalid
+            rows, and those rows are skipped. Otherwise, ValueError is raised.
+        """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1, len(FIELDS))
+        n = len(rows)
+        names = [None] * n if names is None else list(names)
+        paths = [None] * n if paths is None else list(paths)
+
+        with timed("state.validate"):
+            invalid = _invalid_rows(rows)
+        if invalid.any():
+            bad = np.flatnonzero(invalid)
+            if errors is None:
+                raise ValueError(f"Invalid patch values for {paths[bad[0]] or bad[0]}")
+            for i in bad:
+                errors.append((paths[i], ValueError("Invalid patch values")))
+            keep = np.flatnonzero(~invalid)
+            rows = rows[keep]
+            names = [names[i] for i in keep]
+            paths = [paths[i] for i in keep]
+
+        return cls(rows, names, paths)
+
+    @classmethod
+    def from_paths(cls, paths, errors=None) -> Self:
+        """
+        Load the given PRM files.
+
+        Parameters
+        ----------
+        paths : iterable
+            Paths of the PRM files
+        errors : list, optional
+            If given, (path, exception) tuples are appended for the files that
+            could not be loaded, and those files are skipped. Otherwise, the
+            first error is raised.
+        """
+        rows, names, loaded_paths, read_errors, durations = _read_chunk(paths)
+        for duration in durations:
+            observe("prm.parse", duration)
+        if read_errors:
+            if errors is None:
+                raise read_errors[0][1]
+            errors.extend(read_errors)
+
+        return cls.from_rows(rows, names, loaded_paths, errors)
+
+
+def state_from_row(row) -> JU06AState:
+    """ Create the JU06AState for the given PatchArray row, w/o validation."""
+    values = {}
+    for name, value in zip(FIELDS, row.tolist()):
+        enum_class = FIELD_ENUMS.get(name)
+        values[name] = value if enum_class is None else enum_class(value)
+    return JU06AState.model_construct(**values)
+
+
+def read_prm_row(path):
+    """
+    Read the given PRM file into a row of values, in FIELDS order.
+
+    Returns
+    -------
+    row : list[int]
+        The values, not validated
+    patch_name : str or None
+        The patch name
+    """
+    with open(path, 'r', encoding='ascii') as fp:
+        values, patch_name = parse_prm(fp.read())
+    try:
+        return [values[name] for name in FIELDS], patch_name
+    except KeyError as e:
+        raise ValueError(f"Missing field {e.args[0]}") from None
+
+
+def iter_prm_paths(root):
+    """ Walk root recursively, yielding the .PRM files as they are found."""
+    return Path(root).rglob("*.PRM")
+
+
+def _read_chunk(paths):
+    """ Read the given PRM files into rows, w/ the parse time of each file.
+    Run in the worker processes.
+    """
+    rows = []
+    names = []
+    loaded_paths = []
+    errors = []
+    # Metrics are recorded by the parent process
+    durations = []
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            row, name = read_prm_row(path)
+            # Rows are validated by PatchArray.from_rows, but must first fit
+            # in _ROW_DTYPE
+            if not all(_ROW_MIN <= value <= _ROW_MAX for value in row):
+                raise ValueError("Invalid patch values")
+        except (OSError, ValueError) as e:
+            errors.append((path, e))
+            continue
+        finally:
+            durations.append(time.perf_counter() - start)
+        rows.append(row)
+        names.append(name)
+        loaded_paths.append(path)
+    return np.array(rows, dtype=_ROW_DTYPE), names, loaded_paths, errors, durations
+
+
+def load_paths(paths, jobs=None, chunk_size=256, errors=None) -> PatchArray:
+    """
+    Load the given PRM files using a pool of processes.
+
+    Paths are consumed lazily, and sent to the workers by chunks as soon as
+    enough of them are available, so that parsing starts while e.g. the
+    directory is still being walked. Workers return compact rows, validated
+    at once at the end.
+
+    Parameters
+    ----------
+    paths : iterable
+        Paths of the PRM files
+    jobs : int, optional
+        Number of worker processes. Defaults to the number of CPUs. If 1, files
+        are read in the current process.
+    chunk_size : int
+        Number of files parsed per task
+    errors : list, optional
+        If given, (path, exception) tuples are appended for the files that
+        could not be loaded, and those files are skipped. Otherwise, the first
+        error is raised.
+
+    Returns
+    -------
+    PatchArray
+        The patches, in the same order as paths
+    """
+    jobs = jobs or os.cpu_count()
+
+    def chunks():
+        chunk = []
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    if jobs == 1:
+        results = [_read_chunk(chunk) for chunk in chunks()]
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [executor.submit(_read_chunk, chunk) for chunk in chunks()]
+            results = [future.result() for future in futures]
+
+    for result in results:
+        for duration in result[4]:
+            observe("prm.parse", duration)
+
+    read_errors = [error for result in results for error in result[3]]
+    if read_errors:
+        if errors is None:
+            raise read_errors[0][1]
+        errors.extend(read_errors)
+
+    rows = [result[0].reshape(-1, len(FIELDS)) for result in results]
+    return PatchArray.from_rows(
+        np.concatenate(rows) if rows else [],
+        [name for result in results for name in result[1]],
+        [path for result in results for path in result[2]],
+        errors,
+    )
+
+
+def load_directory(root, jobs=None, chunk_size=256, errors=None) -> PatchArray:
+    """ Load every PRM file found recursively under root, see load_paths."""
+    return load_paths(iter_prm_paths(root), jobs, chunk_size, errors)
+
+
+CACHE_DIRNAME = ".text2synth-cache"
+CACHE_VERSION = 2
+
+
+class PatchCache:
+    """
+    On-disk cache of a patch library, stored next to the library.
+
+    The cache is made of a values-<id>.npy file w/ the PatchArray matrix,
+    memory-mapped when loaded, and index.json, w/ one (relative path, mtime,
+    size, patch name) entry per row. The index is written last and points to
+    its values file, so that updating the cache is atomic.
+
+    The files which could not be loaded are also recorded in the index, w/
+    their error, so that they are only parsed again once they change.
+
+    Parameters
+    ----------
+    root : str or Path
+        Root directory of the library
+    cache_dir : str or Path, optional
+        Where to store the cache. Defaults to root/.text2synth-cache
+    """
+    def __init__(self, root, cache_dir=None):
+        self.root = Path(root)
+        self.cache_dir = Path(cache_dir) if cache_dir else self.root / CACHE_DIRNAME
+
+    @property
+    def index_path(self):
+        return self.cache_dir / "index.json"
+
+    def read(self):
+        """
+        Read the cache.
+
+        Returns
+        -------
+        entries : dict
+            Relative path -> (row, mtime_ns, size, patch name)
+        values : np.ndarray
+            Memory-mapped matrix. Empty if there is no valid cache.
+        invalid : dict
+            Relative path -> (mtime_ns, size, error message), for the files
+            which could not be loaded
+        """
+        try:
+            with open(self.index_path, encoding="utf-8") as fp:
+                index = json.load(fp)
+            if index["version"] != CACHE_VERSION or index["fields"] != list(FIELDS):
+                raise ValueError("Incompatible cache")
+            values = np.load(self.cache_dir / index["values"], mmap_mode="r")
+            if values.dtype != np.uint8 or values.shape != (len(index["entries"]), len(FIELDS)):
+                raise ValueError("Values do not match the index")
+            entries = {
+                rel_path: (row, mtime_ns, size, name)
+                for row, (rel_path, mtime_ns, size, name) in enumerate(index["entries"])
+            }
+            invalid = {
+                rel_path: (mtime_ns, size, error)
+                for rel_path, mtime_ns, size, error in index["invalid"]
+            }
+        except FileNotFoundError:
+            return {}, np.empty((0, len(FIELDS)), dtype=np.uint8), {}
+        except Exception:
+            LOGGER.warning("Ignoring invalid patch cache %s", self.cache_dir, exc_info=True)
+            return {}, np.empty((0, len(FIELDS)), dtype=np.uint8), {}
+        return entries, values, invalid
+
+    def write(self, patches, stats, invalid=None):
+        """
+        Write the given patches to the cache.
+
+        Parameters
+        ----------
+        patches : PatchArray
+            The patches, w/ paths under root
+        stats : dict
+            Relative path -> (mtime_ns, size), for every patch
+        invalid : dict, optional
+            Relative path -> (mtime_ns, size, error message), for the files
+            which could not be loaded
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        values_name = f"values-{uuid.uuid4().hex}.npy"
+        np.save(self.cache_dir / values_name, patches.values)
+
+        entries = []
+        for path, name in zip(patches.paths, patches.names):
+            rel_path = Path(path).relative_to(self.root).as_posix()
+            entries.append([rel_path, *stats[rel_path], name])
+        index = {
+            "version": CACHE_VERSION,
+            "fields": list(FIELDS),
+            "values": values_name,
+            "entries": entries,
+            "invalid": [[rel_path, *value] for rel_path, value in (invalid or {}).items()],
+        }
+        previous_values_name = self._values_name()
+        tmp_path = self.cache_dir / f"index-{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(index, fp)
+        os.replace(tmp_path, self.index_path)
+
+        # Only remove the values file of the replaced index: any other file
+        # may belong to another cache, or to a concurrent writer
+        if previous_values_name is not None and previous_values_name != values_name:
+            (self.cache_dir / previous_values_name).unlink(missing_ok=True)
+
+    def _values_name(self):
+        """ Return the name of the values file of the current index, if any."""
+        try:
+            with open(self.index_path, encoding="utf-8") as fp:
+                name = json.load(fp)["values"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        # Never follow an index outside of the cache directory
+        if not isinstance(name, str) or Path(name).name != name or not name.startswith("values-"):
+            return None
+        return name
+
+    def load(self, jobs=None, errors=None) -> PatchArray:
+        """
+        Load the library, only parsing the files that are new or changed since
+        the cache was written.
+
+        If nothing changed, the returned PatchArray values are memory-mapped
+        from the cache. Otherwise, the cache is updated.
+
+        Files which could not be loaded are reported as errors, w/o being
+        parsed again until they change.
+
+        Parameters
+        ----------
+        jobs : int, optional
+            Number of processes used to parse the files, see load_paths
+        errors : list, optional
+            See load_paths
+        """
+        entries, cached_values, cached_invalid = self.read()
+
+        stats = {}
+        paths = []
+        rows = []
+        names = []
+        to_parse = []
+        invalid = {}
+        for path in iter_prm_paths(self.root):
+            rel_path = path.relative_to(self.root).as_posix()
+            try:
+                st = path.stat()
+            except OSError as e:
+                if errors is None:
+                    raise
+                errors.append((path, e))
+                continue
+            stats[rel_path] = (st.st_mtime_ns, st.st_size)
+
+            entry = entries.get(rel_path)
+            invalid_entry = cached_invalid.get(rel_path)
+            if entry is not None and entry[1:3] == stats[rel_path]:
+                paths.append(path)
+                rows.append(entry[0])
+                names.append(entry[3])
+            elif invalid_entry is not None and invalid_entry[:2] == stats[rel_path]:
+                if errors is None:
+                    raise ValueError(invalid_entry[2])
+                errors.append((path, ValueError(invalid_entry[2])))
+                invalid[rel_path] = invalid_entry
+            else:
+                to_parse.append(path)
+
+        up_to_date = rows == list(range(len(cached_values))) and invalid == cached_invalid
+        if not to_parse and up_to_date:
+            LOGGER.debug("Patch cache %s is up to date", self.cache_dir)
+            return PatchArray(cached_values, names, paths)
+
+        LOGGER.debug("Parsing %d new or changed patches", len(to_parse))
+        parse_errors = None if errors is None else []
+        parsed = load_paths(to_parse, jobs, errors=parse_errors)
+        for path, e in parse_errors or ():
+            errors.append((path, e))
+            rel_path = Path(path).relative_to(self.root).as_posix()
+            # I/O errors may be transient: only remember the invalid files
+            if not isinstance(e, OSError) and rel_path in stats:
+                invalid[rel_path] = (*stats[rel_path], str(e))
+        patches = PatchArray(
+            np.concatenate([cached_values[rows], parsed.values]),
+            names + parsed.names,
+            paths + parsed.paths,
+        )
+
+        try:
+            self.write(patches, stats, invalid)
+        except OSError:
+            LOGGER.warning("Could not write patch cache %s", self.cache_dir, exc_info=True)
+
+        return patches
+
+
+def load_library(root, jobs=None, errors=None, use_cache=True) -> PatchArray:
+    """
+    Load every PRM file found recursively under root.
+
+    If use_cache is True, an on-disk cache is kept next to the library so that
+    only new or changed files are parsed, see PatchCache.
+    """
+    if use_cache:
+        return PatchCache(root).load(jobs, errors)
+    return load_directory(root, jobs, errors=errors)
+
+
+def compute_stats(patches, percentiles=(5, 25, 50, 75, 95), bins=16):
+    """
+    Compute per field statistics over the given patches.
+
+    Everything is derived from the per field value counts, computed in a
+    single pass over the matrix.
+
+    Parameters
+    ----------
+    patches : PatchArray
+        The patches to analyze
+    percentiles : tuple
+        Percentiles to compute, using the nearest rank method
+    bins : int
+        Max number of histogram bins
+
+    Returns
+    -------
+    dict
+        "count": number of patches, "fields": field name -> stats dict, and
+        "double_attributes": the fields going beyond the 0..127 CC range, i.e.
+        what DOUBLE_ATTRIBUTES should be.
+    """
+    n = len(patches)
+    n_fields = len(FIELDS)
+
+    # counts[j, v] is the number of patches with value v for field j
+    offsets = np.arange(n_fields) * 256
+    counts = np.bincount(
+        (patches.values + offsets).ravel(), minlength=n_fields * 256
+    ).reshape(n_fields, 256)
+
+    stats = {"count": n, "fields": {}, "double_attributes": []}
+    if n == 0:
+        return stats
+
+    value_range = np.arange(256)
+    present = counts > 0
+    mins = present.argmax(axis=1)
+    maxs = 255 - present[:, ::-1].argmax(axis=1)
+    means = counts @ value_range / n
+    cumulative = counts.cumsum(axis=1)
+
+    for j, name in enumerate(FIELDS):
+        field_stats = {
+            "min": int(mins[j]),
+            "max": int(maxs[j]),
+            "mean": float(means[j]),
+            "percentiles": {
+                str(q): int(np.searchsorted(cumulative[j], max(q / 100 * n, 1)))
+                for q in percentiles
+            },
+        }
+
+        if name in FIELD_ENUMS:
+            enum_class = FIELD_ENUMS[name]
+            field_stats["values"] = {
+                enum_class(v).name: int(counts[j, v]) for v in np.flatnonzero(counts[j])
+            }
+        else:
+            upper = FIELD_RANGES[name][1] + 1
+            width = -(-upper // bins)
+            starts = np.arange(0, upper, width)
+            field_stats["histogram"] = {
+                "edges": starts.tolist() + [upper],
+                "counts": np.add.reduceat(counts[j, :upper], starts).tolist(),
+            }
+            if maxs[j] > 127:
+                stats["double_attributes"].append(name)
+
+        stats["fields"][name] = field_stats
+
+    return stats
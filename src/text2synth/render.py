@@ -0,0 +1,427 @@
+"""
+Offline software approximation of the JU-06A voice, to audition patches w/o
+the hardware.
+
+Everything is computed on whole buffers w/ numpy:
+
+- oscillators integrate their (modulated) frequency w/ cumsum, and use
+  PolyBLEP to reduce aliasing,
+- the VCF and HPF are applied in the frequency domain on overlapping blocks
+  (STFT), w/ the filter cutoff evaluated once per block,
+- envelopes and LFO are closed form functions of time,
+- the delay is computed one delay length at a time.
+
+The mapping from the patch values to times, frequencies, etc. is an educated
+guess, good enough to compare patches, not an emulation of the hardware.
+"""
+import logging
+import os
+import wave
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .state import (
+    ChorusType, DelaySwitch, EnvPolarity, JU06AState, LFOTrig, LFOWave, OscRange, PolyphonicMode,
+    PortamentoSwitch, PWMModulation, VCAEnvGate
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+SAMPLE_RATE = 44100
+# Notes played by default, as (MIDI note, start, duration), in seconds: a C
+# major chord w/ a bass note
+DEFAULT_NOTES = ((36, 0.0, 1.0), (60, 0.0, 1.0), (64, 0.0, 1.0), (67, 0.0, 1.0))
+# Mix level of each voice, to leave some headroom
+VOICE_LEVEL = 0.2
+
+# STFT block size and hop for the filters, in samples
+_BLOCK = 512
+_HOP = _BLOCK // 4
+# Hann analysis and synthesis windows, normalized for perfect reconstruction
+# at _HOP
+_WINDOW = np.hanning(_BLOCK + 1)[:-1]
+_WINDOW_GAIN = (_WINDOW ** 2).sum() / _HOP
+
+# Octave of each oscillator range, relative to 8'
+_OCTAVES = {OscRange.SIXTEEN: -1, OscRange.EIGHT: 0, OscRange.FOUR: 1}
+# Chorus (rate in Hz, base delay and depth in seconds) of each mode
+_CHORUS = {
+    ChorusType.I: (0.5, 0.0035, 0.0015),
+    ChorusType.II: (0.8, 0.0035, 0.0025),
+    ChorusType.I_AND_II: (8.0, 0.0035, 0.0003),
+}
+# Detune of the stacked voices in unison mode, in semitones
+_UNISON_DETUNE = (-0.08, 0.0, 0.08)
+# Longest tail rendered after the last note, in seconds
+_MAX_TAIL = 4.0
+
+
+def _unit(value, high=255):
+    return value / high
+
+
+def envelope_time(value):
+    """ Attack, decay and release times, in seconds: 1ms to 10s."""
+    return 0.001 * 10 ** (4 * _unit(value))
+
+
+def lfo_rate(value):
+    """ LFO frequency, in Hz: 0.1 to 20Hz."""
+    return 0.1 * 10 ** (2.3 * _unit(value))
+
+
+def cutoff_frequency(value):
+    """ VCF cutoff, in Hz: 20Hz to 20kHz."""
+    return 20 * 2 ** (10 * _unit(value))
+
+
+def note_frequency(note):
+    return 440.0 * 2 ** ((np.asarray(note) - 69) / 12)
+
+
+def adsr(t, gate, attack, decay, sustain, release):
+    """
+    Evaluate the envelope at times t, for a note held during gate seconds.
+
+    The attack is linear, the decay and release exponential, reaching ~2% of
+    their target after their time.
+    """
+    t = np.asarray(t, dtype=np.float64)
+
+    def held(t):
+        rising = t / attack
+        falling = sustain + (1 - sustain) * np.exp(-4 * np.maximum(t - attack, 0) / decay)
+        return np.where(t < attack, rising, falling)
+
+    released = held(gate) * np.exp(-4 * np.maximum(t - gate, 0) / release)
+    return np.where(t < gate, held(t), released)
+
+
+def lfo(t, state, rng):
+    """ Evaluate the LFO at times t, in [-1, 1], including its delay."""
+    phase = lfo_rate(state.lfo_rate) * t
+    frac = phase % 1
+    wave = state.lfo_wave
+    if wave == LFOWave.TRIANGLE:
+        values = 1 - 4 * np.abs(frac - 0.5)
+    elif wave == LFOWave.SQUARE:
+        values = np.where(frac < 0.5, 1.0, -1.0)
+    elif wave == LFOWave.SAWTOOTH_1:
+        values = 2 * frac - 1
+    elif wave == LFOWave.SAWTOOTH_2:
+        values = 1 - 2 * frac
+    elif wave == LFOWave.SIN:
+        values = np.sin(2 * np.pi * phase)
+    else:
+        # Sample and hold, smoothed for RAND_2
+        cycles = np.floor(phase).astype(np.int64)
+        steps = rng.uniform(-1, 1, cycles.max(initial=0) + 2)
+        if wave == LFOWave.RAND_1:
+            values = steps[cycles]
+        else:
+            values = steps[cycles] + (steps[cycles + 1] - steps[cycles]) * frac
+
+    # Delay, then fade in
+    delay = 3 * _unit(state.lfo_delay_time) ** 2
+    if delay > 0:
+        values = values * np.clip((t - delay / 2) / (delay / 2), 0, 1)
+    return values
+
+
+def _polyblep(phase, dt):
+    """ PolyBLEP residual, to subtract from naive discontinuities."""
+    x = phase / dt
+    y = (phase - 1) / dt
+    return np.where(phase < dt, 2 * x - x * x - 1, np.where(phase > 1 - dt, y * y + 2 * y + 1, 0.0))
+
+
+def oscillators(frequency, state, env, lfo_values, rng, sample_rate):
+    """ Mix the DCO waveforms for the given per-sample frequency."""
+    dt = np.minimum(frequency / sample_rate, 0.5)
+    phase = np.cumsum(dt) % 1
+
+    out = np.zeros_like(frequency)
+    if state.saw_sw:
+        out += 2 * phase - 1 - _polyblep(phase, dt)
+
+    if state.sqr_sw:
+        if state.pwm_source == PWMModulation.LFO:
+            modulation = (lfo_values + 1) / 2
+        elif state.pwm_source == PWMModulation.ENV:
+            modulation = env
+        else:
+            modulation = 1.0
+        width = 0.5 - 0.45 * _unit(state.pwm) * modulation
+        out += (
+            np.where(phase < width, 1.0, -1.0)
+            + _polyblep(phase, dt) - _polyblep((phase - width) % 1, dt)
+        )
+
+    if state.sub_sw:
+        # Square one octave down
+        sub_dt = dt / 2
+        sub_phase = np.cumsum(sub_dt) % 1
+        sub = (
+            np.where(sub_phase < 0.5, 1.0, -1.0)
+            + _polyblep(sub_phase, sub_dt) - _polyblep((sub_phase - 0.5) % 1, sub_dt)
+        )
+        out += _unit(state.sub_level) * sub
+
+    if state.noise_level:
+        out += _unit(state.noise_level) * rng.uniform(-1, 1, len(frequency))
+
+    return out
+
+
+def _stft(x):
+    n_blocks = max(1, -(-(len(x) - _BLOCK) // _HOP) + 1)
+    padded = np.zeros((n_blocks - 1) * _HOP + _BLOCK)
+    padded[:len(x)] = x
+    frames = np.lib.stride_tricks.sliding_window_view(padded, _BLOCK)[::_HOP]
+    return np.fft.rfft(frames * _WINDOW, axis=1)
+
+
+def _istft(spectrum, n):
+    frames = np.fft.irfft(spectrum, _BLOCK, axis=1) * _WINDOW / _WINDOW_GAIN
+    out = np.zeros((len(frames) - 1) * _HOP + _BLOCK)
+    for i in range(_BLOCK // _HOP):
+        # Frames i, i + 4, ... do not overlap: add them at once
+        chunk = frames[i::_BLOCK // _HOP].ravel()
+        start = i * _HOP
+        out[start:start + len(chunk)] += chunk[:len(out) - start]
+    return out[:n]
+
+
+def filters(x, cutoff, resonance, hpf, sample_rate):
+    """
+    Apply the VCF, a resonant 4-pole lowpass, and the HPF, a 1-pole
+    highpass, block by block.
+
+    Parameters
+    ----------
+    x : ndarray
+        The signal
+    cutoff : callable
+        Return the VCF cutoff, in Hz, at the given times, in seconds
+    resonance : float
+        Resonance, in [0, 4[, self oscillating at 4
+    hpf : float
+        HPF cutoff, in Hz. No HPF if 0.
+    """
+    # Pad, so that the first and last samples are covered by as many blocks as
+    # the others
+    pad = _BLOCK - _HOP
+    spectrum = _stft(np.concatenate([np.zeros(pad), x, np.zeros(pad)]))
+    times = (np.arange(len(spectrum)) * _HOP + _BLOCK / 2 - pad) / sample_rate
+    frequencies = np.fft.rfftfreq(_BLOCK, 1 / sample_rate)
+
+    fc = np.clip(cutoff(times), 10, sample_rate / 2)[:, None]
+    s = 1j * frequencies / fc
+    # Ladder filter response, w/ the passband loss of the resonance made up
+    response = np.abs((1 + 0.5 * resonance) / ((1 + s) ** 4 + resonance))
+    if hpf > 0:
+        ratio = frequencies / hpf
+        response = response * (ratio / np.sqrt(1 + ratio ** 2))
+
+    return _istft(spectrum * response, pad + len(x))[pad:]
+
+
+def render_voice(state, note, start, gate, glide_from, length, rng, sample_rate):
+    """ Render a single voice, of length samples."""
+    t = np.arange(length) / sample_rate
+
+    attack, decay, release = (envelope_time(v) for v in (state.attack, state.decay, state.release))
+    sustain = _unit(state.sustain)
+    env = adsr(t, gate, attack, decay, sustain, release)
+
+    lfo_t = t if state.lfo_trig == LFOTrig.ON else t + start
+    lfo_values = lfo(lfo_t, state, rng)
+
+    # Pitch, in semitones
+    pitch = np.full(length, float(note + 12 * _OCTAVES[state.osc_range]))
+    if glide_from is not None and state.porta_sw == PortamentoSwitch.ON:
+        tau = 2 * _unit(state.porta_time) ** 2 / 4 + 1e-4
+        pitch += (glide_from - note) * np.exp(-t / tau)
+    pitch += 12 * _unit(state.osc_lfo_mod) ** 2 * lfo_values
+
+    detunes = _UNISON_DETUNE if state.assign_mode == PolyphonicMode.UNISON else (0.0,)
+    x = sum(
+        oscillators(note_frequency(pitch + detune), state, env, lfo_values, rng, sample_rate)
+        for detune in detunes
+    ) / np.sqrt(len(detunes))
+
+    # VCF cutoff modulation, in octaves
+    base = cutoff_frequency(state.cutoff) * 2 ** (_unit(state.flt_key_follow) * (note - 60) / 12)
+    env_mod = 8 * _unit(state.env_mod) * (1 if state.env_polarity == EnvPolarity.POSITIVE else -1)
+    lfo_mod = 3 * _unit(state.flt_lfo_mod)
+
+    def cutoff(times):
+        indices = np.minimum((times * sample_rate).astype(np.int64), length - 1)
+        return base * 2 ** (env_mod * env[indices] + lfo_mod * lfo_values[indices])
+
+    hpf = 20 * 2 ** (6.2 * _unit(state.hpf)) if state.hpf else 0.0
+    x = filters(x, cutoff, 3.9 * _unit(state.resonance), hpf, sample_rate)
+
+    if state.amp_mode == VCAEnvGate.ENV:
+        vca = env
+    else:
+        # Gate, w/ short ramps to avoid clicks
+        ramp = 0.003
+        vca = np.clip(np.minimum(t / ramp, (gate + ramp - t) / ramp), 0, 1)
+    return x * vca * _unit(state.amp_level)
+
+
+def chorus(x, mode, sample_rate):
+    """ Mix the signal w/ a copy delayed by a slowly modulated delay."""
+    if mode == ChorusType.OFF:
+        return x
+    rate, base, depth = _CHORUS[mode]
+    t = np.arange(len(x)) / sample_rate
+    delayed_t = t - base - depth * np.sin(2 * np.pi * rate * t)
+    wet = np.interp(delayed_t, t, x, left=0.0)
+    return (x + wet) / np.sqrt(2)
+
+
+def delay(x, state, sample_rate):
+    """ Feedback delay, computed one delay length at a time."""
+    if state.delay_sw == DelaySwitch.OFF or state.delay_level == 0:
+        return x
+    length = max(1, int(0.05 * 2 ** (4.3 * _unit(state.delay_time, 15)) * sample_rate))
+    feedback = 0.85 * _unit(state.delay_feedback, 15)
+
+    # Delayed signal, y[n] = x[n - length] + feedback * y[n - length]
+    y = np.zeros(len(x))
+    for start in range(length, len(x), length):
+        stop = min(start + length, len(x))
+        y[start:stop] = x[start - length:stop - length] + feedback * y[start - length:stop - length]
+    return x + _unit(state.delay_level, 15) * y
+
+
+def tail_duration(state):
+    """ Return how long the sound lasts after the last note off, in seconds."""
+    tail = envelope_time(state.release) if state.amp_mode == VCAEnvGate.ENV else 0.05
+    if state.delay_sw == DelaySwitch.ON and state.delay_level:
+        period = 0.05 * 2 ** (4.3 * _unit(state.delay_time, 15))
+        feedback = 0.85 * _unit(state.delay_feedback, 15)
+        # Until the echoes are 40dB down
+        repeats = np.log(0.01) / np.log(feedback) if feedback > 0 else 1
+        tail += period * repeats
+    return min(tail, _MAX_TAIL)
+
+
+def render(state: JU06AState, notes=DEFAULT_NOTES, sample_rate=SAMPLE_RATE, seed=0):
+    """
+    Render the given notes played w/ the given patch.
+
+    Parameters
+    ----------
+    state : JU06AState
+        The patch
+    notes : sequence
+        (MIDI note, start, duration) tuples, in seconds
+    sample_rate : int
+        Sample rate, in Hz
+    seed : int
+        Seed of the noise and random LFO, for reproducible renders
+
+    Returns
+    -------
+    ndarray
+        Mono float32 audio, nominally within [-1, 1]
+    """
+    rng = np.random.default_rng(seed)
+    notes = sorted(notes, key=lambda note: note[1])
+    end = max((start + duration for _, start, duration in notes), default=0.0)
+    out = np.zeros(int((end + tail_duration(state)) * sample_rate) + 1)
+
+    previous = None
+    for i, (note, start, duration) in enumerate(notes):
+        if state.assign_mode != PolyphonicMode.POLYPHONIC and i + 1 < len(notes):
+            # Monophonic: the next note cuts this one
+            duration = min(duration, max(notes[i + 1][1] - start, 0.0))
+
+        offset = int(start * sample_rate)
+        length = len(out) - offset
+        if length > 0:
+            out[offset:] += VOICE_LEVEL * render_voice(
+                state, note, start, duration, previous, length, rng, sample_rate
+            )
+        previous = note
+
+    out = chorus(out, state.chorus_sw, sample_rate)
+    out = delay(out, state, sample_rate)
+    return out.astype(np.float32)
+
+
+def _render_one(args):
+    return render(*args)
+
+
+def render_many(states, notes=DEFAULT_NOTES, sample_rate=SAMPLE_RATE, jobs=None):
+    """
+    Render many patches using a pool of processes.
+
+    Parameters
+    ----------
+    states : iterable of JU06AState
+        The patches, e.g. a PatchArray
+    notes : sequence
+        See render
+    sample_rate : int
+        See render
+    jobs : int, optional
+        Number of worker processes. Defaults to the number of CPUs. If 1,
+        patches are rendered in the current process.
+
+    Returns
+    -------
+    list of ndarray
+        The audio of each patch, in the same order as states
+    """
+    jobs = jobs or os.cpu_count()
+    tasks = [(state, notes, sample_rate) for state in states]
+    if jobs == 1:
+        return [_render_one(task) for task in tasks]
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(_render_one, tasks, chunksize=max(1, len(tasks) // (4 * jobs))))
+
+
+def write_wav(path, audio, sample_rate=SAMPLE_RATE):
+    """ Write mono audio in [-1, 1] as a 16 bits PCM wav file."""
+    pcm = (np.clip(audio, -1, 1) * 32767).astype("<i2")
+    with wave.open(str(path), "wb") as fp:
+        fp.setnchannels(1)
+        fp.setsampwidth(2)
+        fp.setframerate(sample_rate)
+        fp.writeframes(pcm.tobytes())
+
+
+def read_wav(path):
+    """
+    Read a PCM wav file, mixed down to mono.
+
+    Returns
+    -------
+    audio : ndarray
+        float32 samples in [-1, 1]
+    sample_rate : int
+    """
+    with wave.open(str(path), "rb") as fp:
+        channels, width, sample_rate = fp.getnchannels(), fp.getsampwidth(), fp.getframerate()
+        data = fp.readframes(fp.getnframes())
+
+    if width == 1:
+        pcm = np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128
+    elif width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        pcm = (raw[:, 0].astype(np.int32) << 8 | raw[:, 1].astype(np.int32) << 16
+               | raw[:, 2].astype(np.int8).astype(np.int32) << 24).astype(np.float32) / 256
+    elif width in (2, 4):
+        pcm = np.frombuffer(data, dtype=f"<i{width}").astype(np.float32)
+    else:
+        raise ValueError(f"Unsupported sample width: {width}")
+    audio = pcm.reshape(-1, channels).mean(axis=1) / 2 ** (8 * width - 1)
+    return audio.astype(np.float32), sample_rate
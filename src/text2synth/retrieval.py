@@ -0,0 +1,309 @@
+import math
+import re
+
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from .patches import COLUMNS, FIELDS, PatchArray
+from .state import (
+    FIELD_ENUMS, FIELD_RANGES, ChorusType, DelaySwitch, JU06AState, OscRange, PolyphonicMode,
+    VCAEnvGate
+)
+
+
+# Words from descriptions mapped to the tags used in the index
+SYNONYMS = {
+    "basses": "bass",
+    "bassline": "bass",
+    "sub": "bass",
+    "low": "bass",
+    "pads": "pad",
+    "plucky": "pluck",
+    "plucked": "pluck",
+    "plucks": "pluck",
+    "stab": "pluck",
+    "stabs": "pluck",
+    "strings": "string",
+    "leads": "lead",
+    "mono": "lead",
+    "solo": "lead",
+    "brasses": "brass",
+    "horn": "brass",
+    "horns": "brass",
+    "keys": "key",
+    "piano": "key",
+    "organs": "organ",
+    "bells": "bell",
+    "brighter": "bright",
+    "sharp": "bright",
+    "harsh": "bright",
+    "dull": "dark",
+    "mellow": "dark",
+    "warm": "dark",
+    "darker": "dark",
+    "soft": "slow",
+    "swell": "slow",
+    "ambient": "slow",
+    "percussive": "short",
+    "snappy": "short",
+    "squelchy": "resonant",
+    "acid": "resonant",
+    "wobble": "modulated",
+    "vibrato": "modulated",
+    "wobbly": "modulated",
+    "echo": "delay",
+    "spacious": "delay",
+    "lush": "chorus",
+    "wide": "chorus",
+    "noisy": "noise",
+    "fx": "noise",
+}
+
+_WORD_RE = re.compile(r"[a-z]+|[0-9]+")
+
+
+def tokenize(text):
+    """ Split text into lower case words, mapped through SYNONYMS."""
+    # Split camel case, e.g. "FatBass" -> "Fat Bass"
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text).lower()
+    return [SYNONYMS.get(word, word) for word in _WORD_RE.findall(text)]
+
+
+def parameter_tags(patches):
+    """
+    Derive descriptive tags from the patch parameters.
+
+    Returns
+    -------
+    dict
+        Tag -> boolean mask of the patches it applies to
+    """
+    def col(name):
+        return patches.column(name).astype(np.int16)
+
+    attack, decay, sustain, release = col("attack"), col("decay"), col("sustain"), col("release")
+    cutoff, resonance = col("cutoff"), col("resonance")
+
+    return {
+        "bass": (col("osc_range") == OscRange.SIXTEEN) | (col("sub_level") > 160),
+        "pad": (attack > 100) & (release > 100) & (sustain > 100),
+        "pluck": (attack < 20) & (sustain < 60) & (decay < 140),
+        "short": (attack < 10) & (sustain < 60) & (release < 60),
+        "slow": attack > 120,
+        "bright": cutoff > 180,
+        "dark": cutoff < 80,
+        "resonant": resonance > 150,
+        "lead": np.isin(col("assign_mode"), [PolyphonicMode.SOLO, PolyphonicMode.UNISON]),
+        "brass": (attack > 15) & (attack < 90) & (col("env_mod") > 80) & (col("saw_sw") == 1),
+        "string": (col("saw_sw") == 1) & (attack > 40) & (col("chorus_sw") != ChorusType.OFF),
+        "organ": col("amp_mode") == VCAEnvGate.GATE,
+        "modulated": (col("osc_lfo_mod") > 40) | (col("flt_lfo_mod") > 60),
+        "noise": col("noise_level") > 100,
+        "chorus": col("chorus_sw") != ChorusType.OFF,
+        "delay": col("delay_sw") == DelaySwitch.ON,
+    }
+
+
+class PatchIndex:
+    """
+    Local lexical index of a patch library, to find the patches most relevant
+    to a description.
+
+    Every patch is indexed as a document made of the words of its name and
+    path, and of tags derived from its parameters (see parameter_tags), ranked
+    with BM25.
+
+    Parameters
+    ----------
+    patches : PatchArray
+        The patches to index
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, patches: PatchArray):
+        self.patches = patches
+        n = len(patches)
+
+        documents = [Counter() for _ in range(n)]
+        for i, (name, path) in enumerate(zip(patches.names, patches.paths)):
+            text = " ".join(
+                [name or ""] + ([*Path(path).parent.parts[-2:], Path(path).stem] if path else [])
+            )
+            documents[i].update(tokenize(text))
+        for tag, mask in parameter_tags(patches).items():
+            for i in np.flatnonzero(mask):
+                documents[i][tag] += 1
+
+        # Token -> (patch indices, term frequencies)
+        postings = defaultdict(lambda: ([], []))
+        for i, document in enumerate(documents):
+            for token, tf in document.items():
+                postings[token][0].append(i)
+                postings[token][1].append(tf)
+        self._postings = {
+            token: (np.array(indices), np.array(tfs, dtype=np.float64))
+            for token, (indices, tfs) in postings.items()
+        }
+
+        self._lengths = np.array([sum(document.values()) for document in documents],
+                                 dtype=np.float64)
+        self._avg_length = self._lengths.mean() if n else 0.0
+
+    def __len__(self):
+        return len(self.patches)
+
+    def scores(self, description):
+        """ Return the BM25 score of every patch for the given description."""
+        n = len(self)
+        scores = np.zeros(n)
+        for token in set(tokenize(description)):
+            if token not in self._postings:
+                continue
+            indices, tfs = self._postings[token]
+            idf = math.log(1 + (n - len(indices) + 0.5) / (len(indices) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[indices] / self._avg_length)
+            scores[indices] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        return scores
+
+    def search(self, description, k=10):
+        """
+        Return the indices of the k patches most relevant to description, best
+        first.
+
+        If fewer than k patches match, the remaining ones are spread over the
+        library, so that the examples stay diverse.
+        """
+        k = min(k, len(self))
+        scores = self.scores(description)
+
+        matching = np.flatnonzero(scores > 0)
+        # Stable sort, so that ties keep the library order
+        best = matching[np.argsort(-scores[matching], kind="stable")][:k]
+        if len(best) == k:
+            return best
+
+        others = np.setdiff1d(np.arange(len(self)), best)
+        spread = others[np.linspace(0, len(others) - 1, k - len(best)).astype(int)]
+        return np.concatenate([best, spread])
+
+
+# Field -> weight in the distance between patches, fields not listed weigh 1
+DEFAULT_FIELD_WEIGHTS = {
+    # Output level does not change the character of the sound
+    "amp_level": 0.25,
+}
+
+
+def _compile_embedding(weights):
+    """
+    Compile the embedding of patches for the given field weights, as
+    (numeric columns, offsets, scales, enum columns, enum values, enum scales).
+
+    Numeric fields are normalized by their range. Enum fields are one-hot
+    encoded, each value scaled by sqrt(weight / 2), so that two different
+    values are at a (squared) distance of weight.
+    """
+    numeric = [name for name in FIELDS if name in FIELD_RANGES]
+    offsets = np.array([FIELD_RANGES[name][0] for name in numeric], dtype=np.float32)
+    scales = np.array(
+        [math.sqrt(weights.get(name, 1.0)) / (FIELD_RANGES[name][1] - FIELD_RANGES[name][0])
+         for name in numeric],
+        dtype=np.float32,
+    )
+
+    enum_columns, enum_values, enum_scales = [], [], []
+    for name in FIELDS:
+        if name in FIELD_ENUMS:
+            for value in FIELD_ENUMS[name]:
+                enum_columns.append(COLUMNS[name])
+                enum_values.append(int(value))
+                enum_scales.append(math.sqrt(weights.get(name, 1.0) / 2))
+
+    return (
+        np.array([COLUMNS[name] for name in numeric]), offsets, scales,
+        np.array(enum_columns), np.array(enum_values), np.array(enum_scales, dtype=np.float32),
+    )
+
+
+class SimilarityIndex:
+    """
+    Index of a patch library over the parameter space, to find the patches
+    closest to a given one.
+
+    The distance between patches is a weighted euclidean distance: numeric
+    fields are normalized to [0, 1] from their declared range (see
+    FIELD_RANGES), and enum fields add their weight when different, nothing
+    otherwise.
+
+    Patches are embedded so that this is the euclidean distance between
+    embeddings, and a query is a single matrix-vector product over the
+    library.
+
+    Parameters
+    ----------
+    patches : PatchArray
+        The patches to index
+    weights : dict, optional
+        Field -> weight, overriding DEFAULT_FIELD_WEIGHTS. A weight of 0
+        ignores the field.
+    """
+    def __init__(self, patches: PatchArray, weights=None):
+        unknown = set(weights or {}) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        self.patches = patches
+        self.weights = {**DEFAULT_FIELD_WEIGHTS, **(weights or {})}
+        self._embedding = _compile_embedding(self.weights)
+
+        self._embeddings = self.embed(patches.values)
+        self._norms = np.einsum("ij,ij->i", self._embeddings, self._embeddings)
+
+    def __len__(self):
+        return len(self.patches)
+
+    def embed(self, values):
+        """ Embed the given (n_patches, n_fields) rows."""
+        columns, offsets, scales, enum_columns, enum_values, enum_scales = self._embedding
+        values = np.asarray(values).reshape(-1, len(FIELDS))
+        numeric = (values[:, columns].astype(np.float32) - offsets) * scales
+        one_hot = (values[:, enum_columns] == enum_values) * enum_scales
+        return np.hstack([numeric, one_hot.astype(np.float32)])
+
+    def search(self, query, k=10):
+        """
+        Return the k patches closest to the query, closest first.
+
+        Parameters
+        ----------
+        query : JU06AState or array-like
+            The patch, or its PatchArray row
+        k : int
+            Number of patches to return
+
+        Returns
+        -------
+        indices : ndarray
+            Indices of the closest patches
+        distances : ndarray
+            Their distance to the query
+        """
+        if isinstance(query, JU06AState):
+            query = PatchArray.from_states([query]).values
+        q = self.embed(query)[0]
+
+        k = min(k, len(self))
+        if k == 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.float32)
+
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2
+        d2 = np.maximum(self._norms - 2 * (self._embeddings @ q) + q @ q, 0)
+        best = np.argpartition(d2, k - 1)[:k]
+        # The expansion above loses precision for close patches, recompute
+        # the distances of the selected ones directly
+        d2 = ((self._embeddings[best] - q) ** 2).sum(axis=1)
+        # Ties keep the library order
+        order = np.lexsort((best, d2))
+        return best[order], np.sqrt(d2[order])
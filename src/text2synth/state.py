@@ -1,12 +1,15 @@
-import re
+import csv
+import io
 
 from enum import IntEnum, verify, UNIQUE
+from pathlib import Path
 from typing import Self
 
 import mido
 
-from pydantic import BaseModel, ConfigDict, Field
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
 
+from .metrics import timed
 from .synths import JU_A6_A
 
 
@@ -212,69 +215,75 @@ class JU06AState(BaseModel):
 
     @classmethod
     def from_file(cls, fp) -> Self:
-        parsed_values = {}
+        with timed("prm.parse"):
+            values, _ = parse_prm(fp.read())
+        with timed("state.validate"):
+            return cls.model_validate(values)
 
-        lines = [line.strip() for line in fp.readlines() if line.strip()]
+    @classmethod
+    def load_many(cls, paths, batch_size=1024, errors=None) -> list[Self]:
+        """
+        Load many PRM files at once.
 
-        for i, line in enumerate(lines):
-            # Match pattern: "PARAMETER (value);" or "PARAMETER(value);"
-            match = re.match(r'^(.+?)\s*\((.+?)\)\s*;?$', line)
-            if not match:
-                continue
+        Files are parsed into plain dicts first, which are then validated in
+        batches, which is much faster than calling from_path for each file.
 
-            attr_name_raw = match.group(1).strip()
-            value_raw = match.group(2).strip()
+        Parameters
+        ----------
+        paths : iterable
+            Paths of the PRM files
+        batch_size : int
+            Number of patches validated at once
+        errors : list, optional
+            If given, (path, exception) tuples are appended for the files that
+            could not be loaded, and those files are skipped. Otherwise, the
+            first error is raised.
 
-            # Convert attribute name to Python convention
-            attr_name = attr_name_raw.lower().replace(' ', '_')
+        Returns
+        -------
+        list[JU06AState]
+            The loaded states, in the same order as paths
+        """
+        states = []
+
+        batch_paths = []
+        batch_values = []
+
+        def flush():
+            try:
+                with timed("state.validate"):
+                    states.extend(_STATE_LIST_ADAPTER.validate_python(batch_values))
+            except ValidationError:
+                if errors is None:
+                    raise
+                # Find out which patch is wrong
+                for path, values in zip(batch_paths, batch_values):
+                    try:
+                        states.append(cls.model_validate(values))
+                    except ValidationError as e:
+                        errors.append((path, e))
+            batch_paths.clear()
+            batch_values.clear()
+
+        for path in paths:
+            try:
+                with open(path, 'r', encoding='ascii') as fp, timed("prm.parse"):
+                    values, _ = parse_prm(fp.read())
+            except (OSError, ValueError) as e:
+                if errors is None:
+                    raise
+                errors.append((path, e))
+                continue
 
-            # Determine if this is the last row (PATCH_NAME)
-            is_last_row = (i == len(lines) - 1)
+            batch_paths.append(path)
+            batch_values.append(values)
+            if len(batch_values) >= batch_size:
+                flush()
 
-            # Parse value: string for last row, integer for others
-            if is_last_row:
-                value = value_raw
-            else:
-                value = int(value_raw)
-
-            parsed_values[attr_name] = value
-
-        return cls(
-            osc_range=OscRange(parsed_values["osc_range"]),
-            osc_lfo_mod=parsed_values["osc_lfo_mod"],
-            pwm=parsed_values["pwm"],
-            pwm_source=PWMModulation(parsed_values["pwm_source"]),
-            sqr_sw=SquareSwitch(parsed_values["sqr_sw"]),
-            saw_sw=SawSwitch(parsed_values["saw_sw"]),
-            sub_level=parsed_values["sub_level"],
-            sub_sw=SubSwitch(parsed_values["sub_sw"]),
-            noise_level=parsed_values["noise_level"],
-            lfo_rate=parsed_values["lfo_rate"],
-            lfo_delay_time=parsed_values["lfo_delay_time"],
-            lfo_wave=LFOWave(parsed_values["lfo_wave"]),
-            lfo_trig=LFOTrig(parsed_values["lfo_trig"]),
-            hpf=parsed_values["hpf"],
-            cutoff=parsed_values["cutoff"],
-            resonance=parsed_values["resonance"],
-            env_polarity=EnvPolarity(parsed_values["env_polarity"]),
-            env_mod=parsed_values["env_mod"],
-            flt_lfo_mod=parsed_values["flt_lfo_mod"],
-            flt_key_follow=parsed_values["flt_key_follow"],
-            amp_mode=VCAEnvGate(parsed_values["amp_mode"]),
-            amp_level=parsed_values["amp_level"],
-            attack=parsed_values["attack"],
-            decay=parsed_values["decay"],
-            sustain=parsed_values["sustain"],
-            release=parsed_values["release"],
-            delay_time=parsed_values["delay_time"],
-            delay_feedback=parsed_values["delay_feedback"],
-            delay_sw=DelaySwitch(parsed_values["delay_sw"]),
-            delay_level=parsed_values["delay_level"],
-            chorus_sw=ChorusType(parsed_values["chorus_sw"]),
-            porta_time=parsed_values["porta_time"],
-            porta_sw=parsed_values["porta_sw"],
-            assign_mode=PolyphonicMode(parsed_values["assign_mode"]),
-        )
+        if batch_values:
+            flush()
+
+        return states
 
     def to_path(self, path, patch_name="NEW PATCH"):
         """
@@ -346,32 +355,338 @@ class JU06AState(BaseModel):
 
         fp.write('\r\n'.join(lines))
 
+    def to_compact_row(self, patch_name="NEW PATCH"):
+        """
+        Serialize the state as a single CSV row, for LLM prompts.
+
+        Values are in the COMPACT_HEADER order, w/ enums as their int value,
+        and the patch name last. This takes about 4 times fewer tokens than
+        the PRM format.
+
+        Parameters
+        ----------
+        patch_name : str
+            Name for the patch.
+        """
+        values = self.__dict__
+        return _format_csv_row([int(values[name]) for name in FIELDS] + [patch_name])
+
+    @classmethod
+    def from_compact_row(cls, row) -> Self:
+        """ Create from a row created by `to_compact_row`. The patch name is
+        ignored.
+        """
+        values = next(csv.reader([row]))
+        if len(values) != len(FIELDS) + 1:
+            raise ValueError(f"Expected {len(FIELDS) + 1} values, got {len(values)}")
+        return cls.model_validate(
+            {name: int(value) for name, value in zip(FIELDS, values)}
+        )
+
     def attribute_to_patch_key(self, attribute):
         """ Convert the given attribute name into the key used in .PRN files.
         """
         return attribute.replace("_", " ").upper()
 
+    def apply_updates(self, updates) -> set[str]:
+        """
+        Update many fields at once, w/o pydantic's validation of each
+        assignment.
+
+        Int values are only checked against the bounds and enum values of
+        their field, see FIELD_RANGES and FIELD_ENUMS. Other values, e.g.
+        strings, and invalid values go through pydantic, so that errors are
+        the same as for setattr. Either every field is updated, or none.
+
+        Parameters
+        ----------
+        updates : dict
+            Field name -> new value
+
+        Returns
+        -------
+        set[str]
+            The fields whose value changed
+
+        Raises
+        ------
+        ValidationError
+            Listing every invalid field
+        """
+        values = {}
+        errors = []
+        for name, value in updates.items():
+            if isinstance(value, int):
+                members = _ENUM_MEMBERS.get(name)
+                if members is not None:
+                    member = members.get(value)
+                    if member is not None:
+                        values[name] = member
+                        continue
+                elif name in FIELD_RANGES:
+                    low, high = FIELD_RANGES[name]
+                    if low <= value <= high:
+                        values[name] = int(value)
+                        continue
+
+            # Slow path, for coercion and errors
+            scratch = self.model_construct()
+            try:
+                setattr(scratch, name, value)
+            except ValidationError as e:
+                errors.extend(
+                    {key: error[key] for key in ("type", "loc", "input", "ctx") if key in error}
+                    for error in e.errors()
+                )
+            else:
+                values[name] = scratch.__dict__[name]
+
+        if errors:
+            raise ValidationError.from_exception_data(type(self).__name__, errors)
+
+        current = self.__dict__
+        changed = {name for name, value in values.items() if name not in current or current[name] != value}
+        current.update(values)
+        self.__pydantic_fields_set__.update(values)
+        return changed
+
+    def cc_values(self):
+        """ Create the list of (cc, value) pairs that when sent to the synth,
+        will update the synth to the current state.
+        """
+        # Bypass getattr, fields are stored in the instance dict
+        values = self.__dict__
+        return [(cc, scale(values[attribute])) for attribute, cc, scale in CC_ENCODER]
+
     def to_cc_messages(self):
         """ Create a list of MIDI messages that when applied to the synth, will
         update the synth to the current state.
         """
-        messages = []
-        for data in JU_A6_A.values():
-            cc = data["cc"]
-
-            patch_attribute = data["patch_attribute"]
-            value = getattr(self, patch_attribute)
-            if patch_attribute in DOUBLE_ATTRIBUTES:
-                cc_value = value // 2
-            elif isinstance(value, IntEnum):
-                if isinstance(value, PortamentoSwitch):
-                    # cc value [0, 63[ -> off, [63-128[ -> on
-                    cc_value = 63 * value
-                else:
-                    cc_value = value
+        with timed("cc.encode"):
+            return [
+                mido.Message("control_change", control=cc, value=value)
+                for cc, value in self.cc_values()
+            ]
+
+    def field_cc_messages(self, names):
+        """ Create the MIDI messages updating only the given fields on the
+        synth, in the same order as `to_cc_messages`.
+
+        Only the given fields are read, so this also works on partial states,
+        e.g. created w/ `model_construct` while a patch is being generated.
+        """
+        names = set(names)
+        values = self.__dict__
+        with timed("cc.encode"):
+            return [
+                mido.Message("control_change", control=cc, value=scale(values[attribute]))
+                for attribute, cc, scale in CC_ENCODER
+                if attribute in names
+            ]
+
+    def to_cc_bytes(self, channel=0, running_status=True):
+        """ Encode the CC messages returned by `to_cc_messages` as a raw MIDI
+        byte stream.
+
+        Parameters
+        ----------
+        channel : int
+            MIDI channel, 0-based
+        running_status : bool
+            If True, the status byte is only written once, as every message
+            shares the same one. This makes the stream about a third shorter.
+
+        Returns
+        -------
+        bytes
+            The MIDI stream
+        """
+        status = CC_STATUS[channel]
+        buf = bytearray()
+        with timed("cc.encode"):
+            if running_status:
+                buf.append(status)
+                for cc, value in self.cc_values():
+                    buf += bytes((cc, value))
             else:
-                cc_value = value
+                for cc, value in self.cc_values():
+                    buf += bytes((status, cc, value))
+        return bytes(buf)
+
+    def to_midi_path(self, path, channel=0):
+        """ Save the CC messages for the state into a file, for offline use.
+
+        Parameters
+        ----------
+        path : str or Path
+            Output path. If it ends with .mid, a standard MIDI file is written
+            with every message at time 0. Otherwise, e.g. for .bin files, the
+            raw byte stream from `to_cc_bytes` is written, which is what tools
+            like `amidi -s` send as is. As the stream is not SysEx, .syx files
+            are refused.
+        channel : int
+            MIDI channel, 0-based
+        """
+        suffix = Path(path).suffix.lower()
+        if suffix == ".syx":
+            raise ValueError(f"CC messages cannot be saved as SysEx, use .mid or .bin: {path}")
+        if suffix == ".mid":
+            track = mido.MidiTrack(msg.copy(channel=channel) for msg in self.to_cc_messages())
+            mido.MidiFile(tracks=[track]).save(path)
+        else:
+            with open(path, "wb") as fp:
+                fp.write(self.to_cc_bytes(channel))
+
+    @classmethod
+    def diff_cc_messages(cls, old, new):
+        """ Create the list of MIDI messages needed to move the synth from the
+        `old` state to the `new` state.
+
+        Only the CC whose value on the wire differs between both states are
+        returned, in the same order as `to_cc_messages`.
+
+        Parameters
+        ----------
+        old : JU06AState or None
+            State last sent to the synth. If None, the synth state is unknown
+            and every CC message is returned.
+        new : JU06AState
+            Target state.
+
+        Returns
+        -------
+        list[mido.Message]
+            The messages to send
+        """
+        if old is None:
+            return new.to_cc_messages()
 
-            messages.append(mido.Message("control_change", control=cc, value=cc_value))
+        with timed("cc.encode"):
+            return [
+                mido.Message("control_change", control=cc, value=value)
+                for (cc, value), old_cc_value in zip(new.cc_values(), old.cc_values())
+                if (cc, value) != old_cc_value
+            ]
 
-        return messages
+
+def _field_range(field_info):
+    """ Return the (min, max) allowed values of the given int field, from its
+    Field(ge=..., le=...) metadata.
+    """
+    range_parts = [None, None]
+    for m in field_info.metadata:
+        if hasattr(m, "ge"):
+            range_parts[0] = m.ge
+        if hasattr(m, "le"):
+            range_parts[1] = m.le
+    return tuple(range_parts)
+
+
+# Field names, in declaration order. Column order of the compact CSV format,
+# see JU06AState.to_compact_row, and of PatchArray.values
+FIELDS = tuple(JU06AState.model_fields)
+# Field name -> enum class, for enum fields
+FIELD_ENUMS = {
+    name: field_info.annotation
+    for name, field_info in JU06AState.model_fields.items()
+    if issubclass(field_info.annotation, IntEnum)
+}
+# Field name -> (min, max), for int fields
+FIELD_RANGES = {
+    name: _field_range(field_info)
+    for name, field_info in JU06AState.model_fields.items()
+    if name not in FIELD_ENUMS
+}
+# Field name -> {value: member}, for enum fields
+_ENUM_MEMBERS = {name: {member.value: member for member in enum} for name, enum in FIELD_ENUMS.items()}
+
+
+def _halve(value):
+    return value // 2
+
+
+def _portamento_switch(value):
+    # cc value [0, 63[ -> off, [63-128[ -> on
+    return 63 * value
+
+
+def _compile_cc_encoder(definition):
+    """ Compile the given synth CC definition into a tuple of
+    (patch attribute, cc number, scale function), one per CC.
+
+    The scale function converts the attribute value from the UI model into the
+    CC value.
+    """
+    encoder = []
+    for data in definition.values():
+        attribute = data["patch_attribute"]
+        if attribute in DOUBLE_ATTRIBUTES:
+            scale = _halve
+        elif JU06AState.model_fields[attribute].annotation is PortamentoSwitch:
+            scale = _portamento_switch
+        else:
+            # Also converts enums to plain int
+            scale = int
+        encoder.append((attribute, data["cc"], scale))
+    return tuple(encoder)
+
+
+CC_ENCODER = _compile_cc_encoder(JU_A6_A)
+# Control change status byte, indexed by channel
+CC_STATUS = tuple(0xB0 | channel for channel in range(16))
+
+
+# PRM keyword -> JU06AState field, e.g. "LFO DELAY TIME" -> "lfo_delay_time"
+PRM_KEYWORDS = {
+    name.replace("_", " ").upper(): name for name in JU06AState.model_fields
+}
+PATCH_NAME_KEYWORD = "PATCH_NAME"
+
+_STATE_LIST_ADAPTER = TypeAdapter(list[JU06AState])
+
+# Header of the compact CSV format, see JU06AState.to_compact_row
+COMPACT_HEADER = ",".join(FIELDS + ("patch_name",))
+
+
+def _format_csv_row(values):
+    fp = io.StringIO()
+    csv.writer(fp, lineterminator="").writerow(values)
+    return fp.getvalue()
+
+
+def parse_prm(content):
+    """
+    Parse the content of a PRM file into a dict of raw values.
+
+    Parameters
+    ----------
+    content : str
+        Content of the PRM file, as lines formatted like "LFO RATE (40);"
+
+    Returns
+    -------
+    values : dict
+        Field name -> int value, for every keyword matching a JU06AState
+        field. Values are not validated.
+    patch_name : str or None
+        The patch name, if any
+    """
+    values = {}
+    patch_name = None
+
+    for line in content.splitlines():
+        keyword, sep, rest = line.partition("(")
+        if not sep:
+            continue
+        keyword = keyword.strip()
+        value, sep, _ = rest.rpartition(")")
+        if not sep:
+            continue
+
+        field = PRM_KEYWORDS.get(keyword)
+        if field is not None:
+            values[field] = int(value)
+        elif keyword == PATCH_NAME_KEYWORD:
+            patch_name = value.strip()
+
+    return values, patch_name
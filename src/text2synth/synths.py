@@ -1,3 +1,8 @@
+# MIDI link limits of the JU-06A, used to rate limit the messages sent to it.
+# 5-pin DIN MIDI runs at 31250 bauds, i.e. 3125 bytes/s. The burst is kept
+# small enough not to overflow the device input buffer.
+JU_A6_A_LINK = {"bytes_per_second": 3125, "burst_bytes": 48}
+
 JU_A6_A = {
     # 0 -> 16, 1 -> 8, 2 -> 4
     "dco.range": {"cc": 12, "min": 0, "max": 2, "patch_attribute": "osc_range"},
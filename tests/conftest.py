@@ -0,0 +1,26 @@
+import pathlib
+
+import pytest
+
+from text2synth.state import JU06AState
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+@pytest.fixture
+def write_patches():
+    """ Return a function writing n variations of pad.prm in a directory, w/
+    cutoff i for the i-th patch, and returning their paths.
+    """
+    def _write_patches(directory, n):
+        state = JU06AState.from_path(str(PAD_PRM))
+        paths = []
+        for i in range(n):
+            state.cutoff = i % 256
+            path = directory / f"patch{i}.PRM"
+            state.to_path(path, f"PATCH {i}")
+            paths.append(path)
+        return paths
+
+    return _write_patches
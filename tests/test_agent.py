@@ -0,0 +1,277 @@
+import asyncio
+import json
+import pathlib
+
+import pytest
+
+from pydantic_ai.messages import ModelResponse, SystemPromptPart, ToolCallPart
+from pydantic_ai.models.function import DeltaToolCall, FunctionModel
+
+from text2synth.agent import (
+    PatchGenerator, ResultCache, complete_fields, create_agent, generate_batch, patch_filename,
+    read_descriptions
+)
+from text2synth.patches import PatchArray
+from text2synth.state import JU06AState
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+def _library():
+    state = JU06AState.from_path(str(PAD_PRM))
+    states, names = [], []
+    for i, name in enumerate(["Warm Pad", "Fat Bass", "Mono Lead", "Bell", "Brass"]):
+        state.cutoff = 50 * i
+        states.append(state.model_copy())
+        names.append(name)
+    return PatchArray.from_states(states, names)
+
+
+class _StubModel:
+    """ Local stub LLM, returning the pad patch and recording its calls."""
+    def __init__(self):
+        self.requests = []
+        self.chunks = []
+        self.model = FunctionModel(self.respond, stream_function=self.stream, model_name="stub")
+
+    def respond(self, messages, info):
+        self.requests.append(messages)
+        state = JU06AState.from_path(str(PAD_PRM))
+        return ModelResponse(parts=[
+            ToolCallPart(info.output_tools[0].name, state.model_dump(mode="json")),
+        ])
+
+    async def stream(self, messages, info):
+        """ Stream the pad patch arguments in small chunks."""
+        self.requests.append(messages)
+        args = json.dumps(JU06AState.from_path(str(PAD_PRM)).model_dump(mode="json"))
+        for i in range(0, len(args), 7):
+            self.chunks.append(args[i:i + 7])
+            name = info.output_tools[0].name if i == 0 else None
+            yield {0: DeltaToolCall(name=name, json_args=args[i:i + 7])}
+
+    def system_prompt(self, i):
+        return "".join(
+            part.content for part in self.requests[i][0].parts if isinstance(part, SystemPromptPart)
+        )
+
+
+class TestPatchGenerator:
+    def test_generate(self):
+        # Given
+        stub = _StubModel()
+        generator = PatchGenerator(stub.model, _library(), top_k=1)
+
+        # When
+        state = asyncio.run(generator.generate("a fat bass"))
+
+        # Then
+        assert state == JU06AState.from_path(str(PAD_PRM))
+        assert len(stub.requests) == 1
+        assert "Fat Bass" in generator.build_prompt("a fat bass")
+        assert "Description: a fat bass" in generator.build_prompt("a fat bass")
+
+    def test_static_system_prompt(self):
+        # Given
+        stub = _StubModel()
+        generator = PatchGenerator(stub.model, _library(), top_k=1, prefix_k=2)
+
+        # When
+        asyncio.run(generator.generate("a fat bass"))
+        asyncio.run(generator.generate("a mono lead"))
+
+        # Then
+        assert stub.system_prompt(0) == stub.system_prompt(1) == generator.system_prompt
+        assert generator.system_prompt.count("\n") > 2
+
+    def test_result_cache(self, tmp_path):
+        # Given
+        stub = _StubModel()
+        path = tmp_path / "results.jsonl"
+        asyncio.run(PatchGenerator(stub.model, _library(), result_cache=ResultCache(path))
+                    .generate("a fat bass"))
+
+        # When
+        generator = PatchGenerator(stub.model, _library(), result_cache=ResultCache(path))
+        state = asyncio.run(generator.generate("a fat bass"))
+        asyncio.run(generator.generate("a mono lead"))
+
+        # Then
+        assert state == JU06AState.from_path(str(PAD_PRM))
+        # Only the new description hit the model
+        assert len(stub.requests) == 2
+        assert len(ResultCache(path)) == 2
+
+    def test_result_cache_append(self, tmp_path):
+        # Given
+        path = tmp_path / "results.jsonl"
+        state = JU06AState.from_path(str(PAD_PRM))
+        ResultCache(path).put("a", state)
+        # e.g. another process
+        other = ResultCache(path)
+        ResultCache(path).put("b", state)
+
+        # When
+        other.put("c", state)
+        # Truncated by a crash
+        with open(path, "a") as fp:
+            fp.write('["d", "1,')
+
+        # Then
+        cache = ResultCache(path)
+        assert len(cache) == 3
+        assert cache.get("b") == state
+        assert len(path.read_text().splitlines()) == 4
+
+    def test_result_cache_examples(self):
+        # Given
+        stub = _StubModel()
+        result_cache = ResultCache()
+        library = _library()
+
+        # When
+        asyncio.run(PatchGenerator(stub.model, library, result_cache=result_cache)
+                    .generate("a fat bass"))
+        asyncio.run(PatchGenerator(stub.model, library.select([0, 1]), result_cache=result_cache)
+                    .generate("a fat bass"))
+
+        # Then
+        # Different examples, different key
+        assert len(stub.requests) == 2
+
+
+class TestGenerateStream:
+    def test_stream(self):
+        # Given
+        stub = _StubModel()
+        generator = PatchGenerator(stub.model, _library())
+        updates = []
+
+        async def on_fields(state, names):
+            updates.append((len(stub.chunks), {name: state.__dict__[name] for name in names}))
+
+        # When
+        state = asyncio.run(generator.generate_stream("a warm pad", on_fields))
+
+        # Then
+        expected = JU06AState.from_path(str(PAD_PRM))
+        assert state == expected
+        # Fields are sent as they arrive
+        assert len(updates) > 10
+        assert updates[0][0] < len(stub.chunks) // 4
+        # Every field is sent once
+        received = {}
+        for _, fields in updates:
+            assert not (fields.keys() & received.keys())
+            received.update(fields)
+        assert received == dict(expected)
+
+    def test_cached(self):
+        # Given
+        stub = _StubModel()
+        generator = PatchGenerator(stub.model, _library())
+        asyncio.run(generator.generate("a warm pad"))
+        updates = []
+
+        async def on_fields(state, names):
+            updates.append(names)
+
+        # When
+        state = asyncio.run(generator.generate_stream("a warm pad", on_fields))
+
+        # Then
+        assert state == JU06AState.from_path(str(PAD_PRM))
+        assert updates == [set(JU06AState.model_fields)]
+        assert len(stub.requests) == 1
+
+    def test_complete_fields(self):
+        # Then
+        assert complete_fields('{"cutoff": 12') == {}
+        assert complete_fields('{"cutoff": 12', final=True) == {"cutoff": 12}
+        assert complete_fields('{"cutoff": 127, "reso') == {"cutoff": 127}
+        assert complete_fields('{"cutoff": 127, "resonance": 3') == {"cutoff": 127}
+        assert complete_fields('{"cutoff": 127, "resonance": 3}') == {"cutoff": 127, "resonance": 3}
+        assert complete_fields({"cutoff": 127}) == {"cutoff": 127}
+        assert complete_fields("") == {}
+
+
+class _SlowFlakyModel:
+    """ Stub LLM taking some time to answer, failing the first call for
+    descriptions containing "flaky", and every call for "broken" ones."""
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.failed = set()
+        self.model = FunctionModel(self.respond, model_name="slow-stub")
+
+    async def respond(self, messages, info):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.running -= 1
+
+        prompt = messages[-1].parts[-1].content
+        if "broken" in prompt or ("flaky" in prompt and prompt not in self.failed):
+            self.failed.add(prompt)
+            raise RuntimeError("LLM unavailable")
+
+        state = JU06AState.from_path(str(PAD_PRM))
+        return ModelResponse(parts=[
+            ToolCallPart(info.output_tools[0].name, state.model_dump(mode="json")),
+        ])
+
+
+class TestGenerateBatch:
+    def test_batch(self, tmp_path):
+        # Given
+        stub = _SlowFlakyModel()
+        generator = PatchGenerator(stub.model, _library())
+        descriptions = [f"pad number {i}" for i in range(9)] + ["a flaky bass", "a broken lead"]
+
+        # When
+        summary = asyncio.run(
+            generate_batch(generator, descriptions, tmp_path / "out", concurrency=3,
+                           retry_delay=0)
+        )
+
+        # Then
+        assert stub.max_running == 3
+        assert len(summary["paths"]) == 10
+        assert summary["paths"][-1] == tmp_path / "out" / "009-a-flaky-bass.prm"
+        assert JU06AState.from_path(str(summary["paths"][0])) == JU06AState.from_path(str(PAD_PRM))
+        assert summary["paths"][0].read_text().endswith("PATCH_NAME(PAD NUMBER 0);\n")
+        assert [(d, str(e)) for d, e in summary["failed"]] == [("a broken lead", "LLM unavailable")]
+        assert summary["throughput"] > 0
+
+    def test_read_descriptions(self):
+        # When
+        descriptions = read_descriptions(["# Show bank\n", "warm pad\n", "\n", "  fat bass \n"])
+
+        # Then
+        assert descriptions == ["warm pad", "fat bass"]
+        assert patch_filename(1, "Fat bass, w/ 2 oscillators!") == "001-fat-bass-w-2-oscillators.prm"
+
+
+class TestCreateAgent:
+    def test_anthropic_cache(self):
+        # Given
+        pytest.importorskip("anthropic")
+
+        # When
+        agent = create_agent("anthropic:claude-sonnet-4-5", "system prompt")
+
+        # Then
+        system = agent.model_settings["extra_body"]["system"]
+        assert system == [
+            {"type": "text", "text": "system prompt", "cache_control": {"type": "ephemeral"}},
+        ]
+
+    def test_other_model(self):
+        # When
+        agent = create_agent(_StubModel().model, "system prompt")
+
+        # Then
+        assert agent.model_settings is None
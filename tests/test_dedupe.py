@@ -0,0 +1,150 @@
+import itertools
+import pathlib
+
+import numpy as np
+import pytest
+
+from text2synth.dedupe import dedupe, exact_groups, group_members, near_duplicate_groups
+from text2synth.patches import COLUMNS, PatchArray
+from text2synth.state import FIELD_ENUMS, FIELD_RANGES, JU06AState, OscRange
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+def _library():
+    pad = JU06AState.from_path(str(PAD_PRM))
+
+    louder = pad.model_copy()
+    louder.amp_level = 10
+
+    close = pad.model_copy()
+    close.cutoff += 2
+    close.attack += 1
+
+    closer = close.model_copy()
+    closer.cutoff += 2
+
+    other_range = pad.model_copy()
+    other_range.osc_range = OscRange.SIXTEEN
+
+    far = pad.model_copy()
+    far.cutoff = 0
+
+    states = [pad, louder, close, closer, other_range, far, pad]
+    names = [f"PATCH {i}" for i in range(len(states))]
+    return PatchArray.from_states(states, names)
+
+
+def _reference_groups(patches, tolerance, ignore=("amp_level",)):
+    """ O(n^2) reference implementation."""
+    columns = [i for name, i in COLUMNS.items() if name not in ignore]
+    numeric = [i for name, i in COLUMNS.items() if name not in ignore and name not in FIELD_ENUMS]
+    n = len(patches)
+    groups = list(range(n))
+
+    def find(i):
+        while groups[i] != i:
+            i = groups[i]
+        return i
+
+    values = patches.values.astype(int)
+    for i, j in itertools.combinations(range(n), 2):
+        diff = np.abs(values[i, columns] - values[j, columns])
+        enums_equal = all(values[i, c] == values[j, c] for c in columns if c not in numeric)
+        if enums_equal and diff.max() <= tolerance:
+            a, b = find(i), find(j)
+            groups[max(a, b)] = min(a, b)
+    return np.array([find(i) for i in range(n)])
+
+
+class TestExactGroups:
+    def test_exact(self):
+        # When
+        groups = exact_groups(_library())
+
+        # Then
+        # Same parameters, different volume and names
+        assert groups.tolist() == [0, 0, 2, 3, 4, 5, 0]
+
+    def test_no_ignore(self):
+        # When
+        groups = exact_groups(_library(), ignore=())
+
+        # Then
+        assert groups.tolist() == [0, 1, 2, 3, 4, 5, 0]
+
+    def test_unknown_field(self):
+        # When/Then
+        with pytest.raises(ValueError):
+            exact_groups(_library(), ignore=("volume",))
+
+
+class TestNearDuplicateGroups:
+    def test_tolerance(self):
+        # When
+        groups = near_duplicate_groups(_library(), tolerance=2)
+
+        # Then
+        # 0 ~ 2 ~ 3, enums must be equal
+        assert groups.tolist() == [0, 0, 0, 0, 4, 5, 0]
+        assert group_members(groups) == [[0, 1, 2, 3, 6]]
+
+    def test_zero_tolerance(self):
+        # When/Then
+        assert near_duplicate_groups(_library(), 0).tolist() == exact_groups(_library()).tolist()
+
+    def test_reference(self):
+        # Given
+        rng = np.random.default_rng(42)
+        base = _library().values[[0]]
+        values = np.repeat(base, 300, axis=0).astype(int)
+        # A few clusters of close patches
+        values[:, COLUMNS["cutoff"]] = rng.choice([20, 100, 200], 300) + rng.integers(0, 4, 300)
+        values[:, COLUMNS["resonance"]] = rng.integers(0, 8, 300) * 30 + rng.integers(0, 3, 300)
+        values[:, COLUMNS["osc_range"]] = rng.integers(0, 3, 300)
+        patches = PatchArray(values)
+
+        # When
+        groups = near_duplicate_groups(patches, tolerance=2, grids=16)
+
+        # Then
+        assert groups.tolist() == _reference_groups(patches, 2).tolist()
+
+
+    def test_recall(self):
+        # Given
+        # Random patches, each w/ a twin differing by the full tolerance in
+        # every numeric field
+        rng = np.random.default_rng(0)
+        tolerance = 2
+        values = np.repeat(_library().values[[0]], 600, axis=0).astype(int)
+        for name, column in COLUMNS.items():
+            if name in FIELD_RANGES:
+                low, high = FIELD_RANGES[name]
+                values[0::2, column] = rng.integers(low, high - tolerance + 1, 300)
+                values[1::2, column] = values[0::2, column] + tolerance
+        patches = PatchArray(values)
+
+        # When
+        groups = near_duplicate_groups(patches, tolerance, ignore=())
+
+        # Then
+        assert (groups[1::2] == groups[0::2]).all()
+
+class TestDedupe:
+    def test_dedupe(self):
+        # When
+        keep, groups = dedupe(_library(), tolerance=2)
+
+        # Then
+        assert keep.tolist() == [0, 4, 5]
+        assert groups == [[0, 1, 2, 3, 6]]
+
+    def test_empty(self):
+        # When
+        keep, groups = dedupe(PatchArray([]), tolerance=2)
+
+        # Then
+        assert len(keep) == 0
+        assert groups == []
@@ -0,0 +1,254 @@
+import pathlib
+
+import numpy as np
+import pytest
+
+from text2synth import features
+from text2synth.features import (
+    FEATURE_COLUMNS, FEATURE_NOTES, FEATURES, FeatureCache, FeatureIndex, audio_features,
+    compute_features
+)
+from text2synth.patches import CACHE_DIRNAME, PatchArray, PatchCache
+from text2synth.render import SAMPLE_RATE, read_wav, render, write_wav
+from text2synth.state import DelaySwitch, JU06AState, OscRange
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+def _sine(frequency, duration=1.0):
+    t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+    return np.sin(2 * np.pi * frequency * t)
+
+
+def _states():
+    pad = JU06AState.from_path(str(PAD_PRM))
+    pad.delay_sw = DelaySwitch.OFF
+
+    bright = pad.model_copy()
+    bright.cutoff = 240
+
+    dark = pad.model_copy()
+    dark.cutoff = 30
+
+    pluck = pad.model_copy()
+    pluck.attack = 0
+    pluck.decay = 40
+    pluck.sustain = 0
+    pluck.release = 20
+
+    bass = pluck.model_copy()
+    bass.osc_range = OscRange.SIXTEEN
+    bass.cutoff = 60
+    bass.sub_level = 200
+
+    return [pad, bright, dark, pluck, bass]
+
+
+class TestAudioFeatures:
+    def test_shape(self):
+        # When
+        values = audio_features(_sine(440))
+
+        # Then
+        assert values.dtype == np.float32
+        assert values.shape == (len(FEATURES),)
+
+    def test_silence(self):
+        # When/Then
+        assert (audio_features(np.zeros(100)) == 0).all()
+
+    def test_brightness(self):
+        # Given
+        t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+        saw = 2 * (220 * t % 1) - 1
+
+        # When
+        sine_values = audio_features(_sine(220))
+        saw_values = audio_features(saw)
+
+        # Then
+        centroid = FEATURE_COLUMNS["centroid"]
+        assert saw_values[centroid] > sine_values[centroid] + 1
+        assert sine_values[centroid] == pytest.approx(np.log2(221), abs=0.05)
+
+    def test_flatness(self):
+        # Given
+        noise = np.random.default_rng(0).normal(size=SAMPLE_RATE) * 0.1
+
+        # When/Then
+        flatness = FEATURE_COLUMNS["flatness"]
+        assert audio_features(noise)[flatness] > 0.9
+        assert audio_features(_sine(440))[flatness] < 0.01
+
+    def test_envelope(self):
+        # Given
+        t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+        pluck = _sine(440) * np.exp(-t / 0.05)
+        swell = _sine(440) * np.minimum(t / 0.5, 1)
+
+        # When
+        pluck_values = audio_features(pluck)
+        swell_values = audio_features(swell)
+
+        # Then
+        attack, decay = FEATURE_COLUMNS["attack"], FEATURE_COLUMNS["decay"]
+        assert pluck_values[attack] < -2
+        assert swell_values[attack] == pytest.approx(np.log10(0.45), abs=0.05)
+        assert pluck_values[decay] < 0.01
+        assert swell_values[decay] > 0.9
+
+    def test_sample_rate(self):
+        # Given
+        t = np.arange(22050) / 22050
+        audio = np.sin(2 * np.pi * 440 * t)
+
+        # When
+        values = audio_features(audio, 22050)
+
+        # Then
+        np.testing.assert_allclose(values, audio_features(_sine(440)), atol=0.05)
+
+
+class TestComputeFeatures:
+    def test_compute_features(self):
+        # Given
+        states = _states()[:2]
+        patches = PatchArray.from_states(states)
+
+        # When
+        values = compute_features(patches.values, jobs=2, chunk_size=1)
+
+        # Then
+        assert values.shape == (2, len(FEATURES))
+        np.testing.assert_array_equal(values[1], audio_features(render(states[1], FEATURE_NOTES)))
+
+    def test_empty(self):
+        # When/Then
+        assert compute_features(PatchArray([]).values, jobs=1).shape == (0, len(FEATURES))
+
+
+class TestFeatureCache:
+    @pytest.fixture
+    def rendered(self, monkeypatch):
+        """ Count the patches rendered."""
+        rendered = []
+        compute = features._rows_features
+
+        def _rows_features(rows):
+            rendered.extend(rows.tolist())
+            return compute(rows)
+
+        monkeypatch.setattr(features, "_rows_features", _rows_features)
+        return rendered
+
+    def test_incremental(self, tmp_path, rendered):
+        # Given
+        states = _states()
+        cache = FeatureCache(tmp_path / "features.npz")
+        first = cache.load(PatchArray.from_states(states[:2]), jobs=1)
+        rendered.clear()
+
+        # When
+        # One new patch, one duplicate of a cached patch
+        patches = PatchArray.from_states(states[:3] + [states[0]])
+        values = cache.load(patches, jobs=1)
+
+        # Then
+        assert rendered == [patches.values[2].tolist()]
+        np.testing.assert_array_equal(values[:2], first)
+        np.testing.assert_array_equal(values[3], first[0])
+
+    def test_up_to_date(self, tmp_path, rendered):
+        # Given
+        patches = PatchArray.from_states(_states()[:2])
+        cache = FeatureCache(tmp_path / "features.npz")
+        values = cache.load(patches, jobs=1)
+        rendered.clear()
+
+        # When
+        cached = FeatureCache(tmp_path / "features.npz").load(patches, jobs=1)
+
+        # Then
+        assert rendered == []
+        np.testing.assert_array_equal(cached, values)
+
+    def test_invalid(self, tmp_path, rendered):
+        # Given
+        path = tmp_path / "features.npz"
+        path.write_bytes(b"garbage")
+        patches = PatchArray.from_states(_states()[:1])
+
+        # When
+        values = FeatureCache(path).load(patches, jobs=1)
+
+        # Then
+        assert len(rendered) == 1
+        assert values.shape == (1, len(FEATURES))
+        assert len(FeatureCache(path).read()) == 1
+
+    def test_truncated(self, tmp_path, rendered):
+        # Given
+        path = tmp_path / "features.npz"
+        patches = PatchArray.from_states(_states()[:2])
+        FeatureCache(path).load(patches, jobs=1)
+        path.write_bytes(path.read_bytes()[:path.stat().st_size // 2])
+        rendered.clear()
+
+        # When
+        values = FeatureCache(path).load(patches, jobs=1)
+
+        # Then
+        assert len(rendered) == 2
+        assert values.shape == (2, len(FEATURES))
+
+    def test_next_to_patch_cache(self, tmp_path):
+        # Given
+        for i, state in enumerate(_states()[:2]):
+            state.to_path(tmp_path / f"{i}.PRM")
+        patches = PatchCache(tmp_path).load(jobs=1)
+        FeatureIndex.from_library(tmp_path, patches, jobs=1)
+        _states()[2].to_path(tmp_path / "2.PRM")
+
+        # When
+        PatchCache(tmp_path).load(jobs=1)
+
+        # Then
+        assert (tmp_path / CACHE_DIRNAME / "features.npz").exists()
+
+
+@pytest.fixture(scope="module")
+def index():
+    patches = PatchArray.from_states(_states(), ["PAD", "BRIGHT", "DARK", "PLUCK", "BASS"])
+    return FeatureIndex(patches, compute_features(patches.values, jobs=1))
+
+
+class TestFeatureIndex:
+    def test_search_text(self, index):
+        # When/Then
+        assert index.search_text("bright pad", k=1)[0].tolist() == [1]
+        assert index.search_text("dark and mellow", k=1)[0].tolist() == [2]
+        assert index.search_text("plucky bass", k=2)[0].tolist() == [4, 3]
+
+    def test_search_text_k(self, index):
+        # When
+        indices, scores = index.search_text("something", k=10)
+
+        # Then
+        # No known tag: every patch, in library order
+        assert indices.tolist() == [0, 1, 2, 3, 4]
+        assert (scores == 0).all()
+
+    def test_search_audio(self, index, tmp_path):
+        # Given
+        path = tmp_path / "query.wav"
+        write_wav(path, render(_states()[2], FEATURE_NOTES))
+        audio, sample_rate = read_wav(path)
+
+        # When
+        indices, distances = index.search_audio(audio, sample_rate, k=2)
+
+        # Then
+        assert indices[0] == 2
+        assert distances[0] < 0.1
+        assert distances[0] <= distances[1]
@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+from pydantic_ai.messages import RetryPromptPart
+
+from text2synth.agent import PatchGenerator, create_agent
+from text2synth.local import (
+    FIELD_VALUES, HashScorer, _common_prefix_length, decode_state, decode_value
+)
+from text2synth.state import JU06AState
+
+
+class _BiggestScorer:
+    """ Scorer always preferring the biggest character."""
+    def __init__(self):
+        self.calls = 0
+
+    def score(self, prompt, prefix, candidates):
+        self.calls += 1
+        return [ord(c) for c in candidates]
+
+
+class TestDecodeValue:
+    def test_range(self):
+        # When
+        value = decode_value(_BiggestScorer(), "", "", FIELD_VALUES["cutoff"], ",")
+
+        # Then
+        # "9" is preferred, but nothing over 255 is allowed
+        assert value == "99,"
+
+    def test_enum(self):
+        # When
+        value = decode_value(_BiggestScorer(), "", "", FIELD_VALUES["assign_mode"], "}")
+
+        # Then
+        assert value == "3}"
+
+    def test_single_choice(self):
+        # Given
+        scorer = _BiggestScorer()
+
+        # When
+        value = decode_value(scorer, "", "", ("0",), ",")
+
+        # Then
+        assert value == "0,"
+        assert scorer.calls == 0
+
+
+class TestDecodeState:
+    def test_valid(self):
+        # Given
+        scorer = HashScorer()
+
+        # When
+        outputs = ["".join(decode_state(scorer, f"prompt {i}")) for i in range(20)]
+
+        # Then
+        states = [JU06AState.model_validate_json(output) for output in outputs]
+        assert len({state.model_dump_json() for state in states}) == 20
+        assert list(json.loads(outputs[0])) == list(JU06AState.model_fields)
+
+    def test_deterministic(self):
+        # When
+        first = "".join(decode_state(HashScorer(), "a warm pad"))
+        second = "".join(decode_state(HashScorer(), "a warm pad"))
+        other = "".join(decode_state(HashScorer(seed="other"), "a warm pad"))
+
+        # Then
+        assert first == second
+        assert first != other
+
+
+class TestLocalModel:
+    def test_generate(self):
+        # Given
+        agent = create_agent("local:hash", "system prompt")
+
+        # When
+        first = asyncio.run(agent.run("a warm pad"))
+        second = asyncio.run(agent.run("a warm pad"))
+
+        # Then
+        assert isinstance(first.output, JU06AState)
+        assert first.output == second.output
+        # Valid at the first attempt
+        parts = [part for message in first.all_messages() for part in message.parts]
+        assert not any(isinstance(part, RetryPromptPart) for part in parts)
+
+    def test_stream(self):
+        # Given
+        generator = PatchGenerator("local:hash")
+        updates = []
+
+        async def on_fields(state, names):
+            updates.append(names)
+
+        # When
+        state = asyncio.run(generator.generate_stream("a warm pad", on_fields))
+
+        # Then
+        assert state == asyncio.run(PatchGenerator("local:hash").generate("a warm pad"))
+        assert len(updates) >= len(JU06AState.model_fields) - 1
+
+
+class TestCommonPrefixLength:
+    def test_common_prefix_length(self):
+        # When/Then
+        assert _common_prefix_length([1, 2, 3], [1, 2, 4, 5]) == 2
+        assert _common_prefix_length([1, 2], [1, 2, 3]) == 2
+        assert _common_prefix_length([], [1]) == 0
+        assert _common_prefix_length([2], [1]) == 0
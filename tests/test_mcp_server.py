@@ -1,11 +1,21 @@
+import asyncio
 import inspect
+import pathlib
 import textwrap
 
 from typing import Optional
 
-from pydantic import BaseModel, Field
+import mido
+import pytest
 
+from pydantic import BaseModel, Field, ValidationError
+
+from text2synth import mcp_server, metrics
 from text2synth.mcp_server import create_function_from_model
+from text2synth.state import JU06AState
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
 
 
 class TestToolFactory:
@@ -91,3 +101,128 @@ class TestToolFactory:
         # Then
         assert func.__doc__ == docstring_ref
         assert func.__annotations__ == func_ref.__annotations__
+
+    def test_async(self):
+        # Given
+        class SimpleModel(BaseModel):
+            a: int
+
+        calls = []
+
+        async def dummy(**kw):
+            calls.append(kw)
+
+        # When
+        func = create_function_from_model(SimpleModel, dummy)
+        asyncio.run(func(a=1))
+
+        # Then
+        assert inspect.iscoroutinefunction(func)
+        assert calls == [{"a": 1}]
+
+
+class TestFindSimilar:
+    def test_find_similar(self, tmp_path, monkeypatch):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        for i in range(3):
+            state.cutoff = 100 * i
+            state.to_path(tmp_path / f"patch{i}.PRM", f"PATCH {i}")
+        monkeypatch.setenv(mcp_server.PATCHES_PATH_ENV, str(tmp_path))
+        monkeypatch.setattr(mcp_server, "SIMILARITY_INDEX", None)
+        monkeypatch.setattr(mcp_server, "STATE", state)
+
+        # When
+        results = asyncio.run(mcp_server.find_similar(k=2))
+        from_path = asyncio.run(mcp_server.find_similar(k=1, path=str(tmp_path / "patch0.PRM")))
+
+        # Then
+        assert [result["name"] for result in results] == ["PATCH 2", "PATCH 1"]
+        assert results[0]["distance"] == 0
+        assert [result["name"] for result in from_path] == ["PATCH 0"]
+
+    def test_no_library(self, monkeypatch):
+        # Given
+        monkeypatch.delenv(mcp_server.PATCHES_PATH_ENV, raising=False)
+        monkeypatch.setattr(mcp_server, "SIMILARITY_INDEX", None)
+
+        # When/Then
+        with pytest.raises(ValueError, match=mcp_server.PATCHES_PATH_ENV):
+            asyncio.run(mcp_server.find_similar())
+
+
+class TestMetrics:
+    def test_metrics(self, monkeypatch):
+        # Given
+        registry = metrics.Metrics(enabled=True)
+        monkeypatch.setattr(metrics, "METRICS", registry)
+        monkeypatch.setattr(mcp_server, "METRICS", registry)
+        registry.observe("midi.send", 0.001)
+
+        # When
+        result = mcp_server.metrics(reset=True)
+
+        # Then
+        assert result["enabled"]
+        assert result["timings"]["midi.send"]["count"] == 1
+        assert registry.snapshot() == {}
+
+    def test_disabled(self, monkeypatch):
+        # Given
+        monkeypatch.setattr(mcp_server, "METRICS", metrics.Metrics())
+
+        # When
+        result = mcp_server.metrics()
+
+        # Then
+        assert not result["enabled"]
+        assert metrics.METRICS_ENV in result["hint"]
+
+
+class _RecordingSender:
+    def __init__(self):
+        self.messages = []
+
+    def submit(self, messages):
+        self.messages.extend(messages)
+
+
+class TestUpdateSynthState:
+    @pytest.fixture
+    def sender(self, monkeypatch):
+        sender = _RecordingSender()
+        monkeypatch.setattr(mcp_server, "SENDER", sender)
+        monkeypatch.setattr(mcp_server, "STATE", JU06AState.from_path(str(PAD_PRM)))
+        monkeypatch.setattr(mcp_server, "SENT_STATE", None)
+        return sender
+
+    def test_minimal_messages(self, sender):
+        # Given
+        asyncio.run(mcp_server.update_synth_state())
+        sender.messages.clear()
+
+        # When
+        # cutoff 130 -> 131 does not change the CC value
+        asyncio.run(mcp_server.update_synth_state(cutoff=131, resonance=10, osc_range=1))
+
+        # Then
+        assert sender.messages == [mido.Message("control_change", control=71, value=5)]
+        assert mcp_server.SENT_STATE == mcp_server.STATE
+        assert mcp_server.SENT_STATE is not mcp_server.STATE
+
+    def test_unknown_synth_state(self, sender):
+        # When
+        asyncio.run(mcp_server.update_synth_state(resonance=10))
+
+        # Then
+        assert sender.messages == mcp_server.STATE.to_cc_messages()
+
+    def test_invalid(self, sender):
+        # Given
+        expected = mcp_server.STATE.model_copy()
+
+        # When/Then
+        with pytest.raises(ValidationError):
+            asyncio.run(mcp_server.update_synth_state(cutoff=10, resonance=300))
+        assert mcp_server.STATE == expected
+        assert sender.messages == []
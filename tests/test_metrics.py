@@ -0,0 +1,177 @@
+import pathlib
+
+import mido
+import pytest
+
+from text2synth import metrics
+from text2synth.metrics import Histogram, Metrics
+from text2synth.midi import LoopbackBackend, MidiOutput, SimulatedClock, TokenBucket
+from text2synth.patches import load_paths
+from text2synth.state import JU06AState
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    """ Enable the process wide metrics, w/ empty histograms."""
+    registry = Metrics(enabled=True)
+    monkeypatch.setattr(metrics, "METRICS", registry)
+    return registry
+
+
+class TestHistogram:
+    def test_summary(self):
+        # Given
+        histogram = Histogram()
+
+        # When
+        for value in [0.001] * 90 + [0.1] * 10:
+            histogram.observe(value)
+
+        # Then
+        summary = histogram.summary()
+        assert summary["count"] == 100
+        assert summary["total"] == pytest.approx(1.09)
+        assert summary["min"] == 0.001
+        assert summary["max"] == 0.1
+        # Within a bucket, i.e. 19%
+        assert summary["p50"] == pytest.approx(0.001, rel=0.19)
+        assert summary["p90"] == pytest.approx(0.001, rel=0.19)
+        assert summary["p99"] == pytest.approx(0.1, rel=0.19)
+
+    def test_clipped(self):
+        # Given
+        histogram = Histogram()
+
+        # When
+        histogram.observe(0.0015)
+        histogram.observe(1e6)
+
+        # Then
+        assert histogram.percentile(0) == 0.0015
+        assert histogram.percentile(100) == 1e6
+
+    def test_empty(self):
+        # When/Then
+        assert Histogram().summary() == {
+            "count": 0, "total": 0.0, "mean": 0.0, "min": 0.0, "max": 0.0,
+            "p50": 0.0, "p90": 0.0, "p99": 0.0,
+        }
+
+
+class TestMetrics:
+    def test_timed(self):
+        # Given
+        registry = Metrics(enabled=True)
+
+        # When
+        with registry.timed("block"):
+            pass
+        registry.observe("sleep", 0.5)
+
+        # Then
+        snapshot = registry.snapshot()
+        assert list(snapshot) == ["block", "sleep"]
+        assert snapshot["block"]["count"] == 1
+        assert snapshot["sleep"]["total"] == 0.5
+
+    def test_disabled(self):
+        # Given
+        registry = Metrics()
+
+        # When
+        with registry.timed("block"):
+            pass
+        registry.observe("sleep", 0.5)
+
+        # Then
+        assert registry.snapshot() == {}
+
+    def test_reset(self):
+        # Given
+        registry = Metrics(enabled=True)
+        registry.observe("sleep", 0.5)
+
+        # When
+        registry.reset()
+
+        # Then
+        assert registry.snapshot() == {}
+
+    def test_report(self):
+        # Given
+        registry = Metrics(enabled=True)
+        registry.observe("midi.wait", 0.002)
+
+        # When
+        lines = registry.report().splitlines()
+
+        # Then
+        assert lines[0].split() == ["name", "count", "total", "mean", "p50", "p90", "p99", "max"]
+        assert lines[1].split()[:4] == ["midi.wait", "1", "2.00", "2.000"]
+
+
+class TestInstrumentation:
+    def test_state(self, enabled):
+        # When
+        state = JU06AState.from_path(str(PAD_PRM))
+        JU06AState.diff_cc_messages(None, state)
+
+        # Then
+        assert {"prm.parse", "state.validate", "cc.encode"} <= set(enabled.snapshot())
+
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_load_paths(self, enabled, tmp_path, write_patches, jobs):
+        # Given
+        paths = write_patches(tmp_path, 3)
+        enabled.reset()
+
+        # When
+        load_paths(paths, jobs=jobs)
+
+        # Then
+        # Parsed in the workers, recorded in this process
+        snapshot = enabled.snapshot()
+        assert snapshot["prm.parse"]["count"] == 3
+        assert snapshot["state.validate"]["count"] == 1
+
+    def test_load_many(self, enabled, tmp_path, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 3)
+        enabled.reset()
+
+        # When
+        JU06AState.load_many(paths)
+
+        # Then
+        snapshot = enabled.snapshot()
+        assert snapshot["prm.parse"]["count"] == 3
+        assert snapshot["state.validate"]["count"] == 1
+
+    def test_midi(self, enabled):
+        # Given
+        clock = SimulatedClock()
+        midi = MidiOutput("virtual", LoopbackBackend(clock=clock),
+                          limiter=TokenBucket(3125, 3, clock))
+
+        # When
+        for control in (74, 71, 73):
+            midi.send(mido.Message("control_change", control=control, value=1))
+
+        # Then
+        snapshot = enabled.snapshot()
+        assert snapshot["midi.send"]["count"] == 3
+        assert snapshot["midi.wait"]["count"] == 3
+
+    def test_disabled(self, monkeypatch):
+        # Given
+        registry = Metrics()
+        monkeypatch.setattr(metrics, "METRICS", registry)
+
+        # When
+        JU06AState.from_path(str(PAD_PRM))
+
+        # Then
+        assert registry.snapshot() == {}
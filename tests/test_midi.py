@@ -0,0 +1,405 @@
+import asyncio
+
+import mido
+import pytest
+
+from text2synth.midi import (
+    LOOPBACK_BACKEND, AsyncMidiSender, CoalescingQueue, LoopbackBackend, MidiOutput,
+    SimulatedClock, TokenBucket, open_backend,
+)
+
+
+class FakePort:
+    def __init__(self, name, fail=False):
+        self.name = name
+        self.closed = False
+        self.fail = fail
+        self.messages = []
+
+    def send(self, msg):
+        if self.fail:
+            raise OSError("device unplugged")
+        self.messages.append(msg)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBackend:
+    def __init__(self, names=("dummy",)):
+        self.names = list(names)
+        self.ports = []
+
+    def open_output(self, name):
+        if name not in self.names:
+            raise OSError(f"Unknown port {name}")
+        port = FakePort(name)
+        self.ports.append(port)
+        return port
+
+    def get_output_names(self):
+        return self.names
+
+
+CC = mido.Message("control_change", control=74, value=64)
+
+
+class TestMidiOutput:
+    def test_lazy_open(self):
+        # Given
+        backend = FakeBackend()
+
+        # When
+        midi = MidiOutput("dummy", backend)
+
+        # Then
+        assert not midi.is_open
+        assert backend.ports == []
+
+    def test_port_reused(self):
+        # Given
+        backend = FakeBackend()
+        midi = MidiOutput("dummy", backend)
+
+        # When
+        midi.send(CC)
+        midi.send(CC)
+
+        # Then
+        assert len(backend.ports) == 1
+        assert backend.ports[0].messages == [CC, CC]
+
+    def test_reconnect_on_failure(self):
+        # Given
+        backend = FakeBackend()
+        midi = MidiOutput("dummy", backend)
+        midi.send(CC)
+        backend.ports[0].fail = True
+
+        # When
+        midi.send(CC)
+
+        # Then
+        assert len(backend.ports) == 2
+        assert backend.ports[0].closed
+        assert backend.ports[1].messages == [CC]
+
+    def test_reconnect_close_failure(self):
+        # Given
+        backend = FakeBackend()
+        midi = MidiOutput("dummy", backend)
+        midi.send(CC)
+        backend.ports[0].fail = True
+
+        def close():
+            raise OSError("device unplugged")
+
+        backend.ports[0].close = close
+
+        # When
+        midi.send(CC)
+
+        # Then
+        assert len(backend.ports) == 2
+        assert backend.ports[1].messages == [CC]
+
+    def test_reconnect_failure(self):
+        # Given
+        backend = FakeBackend()
+        midi = MidiOutput("dummy", backend)
+        midi.send(CC)
+        backend.ports[0].fail = True
+        backend.names = []
+
+        # When/Then
+        with pytest.raises(OSError):
+            midi.send(CC)
+        assert not midi.is_open
+
+    def test_health(self):
+        # Given
+        backend = FakeBackend()
+        midi = MidiOutput("dummy", backend)
+
+        # When/Then
+        assert not midi.is_healthy()
+        midi.open()
+        assert midi.is_healthy()
+        backend.names = []
+        assert not midi.is_healthy()
+
+    def test_close(self):
+        # Given
+        backend = FakeBackend()
+
+        # When
+        with MidiOutput("dummy", backend) as midi:
+            midi.send(CC)
+
+        # Then
+        assert not midi.is_open
+        assert backend.ports[0].closed
+
+
+class TestTokenBucket:
+    def test_burst(self):
+        # Given
+        clock = SimulatedClock()
+        limiter = TokenBucket(3125, 48, clock)
+
+        # When
+        for _ in range(16):
+            limiter.acquire(3)
+
+        # Then
+        assert clock.time() == 0
+
+    def test_sustained_rate(self):
+        # Given
+        clock = SimulatedClock()
+        limiter = TokenBucket(3125, 48, clock)
+
+        # When
+        for _ in range(1000):
+            limiter.acquire(3)
+
+        # Then
+        assert clock.time() == pytest.approx((3000 - 48) / 3125)
+
+    def test_refill(self):
+        # Given
+        clock = SimulatedClock()
+        limiter = TokenBucket(1000, 10, clock)
+        limiter.acquire(10)
+
+        # When
+        clock.sleep(1.0)
+        delay = limiter.reserve(10)
+
+        # Then: the bucket is full again, but not beyond burst
+        assert delay == 0
+        assert limiter.reserve(1) == pytest.approx(0.001)
+
+    def test_midi_output(self):
+        # Given
+        clock = SimulatedClock()
+        backend = FakeBackend()
+        midi = MidiOutput("dummy", backend, limiter=TokenBucket(3125, 3, clock))
+
+        # When
+        for _ in range(35):
+            midi.send(CC)
+
+        # Then
+        assert len(backend.ports[0].messages) == 35
+        assert clock.time() == pytest.approx(34 * 3 / 3125)
+
+
+def cc(control, value):
+    return mido.Message("control_change", control=control, value=value)
+
+
+class TestCoalescingQueue:
+    def _drain(self, queue):
+        async def run():
+            messages = []
+            while not queue.empty():
+                messages.append(await queue.get())
+                queue.task_done()
+            await queue.join()
+            return messages
+        return asyncio.run(run())
+
+    def test_last_write_wins(self):
+        # Given
+        queue = CoalescingQueue()
+
+        # When
+        for value in range(100):
+            queue.put_nowait(cc(74, value))
+        queue.put_nowait(cc(71, 10))
+        queue.put_nowait(cc(74, 127))
+
+        # Then
+        assert queue.qsize() == 2
+        assert self._drain(queue) == [cc(74, 127), cc(71, 10)]
+
+    def test_channels_not_merged(self):
+        # Given
+        queue = CoalescingQueue()
+
+        # When
+        queue.put_nowait(mido.Message("control_change", channel=0, control=74, value=1))
+        queue.put_nowait(mido.Message("control_change", channel=1, control=74, value=2))
+
+        # Then
+        assert queue.qsize() == 2
+
+    def test_barrier(self):
+        # Given
+        queue = CoalescingQueue()
+        pc = mido.Message("program_change", program=1)
+
+        # When
+        queue.put_nowait(cc(74, 1))
+        queue.put_nowait(pc)
+        queue.put_nowait(cc(74, 2))
+        queue.put_nowait(pc)
+
+        # Then
+        assert self._drain(queue) == [cc(74, 1), pc, cc(74, 2), pc]
+
+
+MESSAGES = [cc(74, 1), cc(71, 2), cc(73, 3)]
+
+
+class TestAsyncMidiSender:
+    def test_submit_returns_immediately(self):
+        # Given
+        backend = FakeBackend()
+        sender = AsyncMidiSender(MidiOutput("dummy", backend))
+
+        async def run():
+            sender.submit(MESSAGES)
+            sent_before_flush = len(backend.ports)
+            await sender.flush()
+            return sent_before_flush
+
+        # When
+        sent_before_flush = asyncio.run(run())
+
+        # Then
+        assert sent_before_flush == 0
+        assert backend.ports[0].messages == MESSAGES
+
+    def test_close(self):
+        # Given
+        backend = FakeBackend()
+        sender = AsyncMidiSender(MidiOutput("dummy", backend))
+
+        async def run():
+            sender.submit(MESSAGES)
+            await sender.close()
+
+        # When
+        asyncio.run(run())
+
+        # Then
+        assert backend.ports[0].messages == MESSAGES
+        assert backend.ports[0].closed
+
+    def test_error(self):
+        # Given
+        errors = []
+        backend = FakeBackend(names=[])
+        sender = AsyncMidiSender(MidiOutput("dummy", backend), on_error=errors.append)
+
+        async def run():
+            sender.submit([CC])
+            await sender.flush()
+            # The task keeps running after an error
+            backend.names = ["dummy"]
+            sender.submit([CC])
+            await sender.flush()
+
+        # When
+        asyncio.run(run())
+
+        # Then
+        assert len(errors) == 1
+        assert backend.ports[0].messages == [CC]
+
+    def test_coalescing(self):
+        # Given
+        backend = FakeBackend()
+        sender = AsyncMidiSender(MidiOutput("dummy", backend))
+
+        async def run():
+            sender.submit([cc(74, 0)])
+            # Let the sender pick the first message
+            await asyncio.sleep(0)
+            for value in range(1, 100):
+                sender.submit([cc(74, value)])
+            await sender.flush()
+
+        # When
+        asyncio.run(run())
+
+        # Then
+        assert backend.ports[0].messages == [cc(74, 0), cc(74, 99)]
+
+
+class TestLoopbackBackend:
+    def test_loopback(self):
+        # Given
+        backend = LoopbackBackend()
+        midi = MidiOutput("virtual", backend)
+        port = backend.open_input("virtual")
+
+        # When
+        for msg in MESSAGES:
+            midi.send(msg)
+
+        # Then
+        assert list(port.iter_pending()) == MESSAGES
+        assert port.poll() is None
+        assert midi.is_healthy()
+        assert backend.get_output_names() == ["virtual"]
+
+    def test_other_port(self):
+        # Given
+        backend = LoopbackBackend()
+        port = backend.open_input("other")
+
+        # When
+        MidiOutput("virtual", backend).send(CC)
+
+        # Then
+        assert port.poll() is None
+        with pytest.raises(TimeoutError):
+            port.receive(timeout=0.01)
+
+    def test_recorder(self):
+        # Given
+        clock = SimulatedClock()
+        backend = LoopbackBackend(clock=clock)
+        recorder = backend.recorder("virtual")
+        midi = MidiOutput("virtual", backend, limiter=TokenBucket(3125, 3, clock))
+
+        # When
+        for msg in MESSAGES:
+            midi.send(msg)
+        recorder.wait_for(3, timeout=0)
+
+        # Then
+        assert [msg for _, msg in recorder.messages] == MESSAGES
+        assert recorder.bytes_received == 9
+        assert recorder.last_time == pytest.approx((9 - 3) / 3125)
+
+    def test_recorder_timeout(self):
+        # Given
+        recorder = LoopbackBackend().recorder("virtual")
+
+        # When/Then
+        with pytest.raises(TimeoutError):
+            recorder.wait_for(1, timeout=0.01)
+
+    def test_closed(self):
+        # Given
+        backend = LoopbackBackend()
+        recorder = backend.recorder("virtual")
+        midi = MidiOutput("virtual", backend)
+        midi.send(CC)
+
+        # When
+        recorder.close()
+        midi.send(CC)
+
+        # Then
+        assert len(recorder.messages) == 1
+
+    def test_open_backend(self):
+        # When/Then
+        assert open_backend() is mido
+        assert isinstance(open_backend(LOOPBACK_BACKEND), LoopbackBackend)
+        assert open_backend("mido.backends.rtmidi").name == "mido.backends.rtmidi"
@@ -0,0 +1,309 @@
+import pathlib
+
+import numpy as np
+import pytest
+
+from text2synth import patches as patches_module
+from text2synth.patches import (
+    CACHE_DIRNAME, COLUMNS, FIELDS, PatchArray, PatchCache, compute_stats, load_directory, load_paths
+)
+from text2synth.state import JU06AState, OscRange
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+class TestPatchArray:
+    def test_from_paths(self, tmp_path, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 3)
+
+        # When
+        patches = PatchArray.from_paths(paths)
+
+        # Then
+        assert patches.values.shape == (3, len(FIELDS))
+        assert patches.values.dtype == np.uint8
+        assert patches.column("cutoff").tolist() == [0, 1, 2]
+        assert patches.names == ["PATCH 0", "PATCH 1", "PATCH 2"]
+        assert patches.paths == paths
+
+    def test_errors(self, tmp_path, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 3)
+        # Out of range
+        paths[0].write_text(paths[0].read_text().replace("DELAY TIME      (8)", "DELAY TIME      (16)"))
+        # Not a valid enum value
+        paths[1].write_text(paths[1].read_text().replace("ASSIGN MODE     (0)", "ASSIGN MODE     (1)"))
+
+        # When
+        errors = []
+        patches = PatchArray.from_paths(paths, errors)
+
+        # Then
+        assert patches.names == ["PATCH 2"]
+        assert [path for path, _ in errors] == paths[:2]
+
+        with pytest.raises(ValueError):
+            PatchArray.from_paths(paths)
+
+    def test_roundtrip(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        patches = PatchArray.from_states([state], names=["SIMPLE PAD"])
+        new_state = patches.to_state(0)
+
+        # Then
+        assert new_state == state
+        assert new_state.osc_range is OscRange.EIGHT
+        assert patches.to_prm(0) == PAD_PRM.read_text(encoding="ascii").replace("\n", "\r\n")
+
+    def test_to_compact(self, tmp_path, write_patches):
+        # Given
+        patches = PatchArray.from_paths(write_patches(tmp_path, 2))
+
+        # When
+        lines = patches.to_compact().split("\n")
+
+        # Then
+        assert lines[0].startswith("osc_range,")
+        assert len(lines) == 3
+        assert [JU06AState.from_compact_row(line) for line in lines[1:]] == list(patches)
+        assert lines[2].endswith(",PATCH 1")
+
+    def test_views(self, tmp_path, write_patches):
+        # Given
+        patches = PatchArray.from_paths(write_patches(tmp_path, 3))
+
+        # When
+        row = patches[1]
+        column = patches.column("cutoff")
+
+        # Then
+        assert np.shares_memory(row, patches.values)
+        assert np.shares_memory(column, patches.values)
+        assert row[COLUMNS["cutoff"]] == 1
+        with pytest.raises(ValueError):
+            row[0] = 1
+
+    def test_select(self, tmp_path, write_patches):
+        # Given
+        patches = PatchArray.from_paths(write_patches(tmp_path, 3))
+
+        # When
+        selected = patches.select(patches.column("cutoff") > 0)
+
+        # Then
+        assert selected.names == ["PATCH 1", "PATCH 2"]
+        assert [state.cutoff for state in selected] == [1, 2]
+
+
+class TestComputeStats:
+    def test_stats(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        patches = PatchArray.from_states([state] * 10)
+        patches.column("cutoff")[:] = np.arange(0, 250, 25)
+        patches.column("delay_time")[:] = np.arange(10)
+        patches.column("osc_range")[:5] = OscRange.SIXTEEN
+
+        # When
+        stats = compute_stats(patches, percentiles=(0, 50, 90, 100))
+
+        # Then
+        assert stats["count"] == 10
+        cutoff = stats["fields"]["cutoff"]
+        assert (cutoff["min"], cutoff["max"]) == (0, 225)
+        assert cutoff["mean"] == pytest.approx(112.5)
+        assert cutoff["percentiles"] == {"0": 0, "50": 100, "90": 200, "100": 225}
+        assert cutoff["histogram"]["edges"] == list(range(0, 256, 16)) + [256]
+        assert sum(cutoff["histogram"]["counts"]) == 10
+        assert cutoff["histogram"]["counts"][:4] == [1, 1, 0, 1]
+
+        delay_time = stats["fields"]["delay_time"]
+        assert delay_time["histogram"]["edges"] == list(range(17))
+        assert delay_time["histogram"]["counts"] == [1] * 10 + [0] * 6
+
+        assert stats["fields"]["osc_range"]["values"] == {"SIXTEEN": 5, "EIGHT": 5}
+        assert "osc_range" not in stats["double_attributes"]
+        assert "cutoff" in stats["double_attributes"]
+        assert "delay_time" not in stats["double_attributes"]
+
+    def test_empty(self):
+        # When
+        stats = compute_stats(PatchArray([]))
+
+        # Then
+        assert stats == {"count": 0, "fields": {}, "double_attributes": []}
+
+
+class TestLoadPaths:
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_load_paths(self, tmp_path, jobs, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 10)
+        paths[3].write_text("CUTOFF (1000);")
+        # Does not fit in the int16 rows
+        paths[5].write_text(paths[5].read_text().replace("CUTOFF          (5)", "CUTOFF          (40000)"))
+        paths.append(tmp_path / "missing.PRM")
+
+        # When
+        errors = []
+        patches = load_paths(iter(paths), jobs=jobs, chunk_size=3, errors=errors)
+
+        # Then
+        assert patches.paths == paths[:3] + [paths[4]] + paths[6:10]
+        assert patches.column("cutoff").tolist() == [0, 1, 2, 4, 6, 7, 8, 9]
+        assert sorted(path.name for path, _ in errors) == ["missing.PRM", "patch3.PRM", "patch5.PRM"]
+
+    def test_raise(self, tmp_path, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 2)
+        paths[1].write_text("CUTOFF (1000);")
+
+        # When/Then
+        with pytest.raises(ValueError):
+            load_paths(paths, jobs=2)
+
+    def test_load_directory(self, tmp_path, write_patches):
+        # Given
+        (tmp_path / "sub").mkdir()
+        write_patches(tmp_path / "sub", 3)
+        (tmp_path / "not_a_patch.txt").write_text("")
+
+        # When
+        patches = load_directory(tmp_path, jobs=1)
+
+        # Then
+        assert sorted(patches.names) == ["PATCH 0", "PATCH 1", "PATCH 2"]
+
+    def test_empty(self, tmp_path):
+        # When
+        patches = load_directory(tmp_path, jobs=2)
+
+        # Then
+        assert len(patches) == 0
+
+
+class TestPatchCache:
+    def _spy_parsed(self, monkeypatch):
+        parsed = []
+
+        def spy(paths, *a, **kw):
+            paths = list(paths)
+            parsed.extend(path.name for path in paths)
+            return load_paths(paths, *a, **kw)
+
+        monkeypatch.setattr(patches_module, "load_paths", spy)
+        return parsed
+
+    def test_cold_and_warm(self, tmp_path, monkeypatch, write_patches):
+        # Given
+        write_patches(tmp_path, 3)
+        parsed = self._spy_parsed(monkeypatch)
+
+        # When
+        cold = PatchCache(tmp_path).load(jobs=1)
+        warm = PatchCache(tmp_path).load(jobs=1)
+
+        # Then
+        assert len(parsed) == 3
+        assert sorted(warm.names) == sorted(cold.names)
+        # Read-only memory map of the cache
+        assert not warm.values.flags.owndata
+        assert not warm.values.flags.writeable
+        assert sorted(warm.column("cutoff").tolist()) == [0, 1, 2]
+
+    def test_incremental(self, tmp_path, monkeypatch, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 3)
+        PatchCache(tmp_path).load(jobs=1)
+        parsed = self._spy_parsed(monkeypatch)
+
+        # When
+        state = JU06AState.from_path(str(paths[1]))
+        state.cutoff = 200
+        state.to_path(paths[1], "CHANGED PATCH")
+        paths[2].unlink()
+        patches = PatchCache(tmp_path).load(jobs=1)
+
+        # Then
+        assert parsed == ["patch1.PRM"]
+        assert sorted(patches.names) == ["CHANGED PATCH", "PATCH 0"]
+        assert sorted(patches.column("cutoff").tolist()) == [0, 200]
+
+        # The cache was updated
+        parsed.clear()
+        patches = PatchCache(tmp_path).load(jobs=1)
+        assert parsed == []
+        assert sorted(patches.names) == ["CHANGED PATCH", "PATCH 0"]
+
+    def test_invalid_files(self, tmp_path, monkeypatch, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 3)
+        paths[1].write_text("CUTOFF (1000);")
+        PatchCache(tmp_path).load(jobs=1, errors=[])
+        values_files = set((tmp_path / CACHE_DIRNAME).glob("values-*.npy"))
+        parsed = self._spy_parsed(monkeypatch)
+
+        # When
+        errors = []
+        patches = PatchCache(tmp_path).load(jobs=1, errors=errors)
+
+        # Then
+        # The invalid file is not parsed again, and still reported
+        assert parsed == []
+        assert [path for path, _ in errors] == [paths[1]]
+        assert not patches.values.flags.owndata
+        assert set((tmp_path / CACHE_DIRNAME).glob("values-*.npy")) == values_files
+        with pytest.raises(ValueError):
+            PatchCache(tmp_path).load(jobs=1)
+
+        # Once fixed, the file is parsed again
+        state = JU06AState.from_path(str(paths[0]))
+        state.cutoff = 1
+        state.to_path(paths[1], "PATCH 1")
+        patches = PatchCache(tmp_path).load(jobs=1)
+        assert parsed == ["patch1.PRM"]
+        assert sorted(patches.column("cutoff").tolist()) == [0, 1, 2]
+
+    def test_foreign_files(self, tmp_path, write_patches):
+        # Given
+        write_patches(tmp_path, 2)
+        cache = PatchCache(tmp_path)
+        cache.load(jobs=1)
+        previous = set(cache.cache_dir.glob("values-*.npy"))
+        # e.g. the features cache, and the files of a concurrent writer
+        foreign = [
+            cache.cache_dir / name
+            for name in ("features.npz", "values-other.npy", "index-other.tmp")
+        ]
+        for path in foreign:
+            path.write_bytes(b"")
+
+        # When
+        write_patches(tmp_path, 3)
+        cache.load(jobs=1)
+
+        # Then
+        assert all(path.exists() for path in foreign)
+        assert not any(path.exists() for path in previous)
+        assert len(cache.read()[0]) == 3
+
+    def test_corrupted(self, tmp_path, write_patches):
+        # Given
+        write_patches(tmp_path, 3)
+        cache = PatchCache(tmp_path)
+        cache.load(jobs=1)
+        cache.index_path.write_text("{not json")
+
+        # When
+        patches = cache.load(jobs=1)
+
+        # Then
+        assert len(patches) == 3
+        entries, values, _ = cache.read()
+        assert len(entries) == 3
+        assert values.shape == (3, len(FIELDS))
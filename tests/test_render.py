@@ -0,0 +1,226 @@
+import pathlib
+import wave
+
+import numpy as np
+import pytest
+
+from text2synth.render import (
+    SAMPLE_RATE, adsr, envelope_time, filters, read_wav, render, render_many, write_wav
+)
+from text2synth.state import DelaySwitch, JU06AState, VCAEnvGate
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+def _centroid(audio):
+    """ Spectral centroid, in Hz."""
+    spectrum = np.abs(np.fft.rfft(audio))
+    frequencies = np.fft.rfftfreq(len(audio), 1 / SAMPLE_RATE)
+    return (spectrum * frequencies).sum() / spectrum.sum()
+
+
+def _sine(frequency, duration=0.5):
+    t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+    return np.sin(2 * np.pi * frequency * t)
+
+
+class TestADSR:
+    def test_adsr(self):
+        # Given
+        attack, decay, sustain, release = 0.1, 0.2, 0.5, 0.4
+
+        # When
+        env = adsr([0.05, 0.1, 0.9, 1.0, 1.4], 1.0, attack, decay, sustain, release)
+
+        # Then
+        assert env[0] == pytest.approx(0.5)
+        assert env[1] == pytest.approx(1.0)
+        assert env[2] == pytest.approx(sustain, abs=1e-3)
+        assert env[3] == pytest.approx(sustain, abs=1e-3)
+        # ~2% after the release time
+        assert env[4] == pytest.approx(sustain * np.exp(-4), abs=1e-3)
+
+    def test_release_during_attack(self):
+        # When
+        env = adsr([0.05, 0.05 + 0.4], 0.05, 0.1, 0.2, 0.5, 0.4)
+
+        # Then
+        assert env[0] == pytest.approx(0.5)
+        assert env[1] == pytest.approx(0.5 * np.exp(-4))
+
+
+class TestFilters:
+    def test_transparent(self):
+        # Given
+        x = _sine(440)
+
+        # When
+        y = filters(x, lambda t: np.full(len(t), 20000.0), 0.0, 0.0, SAMPLE_RATE)
+
+        # Then
+        assert len(y) == len(x)
+        np.testing.assert_allclose(y, x, atol=0.05)
+
+    def test_lowpass(self):
+        # Given
+        low, high = _sine(200), _sine(8000)
+
+        def cutoff(t):
+            return np.full(len(t), 1000.0)
+
+        # When
+        y_low = filters(low, cutoff, 0.0, 0.0, SAMPLE_RATE)
+        y_high = filters(high, cutoff, 0.0, 0.0, SAMPLE_RATE)
+
+        # Then
+        assert np.std(y_low) > 0.9 * np.std(low)
+        assert np.std(y_high) < 0.01 * np.std(high)
+
+    def test_resonance(self):
+        # Given
+        x = _sine(1000)
+
+        def cutoff(t):
+            return np.full(len(t), 1000.0)
+
+        # When
+        flat = filters(x, cutoff, 0.0, 0.0, SAMPLE_RATE)
+        resonant = filters(x, cutoff, 3.5, 0.0, SAMPLE_RATE)
+
+        # Then
+        assert np.std(resonant) > 2 * np.std(flat)
+
+    def test_hpf(self):
+        # Given
+        x = _sine(50)
+
+        # When
+        y = filters(x, lambda t: np.full(len(t), 20000.0), 0.0, 1000.0, SAMPLE_RATE)
+
+        # Then
+        assert np.std(y) < 0.1 * np.std(x)
+
+
+class TestRender:
+    def test_render(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        audio = render(state, [(60, 0.0, 0.5)])
+
+        # Then
+        assert audio.dtype == np.float32
+        assert np.isfinite(audio).all()
+        assert len(audio) > 0.5 * SAMPLE_RATE
+        assert 0.01 < np.abs(audio).max() < 1
+        np.testing.assert_array_equal(audio, render(state, [(60, 0.0, 0.5)]))
+
+    def test_cutoff(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        state.env_mod = 0
+        state.flt_lfo_mod = 0
+        state.delay_sw = DelaySwitch.OFF
+        bright = state.model_copy()
+        bright.cutoff = 230
+        dark = state.model_copy()
+        dark.cutoff = 60
+
+        # When/Then
+        assert _centroid(render(bright)) > 2 * _centroid(render(dark))
+
+    def test_gate(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        state.delay_sw = DelaySwitch.OFF
+        state.amp_mode = VCAEnvGate.GATE
+
+        # When
+        audio = render(state, [(60, 0.0, 0.5)])
+
+        # Then
+        # Full level right away, silent after the note off
+        assert np.abs(audio[int(0.05 * SAMPLE_RATE):int(0.1 * SAMPLE_RATE)]).max() > 0.05
+        assert np.abs(audio[int(0.52 * SAMPLE_RATE):]).max() < 1e-3
+
+    def test_delay_tail(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        state.attack = 0
+        state.release = 0
+        dry = state.model_copy()
+        dry.delay_sw = DelaySwitch.OFF
+
+        # When
+        wet_audio = render(state, [(60, 0.0, 0.2)])
+        dry_audio = render(dry, [(60, 0.0, 0.2)])
+
+        # Then
+        assert len(wet_audio) > len(dry_audio)
+        assert np.abs(wet_audio[int(0.3 * SAMPLE_RATE):]).max() > 0.01
+
+    def test_render_many(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        other = state.model_copy()
+        other.cutoff = 10
+        notes = [(60, 0.0, 0.2)]
+
+        # When
+        audios = render_many([state, other], notes, jobs=2)
+
+        # Then
+        np.testing.assert_array_equal(audios[0], render(state, notes))
+        np.testing.assert_array_equal(audios[1], render(other, notes))
+
+
+class TestWriteWav:
+    def test_write_wav(self, tmp_path):
+        # Given
+        audio = np.array([0.0, 0.5, -1.0, 2.0], dtype=np.float32)
+        path = tmp_path / "out.wav"
+
+        # When
+        write_wav(path, audio)
+
+        # Then
+        with wave.open(str(path), "rb") as fp:
+            assert fp.getnchannels() == 1
+            assert fp.getframerate() == SAMPLE_RATE
+            data = np.frombuffer(fp.readframes(4), dtype="<i2")
+        assert data.tolist() == [0, 16383, -32767, 32767]
+
+    def test_read_wav(self, tmp_path):
+        # Given
+        audio = np.array([0.0, 0.5, -1.0], dtype=np.float32)
+        path = tmp_path / "out.wav"
+        write_wav(path, audio, 22050)
+
+        # When
+        data, sample_rate = read_wav(path)
+
+        # Then
+        assert sample_rate == 22050
+        np.testing.assert_allclose(data, audio, atol=1e-4)
+
+    def test_read_wav_stereo(self, tmp_path):
+        # Given
+        path = tmp_path / "stereo.wav"
+        with wave.open(str(path), "wb") as fp:
+            fp.setnchannels(2)
+            fp.setsampwidth(2)
+            fp.setframerate(SAMPLE_RATE)
+            fp.writeframes(np.array([16384, 0, -16384, -16384], dtype="<i2").tobytes())
+
+        # When
+        data, _ = read_wav(path)
+
+        # Then
+        np.testing.assert_allclose(data, [0.25, -0.5])
+
+    def test_envelope_time(self):
+        # Then
+        assert envelope_time(0) == pytest.approx(0.001)
+        assert envelope_time(255) == pytest.approx(10)
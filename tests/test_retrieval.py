@@ -0,0 +1,186 @@
+import pathlib
+
+import numpy as np
+import pytest
+
+from text2synth.patches import PatchArray
+from text2synth.retrieval import PatchIndex, SimilarityIndex, parameter_tags, tokenize
+from text2synth.state import FIELD_ENUMS, FIELD_RANGES, JU06AState, OscRange
+
+
+PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
+
+
+def _library():
+    pad = JU06AState.from_path(str(PAD_PRM))
+
+    bass = pad.model_copy()
+    bass.osc_range = OscRange.SIXTEEN
+    bass.attack = 0
+    bass.decay = 80
+    bass.sustain = 30
+    bass.release = 20
+    bass.cutoff = 200
+
+    lead = pad.model_copy()
+    lead.attack = 0
+
+    names = ["Warm Pad", "Pluck Bass", "Mono Lead", "Init", "Init 2"]
+    paths = [pathlib.Path("lib") / f"{name}.PRM" for name in names]
+    return PatchArray.from_states([pad, bass, lead, lead, lead], names, paths)
+
+
+class TestTokenize:
+    def test_tokenize(self):
+        # When
+        tokens = tokenize("A plucky FatBass, with 2 strings")
+
+        # Then
+        assert tokens == ["a", "pluck", "fat", "bass", "with", "2", "string"]
+
+
+class TestParameterTags:
+    def test_tags(self):
+        # When
+        tags = parameter_tags(_library())
+
+        # Then
+        assert tags["pad"].tolist() == [True, False, False, False, False]
+        assert tags["bass"].tolist() == [False, True, False, False, False]
+        assert tags["pluck"].tolist() == [False, True, False, False, False]
+        assert tags["bright"].tolist() == [False, True, False, False, False]
+
+
+class TestPatchIndex:
+    def test_search_name(self):
+        # Given
+        index = PatchIndex(_library())
+
+        # When
+        result = index.search("a mono lead", k=1)
+
+        # Then
+        assert result.tolist() == [2]
+
+    def test_search_parameters(self):
+        # Given
+        index = PatchIndex(_library())
+
+        # When
+        result = index.search("bright plucky bass", k=2)
+
+        # Then
+        assert result[0] == 1
+
+    def test_fill_with_diverse_patches(self):
+        # Given
+        index = PatchIndex(_library())
+
+        # When
+        result = index.search("lead", k=4)
+
+        # Then
+        assert result[0] == 2
+        assert len(set(result.tolist())) == 4
+
+    def test_no_match(self):
+        # Given
+        index = PatchIndex(_library())
+
+        # When
+        result = index.search("xyzzy", k=2)
+
+        # Then
+        assert result.tolist() == [0, 4]
+
+    def test_empty(self):
+        # Given
+        index = PatchIndex(PatchArray([]))
+
+        # When
+        result = index.search("bass")
+
+        # Then
+        assert len(result) == 0
+
+
+def _distance(a, b, weights):
+    """ Reference implementation of the distance between 2 states."""
+    d2 = 0
+    for name in JU06AState.model_fields:
+        weight = weights.get(name, 1.0)
+        if name in FIELD_ENUMS:
+            d2 += weight * (getattr(a, name) != getattr(b, name))
+        else:
+            low, high = FIELD_RANGES[name]
+            d2 += weight * ((getattr(a, name) - getattr(b, name)) / (high - low)) ** 2
+    return d2 ** 0.5
+
+
+class TestSimilarityIndex:
+    def test_search(self):
+        # Given
+        library = _library()
+        index = SimilarityIndex(library)
+        query = library.to_state(1).model_copy()
+        query.cutoff = 190
+
+        # When
+        indices, distances = index.search(query, k=3)
+
+        # Then
+        assert indices[0] == 1
+        assert distances[0] == pytest.approx(10 / 255, rel=1e-5)
+        assert list(distances) == sorted(distances)
+        for i, d in zip(indices, distances):
+            assert d == pytest.approx(_distance(query, library.to_state(i), index.weights), rel=1e-5)
+
+    def test_enums(self):
+        # Given
+        library = _library()
+        index = SimilarityIndex(library, weights={"osc_range": 3.0})
+        query = library.to_state(0).model_copy()
+        query.osc_range = OscRange.SIXTEEN
+
+        # When
+        indices, distances = index.search(query, k=len(library))
+
+        # Then
+        # Categorical: any other range is as far
+        assert distances[list(indices).index(0)] == pytest.approx(3.0 ** 0.5)
+
+    def test_weights(self):
+        # Given
+        library = _library()
+        query = library.to_state(2).model_copy()
+        query.amp_level = 0
+
+        # When
+        _, distances = SimilarityIndex(library, weights={"amp_level": 0}).search(query, k=1)
+
+        # Then
+        assert distances.tolist() == [0]
+
+    def test_unknown_weights(self):
+        # When/Then
+        with pytest.raises(ValueError, match="bend_range"):
+            SimilarityIndex(_library(), weights={"bend_range": 0.25})
+
+    def test_ties(self):
+        # Given
+        index = SimilarityIndex(_library())
+
+        # When
+        indices, distances = index.search(_library()[4], k=3)
+
+        # Then
+        # Identical patches keep the library order
+        assert indices.tolist() == [2, 3, 4]
+        assert np.all(distances == 0)
+
+    def test_empty(self):
+        # When
+        indices, distances = SimilarityIndex(PatchArray([])).search(_library().to_state(0))
+
+        # Then
+        assert len(indices) == len(distances) == 0
@@ -1,7 +1,13 @@
 import pathlib
+import re
 
+import mido
+import pytest
 
-from text2synth.state import JU06AState
+from pydantic import ValidationError
+
+
+from text2synth.state import CC_ENCODER, COMPACT_HEADER, JU06AState, OscRange, parse_prm
 
 
 PAD_PRM = pathlib.Path(__file__).parent / "pad.prm"
@@ -25,3 +31,307 @@ class TestJU06AState:
 
         # Then
         assert r_content == content
+
+
+class TestDiffCCMessages:
+    def test_no_previous_state(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        messages = JU06AState.diff_cc_messages(None, state)
+
+        # Then
+        assert messages == state.to_cc_messages()
+
+    def test_same_state(self):
+        # Given
+        old = JU06AState.from_path(str(PAD_PRM))
+        new = old.model_copy()
+
+        # When
+        messages = JU06AState.diff_cc_messages(old, new)
+
+        # Then
+        assert messages == []
+
+    def test_changed_attributes(self):
+        # Given
+        old = JU06AState.from_path(str(PAD_PRM))
+        new = old.model_copy()
+        new.cutoff = 200
+        new.attack = 201  # same CC value as 200, nothing to send
+
+        # When
+        messages = JU06AState.diff_cc_messages(old, new)
+
+        # Then
+        assert messages == [
+            mido.Message("control_change", control=74, value=100),
+        ]
+
+    def test_partial_state(self):
+        # Given
+        state = JU06AState.model_construct()
+        state.resonance = 10
+        state.cutoff = 200
+
+        # When
+        messages = state.field_cc_messages(["resonance", "cutoff"])
+
+        # Then
+        expected = {"cutoff": 100, "resonance": 5}
+        assert messages == [
+            mido.Message("control_change", control=cc, value=expected[attribute])
+            for attribute, cc, _ in CC_ENCODER
+            if attribute in expected
+        ]
+
+
+class TestApplyUpdates:
+    def test_apply_updates(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        expected = state.model_copy()
+        expected.cutoff = 10
+        expected.osc_range = OscRange.FOUR
+
+        # When
+        changed = state.apply_updates({"cutoff": 10, "osc_range": 2, "resonance": state.resonance})
+
+        # Then
+        assert changed == {"cutoff", "osc_range"}
+        assert state == expected
+        assert state.osc_range is OscRange.FOUR
+        assert {"cutoff", "osc_range", "resonance"} <= state.model_fields_set
+
+    def test_coercion(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        changed = state.apply_updates({"cutoff": "12", "sustain": 13.0})
+
+        # Then
+        assert changed == {"cutoff", "sustain"}
+        assert (state.cutoff, state.sustain) == (12, 13)
+        assert type(state.sustain) is int
+
+    def test_invalid(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        expected = state.model_copy()
+
+        # When
+        with pytest.raises(ValidationError) as e:
+            state.apply_updates({"cutoff": 10, "resonance": 256, "osc_range": 3, "volume": 1})
+
+        # Then
+        # Same errors as setattr, and nothing is updated
+        assert [(error["loc"], error["type"]) for error in e.value.errors()] == [
+            (("resonance",), "less_than_equal"),
+            (("osc_range",), "enum"),
+            (("volume",), "no_such_attribute"),
+        ]
+        assert state == expected
+
+    def test_partial_state(self):
+        # Given
+        state = JU06AState.model_construct()
+
+        # When
+        changed = state.apply_updates({"cutoff": 10})
+
+        # Then
+        assert changed == {"cutoff"}
+        assert state.field_cc_messages(changed) == [mido.Message("control_change", control=74, value=5)]
+
+
+class TestCCEncoding:
+    def test_cc_values(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        values = dict(state.cc_values())
+
+        # Then
+        assert values[74] == 65  # cutoff: 130 / 2
+        assert values[12] == 1  # osc range
+        assert type(values[12]) is int
+        assert values[65] == 0  # portamento switch
+        assert values[82] == 8  # delay time
+
+    def test_portamento_switch(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        state.porta_sw = 1
+
+        # Then
+        assert dict(state.cc_values())[65] == 63
+
+    def test_to_cc_bytes(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        data = state.to_cc_bytes(channel=1, running_status=False)
+
+        # Then
+        messages = [msg.copy(channel=1) for msg in state.to_cc_messages()]
+        assert data == b"".join(bytes(msg.bytes()) for msg in messages)
+
+    def test_to_cc_bytes_running_status(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        data = state.to_cc_bytes()
+
+        # Then
+        full = state.to_cc_bytes(running_status=False)
+        assert len(data) == 1 + 2 * len(CC_ENCODER)
+        assert data[0] == 0xB0
+        assert data[1:] == bytes(b for i, b in enumerate(full) if i % 3)
+
+    def test_to_midi_path(self, tmp_path):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        state.to_midi_path(tmp_path / "pad.bin")
+        state.to_midi_path(tmp_path / "pad.mid")
+
+        # Then
+        assert (tmp_path / "pad.bin").read_bytes() == state.to_cc_bytes()
+        midi_file = mido.MidiFile(tmp_path / "pad.mid")
+        assert [msg for msg in midi_file.tracks[0] if not msg.is_meta] \
+            == state.to_cc_messages()
+
+    def test_to_midi_path_syx(self, tmp_path):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When/Then
+        # A CC stream is not SysEx
+        with pytest.raises(ValueError):
+            state.to_midi_path(tmp_path / "pad.syx")
+        assert not (tmp_path / "pad.syx").exists()
+
+
+class TestParsePRM:
+    def test_parse(self):
+        # Given
+        content = PAD_PRM.read_text()
+
+        # When
+        values, patch_name = parse_prm(content)
+
+        # Then
+        assert patch_name == "SIMPLE PAD"
+        assert values["lfo_delay_time"] == 80
+        assert values["flt_key_follow"] == 100
+        assert set(values) == set(JU06AState.model_fields)
+
+    def test_no_space(self):
+        # When
+        values, patch_name = parse_prm("CUTOFF(130);\r\nPATCH_NAME(Brass  );\r\n")
+
+        # Then
+        assert values == {"cutoff": 130}
+        assert patch_name == "Brass"
+
+
+class TestLoadMany:
+    def test_load_many(self, tmp_path, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 10)
+
+        # When
+        states = JU06AState.load_many(paths, batch_size=3)
+
+        # Then
+        assert [state.cutoff for state in states] == list(range(10))
+        assert states[0] == JU06AState.from_path(str(paths[0]))
+
+    def test_errors(self, tmp_path, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 4)
+        paths[1].write_text(paths[1].read_text().replace("(1);", "(9);"))
+        paths.append(tmp_path / "missing.PRM")
+
+        # When
+        errors = []
+        states = JU06AState.load_many(paths, errors=errors)
+
+        # Then
+        assert [state.cutoff for state in states] == [0, 2, 3]
+        assert {path for path, _ in errors} == {paths[1], paths[4]}
+
+    def test_errors_raised(self, tmp_path, write_patches):
+        # Given
+        paths = write_patches(tmp_path, 2)
+        paths[1].write_text(paths[1].read_text().replace("(1);", "(9);"))
+
+        # When/Then
+        with pytest.raises(ValidationError):
+            JU06AState.load_many(paths)
+
+
+def _estimate_tokens(text):
+    # Rough BPE-like estimate: words, numbers by groups of 3 digits,
+    # punctuation and line breaks are one token each
+    return len(re.findall(r"[A-Za-z]+|[0-9]{1,3}|[^\sA-Za-z0-9]|\n", text))
+
+
+class TestCompact:
+    def test_roundtrip(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        row = state.to_compact_row("SIMPLE PAD")
+        new_state = JU06AState.from_compact_row(row)
+
+        # Then
+        assert row.startswith("1,25,80,1,")
+        assert row.endswith(",SIMPLE PAD")
+        assert len(row.split(",")) == len(COMPACT_HEADER.split(","))
+        assert new_state == state
+
+    def test_name_quoting(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+
+        # When
+        row = state.to_compact_row('PAD, "WARM"')
+
+        # Then
+        assert row.endswith(',"PAD, ""WARM"""')
+        assert JU06AState.from_compact_row(row) == state
+
+    def test_invalid(self):
+        # When/Then
+        with pytest.raises(ValueError):
+            JU06AState.from_compact_row("1,2,3")
+        with pytest.raises(ValidationError):
+            JU06AState.from_compact_row(",".join(["300"] * len(COMPACT_HEADER.split(","))))
+
+    def test_token_count(self):
+        # Given
+        state = JU06AState.from_path(str(PAD_PRM))
+        budget = 100_000
+
+        # When
+        prm = f"=== pad.prm ===\n{PAD_PRM.read_text()}\n"
+        compact = state.to_compact_row("SIMPLE PAD") + "\n"
+        prm_tokens = _estimate_tokens(prm)
+        compact_tokens = _estimate_tokens(compact)
+        header_tokens = _estimate_tokens(COMPACT_HEADER)
+
+        # Then
+        assert 3 * compact_tokens < prm_tokens
+        # Still true once the header is paid for
+        assert (budget - header_tokens) // compact_tokens > 3 * (budget // prm_tokens)